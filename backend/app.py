@@ -1,48 +1,138 @@
 import yaml, os
-from utils.ssh_utils import ssh_connect, ensure_remote_dependencies, setup_ssh_authorized_key
+from utils.ssh_utils import ensure_remote_dependencies, install_proxy_dependencies, setup_ssh_authorized_key
+from utils.fleet_utils import Fleet
+from utils.agent_utils import start_agent
 from utils.git_utils import setup_ssh_key, initialize_all_repos
-from utils.services_utils import initialize_services
-from server import set_dependencies, run_server
+from utils.services_utils import initialize_services, load_services_from_yaml, revalidate_services
+from utils.logging_utils import log
+from utils.startup_utils import StartupGraph
+from utils.watcher_utils import ServiceWatcher
+from utils.container_utils import ContainerCollector
+from server import set_dependencies, run_server, download_host_zip, SERVICES_YAML_PATH, STARTUP_ZIP_PATH
 import atexit
 
 BASE_DIR = os.path.dirname(__file__)
-SERVICES_YAML_PATH = os.path.join(BASE_DIR, 'services.yaml')
 CONFIG_YAML_PATH = os.path.join(BASE_DIR, 'config.yaml')
 
 def load_config():
     with open(CONFIG_YAML_PATH, "r") as f:
         return yaml.safe_load(f)
     
-def save_config(config):
-    with open(SERVICES_YAML_PATH, "w") as f:
-        yaml.safe_dump(config['services'], f)
+def save_config(fleet):
+    # Registries save themselves shortly after each change; write what is still pending
+    for host in fleet:
+        host.services.flush()
 
-def main():
-    config = load_config()
+def leased(host, fn, *args):
+    """Wraps fn(ssh, *args) as a startup step that runs on its own lease."""
+    def step():
+        with host.pool.lease() as ssh:
+            return fn(ssh, *args)
+    return step
+
+def build_startup_graph(host, fleet):
+    """
+    Startup steps for one host. Steps only wait for what they actually need,
+    so e.g. key setup, the agent and service discovery run concurrently.
+    """
+    config = host.config
+    graph = StartupGraph(host.name)
+    state = {}
 
     # --- SSH Setup ---------------
-    ssh = ssh_connect(config)
-    if not ssh:
-        exit(1)
-    
-    ensure_remote_dependencies(ssh)
-    setup_ssh_authorized_key(ssh, config)
+    def deps(ssh):
+        state["deps"] = ensure_remote_dependencies(ssh)
+        if not state["deps"]["success"]:
+            # Fail the step, so /api/ready shows it and its dependents are skipped
+            raise Exception(state["deps"]["error"])
+
+    def deps_step():
+        try:
+            leased(host, deps)()
+        except Exception:
+            # proxy_tools gets skipped: don't leave proxy installs waiting for it
+            host.dependencies_ready.set()
+            raise
+
+    def proxy_tools(ssh):
+        try:
+            if state["deps"].get("pending") and not install_proxy_dependencies(ssh, state["deps"].get("python")):
+                raise Exception("Proxy tools could not be installed")
+        finally:
+            host.dependencies_ready.set()
+
+    def agent(ssh):
+        if config.get("use_remote_agent"):
+            host.pool.agent = start_agent(ssh)
+
+    graph.add("dependencies", deps_step)
+    graph.add("proxy_tools", leased(host, proxy_tools), deps=["dependencies"])
+    graph.add("authorized_key", leased(host, setup_ssh_authorized_key, config))
+    graph.add("agent", leased(host, agent))
     # -----------------------------
 
     # --- Parse services ----------
-    initialize_services(ssh, config, SERVICES_YAML_PATH)
-    
+    # Serve the cached services right away (no VM needed) and check them against the VM afterwards
+    def services():
+        cached = load_services_from_yaml(host.services.path)
+        state["cached"] = bool(cached)
+        if cached:
+            log.info(f"[{host.name}] Loaded {len(cached)} cached services, revalidating.")
+            host.services.replace_all(cached, persist=False)
+
+    def revalidate(ssh):
+        if state["cached"]:
+            revalidate_services(ssh, config)
+        else:
+            initialize_services(ssh, config)
+
+    graph.add("services", services)
+    graph.add("revalidate", leased(host, revalidate), deps=["services", "dependencies"])
+
+    # Live container state for /api/services
+    host.collector = ContainerCollector(host)
+    graph.add("containers", host.collector.start)
+
+    # Keep the services in sync with edits made on the VM from here on
+    host.watcher = ServiceWatcher(host)
+    graph.add("watcher", host.watcher.start, deps=["revalidate"])
+
     # --- Git Setup ---------------
-    setup_ssh_key(ssh, config)
-    initialize_all_repos(ssh, config)
+    # After revalidate: the service folders are added to git's safe.directory list
+    graph.add("git_key", leased(host, setup_ssh_key, config), deps=["dependencies", "revalidate"])
+    graph.add("git_repos", leased(host, initialize_all_repos, config), deps=["git_key", "revalidate"])
     # -----------------------------
 
+    # --- Startup backup ----------
+    startup_zip_name = fleet.path_for(host, os.path.basename(STARTUP_ZIP_PATH))
+    graph.add("startup_zip", leased(host, download_host_zip, startup_zip_name), deps=["git_repos"])
+
+    return graph
+
+def main():
+    config = load_config()
+
+    # --- Connect to every host ---
+    fleet = Fleet(config, SERVICES_YAML_PATH)
+    if not fleet.start():
+        exit(1)
+
+    # --- Set up hosts in the background
+    startup = {host.name: build_startup_graph(host, fleet) for host in fleet}
+    set_dependencies(config, fleet, startup)
+    for graph in startup.values():
+        graph.start()
+
     # ---- Run Web Server -----------
-    set_dependencies(config, ssh)
     run_server()
     
-    save_config(config)
-    ssh.close()
+    for host in fleet:
+        if host.watcher:
+            host.watcher.stop()
+        if host.collector:
+            host.collector.stop()
+    save_config(fleet)
+    fleet.close()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+# Cannavaro remote helper agent.
+# Uploaded to the VM by the backend and kept alive on one long-lived SSH channel.
+# Speaks JSON-RPC 2.0 over stdin/stdout, one JSON document per line.
+# Only depends on the standard library.
+
+import glob
+import hashlib
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+# ==== Methods ====
+
+def rpc_ping():
+    return {"pid": os.getpid()}
+
+def rpc_stat(path, digest=False):
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return {"exists": False}
+    result = {
+        "exists": True,
+        "is_dir": os.path.isdir(path),
+        "size": st.st_size,
+        "mtime": st.st_mtime,
+    }
+    if digest and not result["is_dir"]:
+        with open(path, "rb") as f:
+            result["sha256"] = hashlib.sha256(f.read()).hexdigest()
+    return result
+
+def rpc_read(path):
+    with open(path, "rb") as f:
+        data = f.read()
+    st = os.stat(path)
+    return {"content": data.decode("utf-8", errors="replace"), "size": st.st_size, "mtime": st.st_mtime}
+
+def rpc_write(path, content, mode=None):
+    # Write atomically so readers never see a half-written file
+    directory = os.path.dirname(path) or "."
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".cannavaro_")
+    try:
+        with os.fdopen(fd, "w") as f:
+            f.write(content)
+        if mode is not None:
+            os.chmod(tmp_path, mode)
+        elif os.path.exists(path):
+            os.chmod(tmp_path, os.stat(path).st_mode & 0o7777)
+        else:
+            os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return rpc_stat(path)
+
+def rpc_glob(pattern, recursive=False):
+    return sorted(glob.glob(pattern, recursive=recursive))
+
+def rpc_run(command, cwd=None, timeout=None):
+    try:
+        proc = subprocess.run(
+            command, shell=True, cwd=cwd, timeout=timeout,
+            stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+        )
+    except subprocess.TimeoutExpired as e:
+        return {
+            "stdout": (e.stdout or b"").decode("utf-8", errors="replace"),
+            "stderr": f"Timed out after {timeout}s",
+            "exit_code": None,
+        }
+    return {
+        "stdout": proc.stdout.decode("utf-8", errors="replace"),
+        "stderr": proc.stderr.decode("utf-8", errors="replace"),
+        "exit_code": proc.returncode,
+    }
+
+def rpc_git(path, args, timeout=None):
+    proc = subprocess.run(
+        ["git", "-C", path] + list(args), timeout=timeout,
+        stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+    )
+    return {
+        "stdout": proc.stdout.decode("utf-8", errors="replace"),
+        "stderr": proc.stderr.decode("utf-8", errors="replace"),
+        "exit_code": proc.returncode,
+    }
+
+METHODS = {
+    "ping": rpc_ping,
+    "stat": rpc_stat,
+    "read": rpc_read,
+    "write": rpc_write,
+    "glob": rpc_glob,
+    "run": rpc_run,
+    "git": rpc_git,
+}
+
+# ==== Main loop ====
+
+def handle(line):
+    try:
+        request = json.loads(line)
+    except ValueError as e:
+        return {"jsonrpc": "2.0", "id": None, "error": {"code": -32700, "message": str(e)}}
+
+    req_id = request.get("id")
+    method = METHODS.get(request.get("method"))
+    if method is None:
+        return {"jsonrpc": "2.0", "id": req_id, "error": {"code": -32601, "message": "Method not found"}}
+
+    try:
+        result = method(**(request.get("params") or {}))
+    except Exception as e:
+        return {"jsonrpc": "2.0", "id": req_id, "error": {"code": -32000, "message": f"{type(e).__name__}: {e}"}}
+    return {"jsonrpc": "2.0", "id": req_id, "result": result}
+
+def main():
+    for line in sys.stdin:
+        if not line.strip():
+            continue
+        sys.stdout.write(json.dumps(handle(line)) + "\n")
+        sys.stdout.flush()
+
+if __name__ == "__main__":
+    main()
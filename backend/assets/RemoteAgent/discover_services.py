@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+# Cannavaro service discovery.
+# Piped to `python3 - <root_dir>` on the VM by the backend; prints one JSON
+# document describing every compose project under root_dir, so discovery
+# takes a single round-trip however many services there are.
+# An optional second argument is a JSON object {path: [mtime, sha256]} of
+# files the backend already knows; those that haven't changed are reported
+# as "unchanged" without their contents.
+# With `--watch <seconds>` as third argument it keeps running instead, polling
+# the compose files and proxy folders and printing one JSON event per line
+# whenever a service changes, appears or disappears.
+# Each changed project is also resolved with `docker compose config --format json`
+# (overrides, interpolation, extends applied) when docker compose supports it.
+# Only depends on the standard library.
+
+import hashlib
+import json
+import os
+import re
+import subprocess
+import sys
+import time
+
+HEARTBEAT_INTERVAL = 30
+PEM_RESCAN_INTERVAL = 60
+_pem_cache = {}
+
+COMPOSE_NAME = re.compile(r"^(docker-)?compose\.ya?ml$")
+MAX_DEPTH = 2
+RESOLVE_TIMEOUT = 30
+# Files besides the compose file that change what `docker compose config` returns
+PROJECT_EXTRAS = (
+    "compose.override.yml", "compose.override.yaml",
+    "docker-compose.override.yml", "docker-compose.override.yaml", ".env",
+)
+
+def compose_files(root_dir):
+    """Same files as `find root_dir -maxdepth 2 -regex '.*/\\(docker-\\)?compose\\.ya?ml'`."""
+    found = []
+    for dirpath, dirnames, filenames in os.walk(root_dir):
+        depth = dirpath[len(root_dir):].count(os.sep) + 1
+        if depth >= MAX_DEPTH:
+            dirnames[:] = []
+        found.extend(os.path.join(dirpath, f) for f in filenames if COMPOSE_NAME.match(f))
+    return sorted(found)
+
+def has_pem(folder):
+    for _, _, filenames in os.walk(folder):
+        if any(f.endswith(".pem") for f in filenames):
+            return True
+    return False
+
+def polled_has_pem(folder):
+    """
+    has_pem() for the watch loop, which would otherwise walk every project on
+    every poll. The result is reused while the folder's mtime is unchanged,
+    and recomputed every PEM_RESCAN_INTERVAL for files added in subfolders.
+    """
+    mtime, now = os.stat(folder).st_mtime, time.monotonic()
+    cached = _pem_cache.get(folder)
+    if cached and cached[0] == mtime and now - cached[1] < PEM_RESCAN_INTERVAL:
+        return cached[2]
+    found = has_pem(folder)
+    _pem_cache[folder] = (mtime, now, found)
+    return found
+
+def project_files(path):
+    folder = os.path.dirname(path)
+    extras = [os.path.join(folder, f) for f in PROJECT_EXTRAS]
+    return [path] + [f for f in extras if os.path.isfile(f)]
+
+def project_mtime(path):
+    return max(os.stat(f).st_mtime for f in project_files(path))
+
+def project_hash(path):
+    """Hash of the compose file and everything that can change its resolved config."""
+    digest = hashlib.sha256()
+    for f in project_files(path):
+        with open(f, "rb") as fh:
+            digest.update(os.path.basename(f).encode() + b"\0" + fh.read() + b"\0")
+    return digest.hexdigest()
+
+def resolve(folder):
+    """Canonical config from docker compose, or None if it isn't available."""
+    try:
+        result = subprocess.run(
+            ["docker", "compose", "config", "--format", "json"],
+            cwd=folder, capture_output=True, timeout=RESOLVE_TIMEOUT,
+        )
+    except (OSError, subprocess.TimeoutExpired):
+        return None
+    if result.returncode != 0:
+        return None
+    try:
+        return json.loads(result.stdout)
+    except ValueError:
+        return None
+
+def describe(path, known):
+    folder = os.path.dirname(path)
+    name = os.path.basename(folder)
+    entry = {"path": path, "folder": folder, "name": name}
+    try:
+        mtime = project_mtime(path)
+        entry["mtime"] = mtime
+        if path in known and known[path][0] == mtime:
+            entry["sha256"] = known[path][1]
+            entry["unchanged"] = True
+        else:
+            entry["sha256"] = project_hash(path)
+            if path in known and known[path][1] == entry["sha256"]:
+                entry["unchanged"] = True
+            else:
+                with open(path, "rb") as f:
+                    entry["content"] = f.read().decode(errors="replace")
+                entry["resolved"] = resolve(folder)
+    except OSError as e:
+        entry["content"] = ""
+        entry["error"] = str(e)
+    entry["tls"] = has_pem(folder)
+    entry["proxied"] = os.path.isdir(os.path.join(folder, f"proxy_folder_{name}"))
+    return entry
+
+def snapshot(root_dir):
+    """What a poll compares: each compose file's mtime, TLS and proxy state."""
+    snap = {}
+    for path in compose_files(root_dir):
+        folder = os.path.dirname(path)
+        name = os.path.basename(folder)
+        try:
+            mtime = project_mtime(path)
+            tls = polled_has_pem(folder)
+        except OSError:
+            continue
+        snap[path] = (mtime, tls, os.path.isdir(os.path.join(folder, f"proxy_folder_{name}")))
+    return snap
+
+def emit(event):
+    # Writing also detects a backend that went away: the pipe breaks and we exit
+    sys.stdout.write(json.dumps(event) + "\n")
+    sys.stdout.flush()
+
+def watch(root_dir, known, interval):
+    # Start from what the backend knows, so changes made before we started are reported too
+    previous = {path: (mtime, None, None) for path, (mtime, _) in known.items()}
+    last_output = time.monotonic()
+    while True:
+        current = snapshot(root_dir)
+
+        def report(path):
+            entry = describe(path, known)
+            if "sha256" in entry:
+                known[path] = [entry["mtime"], entry["sha256"]]
+            emit({"event": "changed", "entry": entry})
+
+        for path, state in current.items():
+            old = previous.get(path)
+            if old is None or old[0] != state[0] or (old[1] is not None and old[1:] != state[1:]):
+                report(path)
+                last_output = time.monotonic()
+        for path in previous.keys() - current.keys():
+            known.pop(path, None)
+            folder = os.path.dirname(path)
+            remaining = [p for p in current if os.path.dirname(p) == folder]
+            if remaining:
+                # Renamed, or one of two compose files in the folder: the service is still
+                # there. Re-send the file discovery would now use (the last one), in full,
+                # since the backend's entry may have come from the removed file.
+                known.pop(max(remaining), None)
+                report(max(remaining))
+            else:
+                emit({"event": "removed", "path": path, "name": os.path.basename(folder)})
+            last_output = time.monotonic()
+        previous = current
+
+        if time.monotonic() - last_output >= HEARTBEAT_INTERVAL:
+            emit({"event": "heartbeat"})
+            last_output = time.monotonic()
+        time.sleep(interval)
+
+def main():
+    root_dir = os.path.normpath(sys.argv[1] if len(sys.argv) > 1 else "/root")
+    known = json.loads(sys.argv[2]) if len(sys.argv) > 2 else {}
+    if len(sys.argv) > 4 and sys.argv[3] == "--watch":
+        try:
+            watch(root_dir, known, float(sys.argv[4]))
+        except (BrokenPipeError, KeyboardInterrupt):
+            pass
+        return
+
+    services = [describe(p, known) for p in compose_files(root_dir)]
+    json.dump({"root": root_dir, "services": services}, sys.stdout)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,313 @@
+# benchmarks/restart_benchmark.py
+"""
+Restart benchmark against the example services in remote_vm_example/.
+
+Brings the services up on the VM from config.yaml (see
+remote_vm_example/HOWTORUN for a local one), then times the backend's
+restart paths on each of them:
+
+- full:    restart_docker_service (docker compose down/up)
+- rolling: rolling_restart_docker_service
+- proxy:   installs a proxy on the service, then restarts its proxied
+           subservice rolling and blue/green
+
+For every run it records wall-clock time, the downtime reported by the
+VM-side readiness probe, the outages seen by sending requests to the published
+ports from here, and the number of remote round trips. Results are
+printed (or written with --out) as JSON.
+
+Run from backend/:  python -m benchmarks.restart_benchmark --out results.json
+Installing proxies changes the services' compose files: use a throwaway VM.
+"""
+import argparse
+import json
+import os
+import socket
+import statistics
+import sys
+import threading
+import time
+import yaml
+from utils.fleet_utils import Fleet
+from utils.logging_utils import log
+from utils.metrics_utils import remote_call_counts
+from utils.proxy_utils import install_proxy_for_service
+from utils.ssh_utils import exec_remote
+from utils.services_utils import (
+    READY_TIMEOUT, RESTART_PARALLELISM, blue_green_restart, build_specs_of, list_vm_services_with_ports,
+    probes_of, restart_docker_service, rolling_restart_docker_service, wait_until_ready,
+)
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_SERVICES = ("Notes", "Pwnzer0tt1Shop", "PCSS", "CheesyCheats", "Mudarabah")
+SCENARIOS = ("full", "rolling", "proxy")
+WATCH_INTERVAL = 0.05
+# Any reply counts: HTTP services answer it, others usually send an error or a banner
+PROBE_REQUEST = b"HEAD / HTTP/1.0\r\n\r\n"
+SETUP_TIMEOUT = 900
+
+
+class PortWatcher:
+    """
+    Sends a request to the given ports every WATCH_INTERVAL seconds and
+    records the windows in which they didn't answer. Accepting the connection
+    isn't enough: docker-proxy and the proxies accept while nothing is behind
+    them. With `tcp_only` a connection is enough (for services that stay
+    silent until they get input they understand).
+    """
+
+    def __init__(self, host, ports, tcp_only=False):
+        self.host = host
+        self.ports = list(ports)
+        self.tcp_only = tcp_only
+        self._outages = {port: [] for port in self.ports}
+        self._reachable = {port: False for port in self.ports}
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+    def _up(self, port):
+        try:
+            with socket.create_connection((self.host, port), timeout=0.5) as conn:
+                if self.tcp_only:
+                    return True
+                conn.sendall(PROBE_REQUEST)
+                return bool(conn.recv(1))
+        except OSError:
+            return False
+
+    def _run(self):
+        down_since = {}
+        while not self._stop.is_set():
+            for port in self.ports:
+                now = time.monotonic()
+                if self._up(port):
+                    self._reachable[port] = True
+                    if port in down_since:
+                        self._outages[port].append(now - down_since.pop(port))
+                elif port not in down_since:
+                    down_since[port] = now
+            self._stop.wait(WATCH_INTERVAL)
+        now = time.monotonic()
+        for port, since in down_since.items():
+            self._outages[port].append(now - since)
+
+    def report(self):
+        return {
+            str(port): {
+                "reachable": self._reachable[port],
+                "outages": len(self._outages[port]),
+                "longest_s": round(max(self._outages[port], default=0), 3),
+                "total_s": round(sum(self._outages[port]), 3),
+            }
+            for port in self.ports
+        }
+
+
+def published_ports(service, subservices=None):
+    return sorted({
+        port for sub in service.get("services", [])
+        if subservices is None or sub["name"] in subservices
+        for port in sub.get("ports", []) if isinstance(port, int)
+    })
+
+def main_subservice(service):
+    """The subservice exposing the service's main port (what a proxy goes in front of)."""
+    subs = service.get("services", [])
+    return next((s["name"] for s in subs if service.get("port") in s.get("ports", [])), subs[0]["name"] if subs else None)
+
+
+class Benchmark:
+    def __init__(self, host, args):
+        self.host = host
+        self.args = args
+        self.results = []
+
+    # ─── Setup ─────────────────────────────
+    def discover(self):
+        with self.host.pool.lease() as ssh:
+            services = list_vm_services_with_ports(ssh)
+        self.host.services.replace_all(services, persist=False)
+
+    def bring_up(self, name):
+        """Starts a service (not measured) and waits for its ports."""
+        service = self.host.services.get(name)
+        with self.host.pool.lease() as ssh:
+            result = exec_remote(ssh, f"cd /root/{name} && docker compose up -d --build", timeout=SETUP_TIMEOUT)
+            if result["exit_code"] != 0:
+                raise Exception(f"Could not start {name}: {result['stderr'].strip()}")
+            probes = probes_of(service) or {}
+            wait_until_ready(ssh, f"/root/{name}", f"/tmp/cannavaro-bench-{name}", probes, self.args.ready_timeout)
+
+    def install_proxy(self, name):
+        sub = main_subservice(self.host.services.get(name))
+        proxy_config = {"proxy_type": self.args.proxy_type, "protocol": "http", "tls_enabled": False, "dump_pcaps": False}
+        with self.host.pool.lease() as ssh:
+            result = install_proxy_for_service(ssh, self.host.config, name, sub, proxy_config)
+        if not result.get("success"):
+            raise Exception(f"Could not install a proxy on {name}: {result.get('error')}")
+        # The proxied subservice's ports moved
+        self.discover()
+        self.host.services.update(name, proxied=True)
+        return sub
+
+    # ─── Runs ──────────────────────────────
+    def measure(self, name, scenario, run, restart, watch):
+        service = self.host.services.get(name)
+        before = remote_call_counts()
+        started = time.monotonic()
+        with PortWatcher(self.args.probe_host, watch, self.args.tcp_only) as watcher, self.host.pool.lease() as ssh:
+            try:
+                result = restart(ssh, service)
+            except Exception as e:
+                result = {"success": False, "error": f"{type(e).__name__}: {e}"}
+            wall = time.monotonic() - started
+            # Let the watcher see the ports come back
+            time.sleep(self.args.settle)
+
+        after = remote_call_counts()
+        calls = {op: after[op] - before.get(op, 0) for op in after if after[op] != before.get(op, 0)}
+        timings = result.get("timings", {})
+        entry = {
+            "service": name,
+            "scenario": scenario,
+            "run": run,
+            "success": bool(result.get("success")),
+            "wall_s": round(wall, 3),
+            "reported_downtime_s": timings.get("downtime_s"),
+            "observed": watcher.report(),
+            "round_trips": sum(calls.values()),
+            "round_trips_by_operation": calls,
+            "timings": timings,
+            "builds": result.get("builds"),
+        }
+        if not result.get("success"):
+            entry["error"] = result.get("error")
+        log.info(f"⏱️ {name} {scenario} #{run}: {entry['wall_s']:.1f}s, {entry['round_trips']} round trips")
+        self.results.append(entry)
+
+    def run_service(self, name):
+        args = self.args
+        options = {"force_build": args.force_build, "ready_timeout": args.ready_timeout}
+
+        def full(ssh, service):
+            return restart_docker_service(ssh, name, build_specs=build_specs_of(service), probes=probes_of(service), **options)
+
+        def rolling(ssh, service, subs=None):
+            subs = subs or [s["name"] for s in service.get("services", []) if not s.get("locked")]
+            depends_on = {s["name"]: s.get("depends_on", []) for s in service.get("services", [])}
+            return rolling_restart_docker_service(
+                ssh, f"/root/{name}", subs, depends_on=depends_on, parallelism=args.parallelism,
+                build_specs=build_specs_of(service), probes=probes_of(service), **options,
+            )
+
+        self.bring_up(name)
+        service = self.host.services.get(name)
+        for run in range(1, args.repeat + 1):
+            if "full" in args.scenarios:
+                self.measure(name, "full", run, full, published_ports(service))
+            if "rolling" in args.scenarios:
+                self.measure(name, "rolling", run, rolling, published_ports(service))
+
+        if "proxy" in args.scenarios:
+            sub = self.install_proxy(name)
+            # From outside, the service is now reached through the proxy on its original port
+            watch = [service["port"]] if isinstance(service.get("port"), int) else []
+            for run in range(1, args.repeat + 1):
+                self.measure(name, "proxy_rolling", run, lambda ssh, s: rolling(ssh, s, [sub]), watch)
+                self.measure(name, "proxy_blue_green", run, lambda ssh, s: blue_green_restart(
+                    ssh, f"/root/{name}", sub, build_specs=build_specs_of(s), **options), watch)
+
+    # ─── Report ────────────────────────────
+    def summary(self):
+        groups = {}
+        for r in self.results:
+            if "wall_s" not in r:
+                continue
+            groups.setdefault((r["scenario"], r["service"]), []).append(r)
+
+        summary = {}
+        for (scenario, service), runs in sorted(groups.items()):
+            # Ports never reached from here say nothing about the restart
+            longest = [max((p["longest_s"] for p in r["observed"].values() if p["reachable"]), default=0) for r in runs]
+            summary.setdefault(scenario, {})[service] = {
+                "runs": len(runs),
+                "failures": sum(not r["success"] for r in runs),
+                "median_wall_s": round(statistics.median(r["wall_s"] for r in runs), 3),
+                "median_observed_downtime_s": round(statistics.median(longest), 3),
+                "median_round_trips": statistics.median(r["round_trips"] for r in runs),
+            }
+        return summary
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the backend's restart paths on the example services.")
+    parser.add_argument("--config", default=os.path.join(BASE_DIR, "config.yaml"))
+    parser.add_argument("--host", help="host name from config.yaml (default: the first one)")
+    parser.add_argument("--services", nargs="+", default=list(DEFAULT_SERVICES))
+    parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=list(SCENARIOS))
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--parallelism", type=int, default=RESTART_PARALLELISM)
+    parser.add_argument("--ready-timeout", type=int, default=READY_TIMEOUT)
+    parser.add_argument("--force-build", action="store_true", help="rebuild images even if their context is unchanged")
+    parser.add_argument("--proxy-type", default="DemonHill", choices=("DemonHill", "AngelPit", "Mini-Proxad"))
+    parser.add_argument("--probe-host", help="where the published ports are reached from here (default: the VM address)")
+    parser.add_argument("--settle", type=float, default=1.0, help="seconds to keep watching ports after a restart")
+    parser.add_argument("--tcp-only", action="store_true", help="count a port as up once it accepts connections, without a reply")
+    parser.add_argument("--out", help="write the JSON results here instead of stdout")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    with open(args.config, "r") as f:
+        config = yaml.safe_load(f)
+
+    fleet = Fleet(config)
+    if not fleet.start():
+        sys.exit(1)
+    host = fleet.get(args.host)
+    if args.probe_host is None:
+        remote = host.config["remote_host"]
+        args.probe_host = "127.0.0.1" if remote == "host.docker.internal" else remote
+
+    bench = Benchmark(host, args)
+    started = time.time()
+    try:
+        bench.discover()
+        for name in args.services:
+            if host.services.get(name) is None:
+                log.warning(f"⚠️ {name} not found on {host.name}, skipping it")
+                continue
+            try:
+                bench.run_service(name)
+            except Exception as e:
+                log.error(f"❌ {name}: {e}")
+                bench.results.append({"service": name, "scenario": "setup", "success": False, "error": str(e)})
+    finally:
+        fleet.close()
+
+    report = {
+        "started_at": started,
+        "host": host.name,
+        "options": {k: v for k, v in vars(args).items() if k not in ("config", "out")},
+        "summary": bench.summary(),
+        "results": bench.results,
+    }
+    output = json.dumps(report, indent=2)
+    if args.out:
+        with open(args.out, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+    return 0 if all(r["success"] for r in bench.results) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,7 +1,9 @@
 import os
 import threading
 import time
-from flask import Flask, jsonify, send_file, request, after_this_request, send_from_directory
+import shutil
+import tempfile
+from flask import Flask, jsonify, send_file, request, after_this_request, send_from_directory, g, abort, make_response, Response, stream_with_context
 from flask_cors import CORS
 from bson import ObjectId
 from utils.zip_utils import *
@@ -9,11 +11,16 @@ from utils.services_utils import *
 from utils.logging_utils import log
 from utils.proxy_utils import *
 from utils.ssh_utils import *
+from utils.job_utils import jobs, sse_stream
+from utils.bulk_utils import MAX_BUILDS, MAX_DOWN, restart_all_services
+from utils.metrics_utils import HTTP_REQUEST_SECONDS, PROMETHEUS_CONTENT_TYPE, render_metrics, set_operation, reset_operation
 
 # ─── Paths & Constants ─────────────────────
 BASE_DIR = os.path.dirname(__file__)
 ZIP_BASE_DIR = os.path.join(BASE_DIR, 'zip')
 STARTUP_ZIP_PATH, CURRENT_ZIP_DIR = setup_zip_dirs(ZIP_BASE_DIR)
+SERVICES_YAML_PATH = os.path.join(BASE_DIR, 'services.yaml')
+DEPENDENCY_WAIT = 5
 
 # ─── Flask App ─────────────────────────────
 app = Flask(__name__)
@@ -21,43 +28,285 @@ CORS(app)
 
 # ─── Globals ───────────────────────────────
 config = None
-ssh = None
+fleet = None
+startup = {}
 
-# ─── SSH Management ────────────────────────
-def set_dependencies(ext_config, ext_ssh):
-    global config, ssh
+# ─── Host & SSH Management ─────────────────
+def set_dependencies(ext_config, ext_fleet, ext_startup=None):
+    global config, fleet, startup
     config = ext_config
-    ssh = ext_ssh
-
+    fleet = ext_fleet
+    startup = ext_startup or {}
+
+
+def get_host():
+    """
+    Host addressed by the current request: `?host=` or "host" in the JSON
+    body, defaulting to the primary host.
+    """
+    if "host" not in g:
+        name = request.args.get("host") or (request.get_json(silent=True) or {}).get("host")
+        host = fleet.get(name)
+        if host is None:
+            abort(make_response(jsonify({"error": f"Unknown host '{name}'", "available": list(fleet.hosts)}), 404))
+        g.host = host
+    return g.host
 
 def get_active_ssh():
-    global ssh
-    if not is_ssh_active(ssh):
-        log.warning("SSH inactive — reconnecting...")
-        ssh = ssh_connect(config)
-    return ssh
+    """
+    Leases a pooled SSH connection to the request's host for the rest of the
+    current request. The lease is returned to the pool in release_active_ssh().
+    """
+    if "ssh_lease" not in g:
+        try:
+            g.ssh_lease = get_host().pool.acquire()
+        except TimeoutError as e:
+            log.error(f"❌ {e}")
+            return None
+    return g.ssh_lease
+
+@app.teardown_request
+def release_active_ssh(exc):
+    lease = g.pop("ssh_lease", None)
+    if lease is not None:
+        lease.pool.release(lease)
+
+# ─── Metrics ───────────────────────────────
+@app.before_request
+def start_request_timer():
+    g.request_started = time.monotonic()
+    # Remote calls made by the route are labelled with it unless a util sets a finer label
+    g.operation_token = set_operation(f"route:{request.endpoint or 'unmatched'}")
+
+@app.after_request
+def record_request_latency(response):
+    started = g.get("request_started")
+    if started is not None:
+        route = request.url_rule.rule if request.url_rule else "unmatched"
+        HTTP_REQUEST_SECONDS.observe(
+            time.monotonic() - started, method=request.method, route=route, status=response.status_code
+        )
+    return response
+
+@app.teardown_request
+def reset_request_operation(exc):
+    token = g.pop("operation_token", None)
+    if token is not None:
+        reset_operation(token)
 
 # ─── Utility ───────────────────────────────
-def get_service_by_name(name):
-    return next((s for s in config.get("services", []) if s["name"] == name), None)
+def get_service_by_name(name, host=None):
+    host = host or get_host()
+    return host.services.get(name)
+
+def plan_restart(host, parent, sub=None):
+    """Subservices a restart would touch, skipping locked ones, or an error result."""
+    service = get_service_by_name(parent, host)
+    if not service:
+        return None, {"success": False, "error": "Service not found", "status": 404}
+
+    unlocked = [s["name"] for s in service.get("services", []) if not s.get("locked")]
+    to_restart = [sub] if sub else unlocked
+
+    if not to_restart:
+        return None, {"success": False, "error": "No services to restart", "status": 400}
+    return to_restart, None
+
+def restart_service(host, ssh, parent, sub=None, progress=None, strategy=None, force_build=False):
+    """
+    Restarts a whole service, or one subservice, skipping locked subservices.
+    A whole service is either recreated with down/up ("recreate", the
+    default) or rolled ("rolling": subservices recreated in parallel in
+    depends_on order); config.yaml's restart_strategy picks the default.
+    A single subservice behind a proxy can also be swapped blue/green
+    ("blue_green"; anything else then restarts as "rolling").
+    Images whose build context is unchanged aren't rebuilt unless `force_build`,
+    and a restart only succeeds once the published ports accept connections.
+    """
+    to_restart, error = plan_restart(host, parent, sub)
+    if error:
+        return error
+
+    path = f"/root/{parent}"
+    strategy = strategy or host.config.get("restart_strategy", "recreate")
+    service = get_service_by_name(parent, host)
+    build_specs, probes = build_specs_of(service), probes_of(service)
+    ready_timeout = host.config.get("ready_timeout", READY_TIMEOUT)
+    if strategy == "blue_green" and sub and not service.get("proxied"):
+        # Without a proxy, outside traffic doesn't go through the redirect
+        log.warning(f"[{host.name}] {parent} has no proxy, restarting {sub} without blue/green")
+    elif strategy == "blue_green" and sub:
+        return blue_green_restart(ssh, path, sub, progress=progress, build_specs=build_specs,
+                                  force_build=force_build, ready_timeout=ready_timeout)
+    if not sub and strategy not in ("rolling", "blue_green"):
+        return restart_docker_service(ssh, parent, progress=progress, build_specs=build_specs, force_build=force_build,
+                                      probes=probes, ready_timeout=ready_timeout)
+
+    depends_on = {s["name"]: s.get("depends_on", []) for s in service.get("services", [])}
+    parallelism = host.config.get("restart_parallelism", RESTART_PARALLELISM)
+    return rolling_restart_docker_service(ssh, path, to_restart, progress=progress,
+                                          depends_on=depends_on, parallelism=parallelism,
+                                          build_specs=build_specs, force_build=force_build,
+                                          probes=probes, ready_timeout=ready_timeout)
+
+def restart_job(job, host, parent, sub=None, strategy=None, force_build=False):
+    with host.pool.lease() as ssh:
+        return restart_service(host, ssh, parent, sub, progress=job, strategy=strategy, force_build=force_build)
+
+def fleet_restart_job(job, parent, sub, hosts, strategy=None, force_build=False):
+    results = fleet.fan_out(
+        lambda host, ssh: restart_service(host, ssh, parent, sub, progress=job.for_host(host.name),
+                                          strategy=strategy, force_build=force_build),
+        hosts=hosts,
+    )
+    failed = {name: r.get("error") for name, r in results.items() if not r.get("success")}
+    return {"success": not failed, "hosts": results, **({"error": failed} if failed else {})}
+
+def restart_all_on_host(host, progress=None, force_build=False):
+    return restart_all_services(
+        host, progress,
+        max_builds=host.config.get("bulk_max_builds", MAX_BUILDS),
+        max_down=host.config.get("bulk_max_down", MAX_DOWN),
+        parallelism=host.config.get("restart_parallelism", RESTART_PARALLELISM),
+        force_build=force_build,
+        ready_timeout=host.config.get("ready_timeout", READY_TIMEOUT),
+    )
+
+def restart_all_job(job, host, force_build=False):
+    return restart_all_on_host(host, job, force_build)
+
+def fleet_restart_all_job(job, force_build=False):
+    # The bulk scheduler leases its own connections; the fan-out one stays idle
+    results = fleet.fan_out(lambda host, ssh: restart_all_on_host(host, job.for_host(host.name), force_build))
+    failed = {name: r.get("error") for name, r in results.items() if not r.get("success")}
+    return {"success": not failed, "hosts": results, **({"error": failed} if failed else {})}
+
+def job_accepted(job):
+    return jsonify({
+        "job_id": job.id,
+        "status_url": f"/api/jobs/{job.id}",
+        "events_url": f"/api/jobs/{job.id}/events",
+    }), 202
+
+def install_proxy_on_host(host, ssh, parent, sub, proxy_config):
+    #TODO: Multiple proxy for the same service?
+    if not host.dependencies_ready.wait(DEPENDENCY_WAIT):
+        return {"success": False, "error": "Proxy dependencies are still being installed on the VM", "status": 503}
+    if is_proxy_installed(ssh, parent):
+        return {"success": False, "error": "Proxy already installed", "status": 400}
+
+    service = get_service_by_name(parent, host)
+
+    log.info(f"[{host.name}] Installing proxy for {parent} with config: {proxy_config}")
+    result = install_proxy_for_service(ssh, host.config, parent, sub, proxy_config)
+
+    if result.get("success") and service:
+        host.services.update(parent, proxied=True)
+    return result
+
+def proxy_config_from_request(data):
+    # Build a configuration dictionary to pass to the install function
+    return {
+        "port": data.get("port", None),
+        "tls_enabled": data.get("tlsEnabled", False),
+        "server_cert": data.get("serverCert"),
+        "server_key": data.get("serverKey"),
+        "protocol": data.get("protocol", "http"),
+        "dump_pcaps": data.get("dumpPcaps", False),
+        "pcap_path": data.get("pcapPath"),
+        "proxy_type": data.get("proxyType", "AngelPit"),
+    }
+
+def download_host_zip(ssh, filename):
+    return create_and_download_zip(ssh, ZIP_BASE_DIR, filename)
 
 # ─── Routes ────────────────────────────────
 @app.route("/api/vm_ip")
 def get_vm_ip():
-    return jsonify(config.get("remote_host", "No VM IP configured"))
+    return jsonify(get_host().config.get("remote_host", "No VM IP configured"))
+
+@app.route("/api/ssh_health")
+def get_ssh_health():
+    return jsonify(get_host().pool.health())
+
+@app.route("/api/ready")
+def get_ready():
+    # Per-host startup steps with their status and timings
+    hosts = {name: graph.status() for name, graph in startup.items()}
+    ready = all(h["ready"] for h in hosts.values())
+    return jsonify({"ready": ready, "hosts": hosts}), 200 if ready else 503
+
+@app.route("/api/jobs")
+def list_jobs():
+    return jsonify([job.to_dict() for job in jobs.all()])
+
+@app.route("/api/jobs/<job_id>")
+def get_job(job_id):
+    job = jobs.get(job_id)
+    if job is None:
+        return jsonify({"error": "Job not found"}), 404
+    return jsonify(job.to_dict())
+
+@app.route("/api/jobs/<job_id>/events")
+def get_job_events(job_id):
+    # Server-Sent Events; reconnecting clients resume after Last-Event-ID
+    job = jobs.get(job_id)
+    if job is None:
+        return jsonify({"error": "Job not found"}), 404
+    last_id = request.headers.get("Last-Event-ID") or request.args.get("last_event_id") or 0
+    try:
+        last_id = int(last_id)
+    except ValueError:
+        return jsonify({"error": "Invalid Last-Event-ID"}), 400
+    headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    return Response(stream_with_context(sse_stream(job, last_id)), mimetype="text/event-stream", headers=headers)
+
+@app.route("/api/metrics")
+def get_metrics():
+    # Prometheus text exposition format
+    return render_metrics(), 200, {"Content-Type": PROMETHEUS_CONTENT_TYPE}
+
+def with_live_state(host, services):
+    """Attaches the latest container state collected in the background, if any."""
+    if host.collector is None:
+        return services
+    return host.collector.enrich(services)
+
+def services_etag(host):
+    # Changes with the registry version and with each new container snapshot
+    snapshot = host.collector.latest() if host.collector else None
+    return host.services.etag(snapshot["taken_at"] if snapshot else 0)
 
 @app.route("/api/services")
 def get_services():
     name = request.args.get("name")
-    services = config.get("services", [])
+    host = get_host()
+    etag = services_etag(host)
+    headers = {"ETag": f'W/"{etag}"'}
+    # Weak comparison: the tag is weak, and browsers send it back as such
+    if request.if_none_match.contains_weak(etag):
+        return "", 304, headers
+
+    _, services = host.services.snapshot()
     if not name:
-        return jsonify(services)
+        return jsonify(with_live_state(host, services)), 200, headers
 
-    service = get_service_by_name(name)
+    service = host.services.get(name)
     if service:
-        return jsonify(service)
+        return jsonify(with_live_state(host, [service])[0]), 200, headers
     return jsonify({"error": "Service not found", "available": [s['name'] for s in services]}), 400
 
+@app.route("/api/services/history")
+def get_service_history():
+    # Buffered container state of one subservice, oldest first
+    host = get_host()
+    name, sub = request.args.get("name"), request.args.get("subservice")
+    if not name or not sub:
+        return jsonify({"error": "Missing name or subservice"}), 400
+    if host.collector is None:
+        return jsonify([])
+    return jsonify(host.collector.history(name, sub))
+
 @app.route("/api/service_locks", methods=["GET", "POST"])
 def service_locks():
     if request.method == "GET":
@@ -75,25 +324,21 @@ def service_locks():
     sub = data.get("service")
     lock = data.get("lock")
 
-    service = get_service_by_name(parent)
-    if not service:
+    if not get_service_by_name(parent):
         return jsonify({"error": "Parent not found"}), 400
 
-    for s in service.get("services", []):
-        if s["name"] == sub:
-            s["locked"] = bool(lock)
-            break
-    else:
+    try:
+        locked = get_host().services.set_locked(parent, sub, lock)
+    except KeyError:
         return jsonify({"error": "Subservice not found"}), 404
-
-    locked = [s["name"] for s in service.get("services", []) if s.get("locked")]
     return jsonify({"locked": locked})
 
 @app.route("/api/get_startup_zip")
 def get_startup_zip():
-    if not os.path.exists(STARTUP_ZIP_PATH):
+    startup_zip_path = fleet.path_for(get_host(), STARTUP_ZIP_PATH)
+    if not os.path.exists(startup_zip_path):
         return jsonify({"error": "Startup ZIP not found"}), 404
-    return send_file(STARTUP_ZIP_PATH, as_attachment=True)
+    return send_file(startup_zip_path, as_attachment=True)
 
 @app.route("/api/get_current_zip")
 def get_current_zip():
@@ -133,27 +378,27 @@ def get_git_key():
 def reset_docker():
     data = request.get_json()
     parent, sub = data.get("service"), data.get("subservice")
-    active_ssh = get_active_ssh()
-
-    service = get_service_by_name(parent)
-    if not service:
-        return jsonify({"error": "Service not found"}), 404
-
-    unlocked = [s["name"] for s in service["services"] if not s.get("locked")]
-    to_restart = [sub] if sub else unlocked
-
-    if not to_restart:
-        return jsonify({"error": "No services to restart"}), 400
-
-    path = f"/root/{parent}"
-    if not sub:
-        result = restart_docker_service(active_ssh, parent)
-    else:
-        result = rolling_restart_docker_service(active_ssh, path, to_restart)
-
-    if result.get("success"):
-        return jsonify({"message": "Services restarted", "restarted": result.get("restarted", [])})
-    return jsonify({"error": result.get("error")}), 500
+    host = get_host()
+
+    _, error = plan_restart(host, parent, sub)
+    if error:
+        return jsonify({"error": error["error"]}), error["status"]
+
+    # Builds can take minutes: run as a job and let the client follow its events
+    strategy, force_build = data.get("strategy"), bool(data.get("force_build"))
+    job = jobs.submit("restart", restart_job, host, parent, sub, strategy, force_build,
+                      params={"host": host.name, "service": parent, "subservice": sub,
+                              "strategy": strategy, "force_build": force_build})
+    return job_accepted(job)
+
+@app.route("/api/restart_all", methods=["POST"])
+def restart_all():
+    data = request.get_json(silent=True) or {}
+    host = get_host()
+    force_build = bool(data.get("force_build"))
+    job = jobs.submit("restart_all", restart_all_job, host, force_build,
+                      params={"host": host.name, "force_build": force_build})
+    return job_accepted(job)
 
 @app.route("/api/install_proxy", methods=["POST"])
 def install_proxy():
@@ -161,43 +406,14 @@ def install_proxy():
 
     parent = data.get("service")
     sub = data.get("subservice")
-    port = data.get("port", None)
-    tls_enabled = data.get("tlsEnabled", False)
-    server_cert = data.get("serverCert")
-    server_key = data.get("serverKey")
-    protocol = data.get("protocol", "http")
-    dump_pcaps = data.get("dumpPcaps", False)
-    pcap_path = data.get("pcapPath")
-    proxy_type = data.get("proxyType", "AngelPit")
-
     active_ssh = get_active_ssh()
 
-    #TODO: Multiple proxy for the same service?
-    if is_proxy_installed(active_ssh, parent):
-        return jsonify({"error": "Proxy already installed"}), 400
-
-    service = get_service_by_name(parent)
-
-    # Build a configuration dictionary to pass to the install function
-    proxy_config = {
-        "port": port,
-        "tls_enabled": tls_enabled,
-        "server_cert": server_cert,
-        "server_key": server_key,
-        "protocol": protocol,
-        "dump_pcaps": dump_pcaps,
-        "pcap_path": pcap_path,
-        "proxy_type": proxy_type,
-    }
-    log.info(f"Installing proxy for {parent} with config: {proxy_config}")
-    result = install_proxy_for_service(active_ssh, config, parent, sub, proxy_config)
+    result = install_proxy_on_host(get_host(), active_ssh, parent, sub, proxy_config_from_request(data))
 
     if result.get("success"):
-        if service:
-            service["proxied"] = True
         return jsonify({"message": "Proxy installed"})
 
-    return jsonify({"error": result.get("error", "Unknown error")}), 500
+    return jsonify({"error": result.get("error", "Unknown error")}), result.get("status", 500)
 
 
 @app.route("/api/get_proxy_logs", methods=["POST"])
@@ -294,6 +510,96 @@ def save_proxy_regex():
 
     return jsonify({"error": result.get("error")}), 500
 
+# ─── Fleet Routes ──────────────────────────
+def hosts_with_service(parent):
+    return [h.name for h in fleet if get_service_by_name(parent, h)]
+
+@app.route("/api/fleet")
+def get_fleet():
+    return jsonify({
+        "primary": fleet.primary,
+        "hosts": {h.name: h.pool.health() for h in fleet},
+    })
+
+@app.route("/api/fleet/services")
+def get_fleet_services():
+    return jsonify({h.name: with_live_state(h, h.services.all()) for h in fleet})
+
+@app.route("/api/fleet/discover", methods=["POST"])
+def fleet_discover():
+    def discover(host, ssh):
+        services = initialize_services(ssh, host.config)
+        return {"success": services is not None, "services": len(services or [])}
+
+    return jsonify(fleet.fan_out(discover))
+
+@app.route("/api/fleet/reset_docker", methods=["POST"])
+def fleet_reset_docker():
+    data = request.get_json()
+    parent, sub = data.get("service"), data.get("subservice")
+
+    hosts = hosts_with_service(parent)
+    if not hosts:
+        return jsonify({"error": "Service not found on any host"}), 404
+
+    strategy, force_build = data.get("strategy"), bool(data.get("force_build"))
+    job = jobs.submit("fleet_restart", fleet_restart_job, parent, sub, hosts, strategy, force_build,
+                      params={"hosts": hosts, "service": parent, "subservice": sub,
+                              "strategy": strategy, "force_build": force_build})
+    return job_accepted(job)
+
+@app.route("/api/fleet/restart_all", methods=["POST"])
+def fleet_restart_all():
+    data = request.get_json(silent=True) or {}
+    force_build = bool(data.get("force_build"))
+    job = jobs.submit("fleet_restart_all", fleet_restart_all_job, force_build,
+                      params={"hosts": [h.name for h in fleet], "force_build": force_build})
+    return job_accepted(job)
+
+@app.route("/api/fleet/install_proxy", methods=["POST"])
+def fleet_install_proxy():
+    data = request.get_json()
+    parent, sub = data.get("service"), data.get("subservice")
+
+    hosts = hosts_with_service(parent)
+    if not hosts:
+        return jsonify({"error": "Service not found on any host"}), 404
+
+    results = fleet.fan_out(install_proxy_on_host, parent, sub, proxy_config_from_request(data), hosts=hosts)
+    status = 200 if all(r.get("success") for r in results.values()) else 500
+    return jsonify(results), status
+
+@app.route("/api/fleet/get_current_zip")
+def get_fleet_current_zip():
+    """Backs up every host in parallel and bundles the per-host ZIPs into one."""
+    timestamped = create_timestamped_filename()
+    results = fleet.fan_out(lambda host, ssh: download_host_zip(ssh, f"{host.name}_{timestamped}"))
+
+    bundle_dir = tempfile.mkdtemp(dir=ZIP_BASE_DIR)
+    for name, zip_path in results.items():
+        if isinstance(zip_path, str):
+            os.rename(zip_path, os.path.join(bundle_dir, f"{name}.zip"))
+        else:
+            log.error(f"❌ Failed to create ZIP for host {name}")
+
+    if not os.listdir(bundle_dir):
+        shutil.rmtree(bundle_dir)
+        return jsonify({"error": "Failed to create ZIP"}), 500
+
+    dest_path = os.path.join(CURRENT_ZIP_DIR, f"fleet_{timestamped}")
+    create_local_backup_zip(bundle_dir, dest_path)
+    shutil.rmtree(bundle_dir)
+
+    @after_this_request
+    def cleanup(response):
+        try:
+            os.remove(dest_path)
+        except Exception as e:
+            log.error(f"Cleanup failed: {e}")
+        return response
+
+    return send_file(dest_path, as_attachment=True)
+
 @app.route('/', defaults={'path': ''})
 @app.route('/<path:path>')
 def serve_react(path):
@@ -304,7 +610,6 @@ def serve_react(path):
 
 
 def run_server():
-    create_and_download_zip(get_active_ssh(), ZIP_BASE_DIR, filename="home_backup_startup.zip")
     app.run(host='0.0.0.0', port=7000, debug=False)
 
 if __name__ == "__main__":
@@ -0,0 +1,210 @@
+# utils/agent_utils.py
+import itertools
+import json
+import os
+import shlex
+import socket
+import threading
+import time
+from utils.logging_utils import log
+from utils.metrics_utils import current_operation, record_remote_call
+from utils.ssh_utils import run_remote_command, exec_remote, sftp_session
+
+LOCAL_AGENT_PATH = os.path.join(os.path.dirname(__file__), "../assets/RemoteAgent/cannavaro_agent.py")
+REMOTE_AGENT_DIR = "/root/.cannavaro"
+REMOTE_AGENT_PATH = f"{REMOTE_AGENT_DIR}/cannavaro_agent.py"
+# Added to the call's own "timeout" parameter, if any
+CALL_TIMEOUT = 30
+# Restarts back off from RETRY_DELAY, doubling; after MAX_FAILURES the agent stays off
+RETRY_DELAY = 5
+MAX_FAILURES = 5
+
+
+class AgentError(Exception):
+    pass
+
+
+class RemoteAgent:
+    """
+    Client for the helper agent running on the VM.
+    Requests are JSON-RPC 2.0 documents, one per line, sent over a single
+    long-lived SSH channel. Calls are serialized: one message in flight at a time.
+    """
+
+    def __init__(self, transport):
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1)
+        self._channel = transport.open_session()
+        self._channel.exec_command(f"python3 -u {REMOTE_AGENT_PATH}")
+        self._stdin = self._channel.makefile("wb")
+        self._stdout = self._channel.makefile("rb")
+
+    def is_alive(self):
+        return not self._channel.closed and not self._channel.exit_status_ready()
+
+    def call(self, method, **params):
+        started = time.monotonic()
+        try:
+            result = self._call(method, **params)
+        except Exception:
+            record_remote_call(current_operation(), f"agent_{method}", time.monotonic() - started, "error")
+            raise
+        record_remote_call(current_operation(), f"agent_{method}", time.monotonic() - started, "ok")
+        return result
+
+    def _call(self, method, **params):
+        with self._lock:
+            if not self.is_alive():
+                raise AgentError("Remote agent is not running")
+
+            req_id = next(self._ids)
+            message = {"jsonrpc": "2.0", "id": req_id, "method": method, "params": params}
+            self._channel.settimeout(CALL_TIMEOUT + (params.get("timeout") or 0))
+            try:
+                self._stdin.write((json.dumps(message) + "\n").encode())
+                self._stdin.flush()
+                line = self._stdout.readline()
+            except socket.timeout:
+                # A late reply would be read as the next call's: drop the channel
+                self.close()
+                raise AgentError(f"Remote agent did not answer {method} in time")
+            if not line:
+                self.close()
+                raise AgentError("Remote agent closed the channel")
+
+        response = json.loads(line)
+        if response.get("id") != req_id:
+            raise AgentError(f"Unexpected response id {response.get('id')} (expected {req_id})")
+        if "error" in response:
+            raise AgentError(response["error"].get("message"))
+        return response["result"]
+
+    def close(self):
+        try:
+            self._channel.close()
+        except Exception:
+            pass
+
+
+def start_agent(ssh):
+    """
+    Uploads the agent to the VM and starts it on its own channel of the given
+    connection's transport. Returns None if the agent could not be started.
+    """
+    try:
+        run_remote_command(ssh, f"mkdir -p {REMOTE_AGENT_DIR}")
+        with sftp_session(ssh) as sftp:
+            sftp.put(LOCAL_AGENT_PATH, REMOTE_AGENT_PATH)
+
+        agent = RemoteAgent(ssh.get_transport())
+        pid = agent.call("ping")["pid"]
+        log.info(f"🤖 Remote agent running on VM (pid {pid})")
+        return agent
+    except Exception as e:
+        log.error(f"❌ Failed to start remote agent: {type(e).__name__}: {e}")
+        return None
+
+
+def get_agent(ssh):
+    """
+    Returns the running agent attached to the connection pool behind `ssh`,
+    restarting it if it died. Returns None when the agent is disabled, or
+    while it is being restarted or backing off after failed starts: callers
+    fall back to plain SSH instead of waiting.
+    """
+    pool = getattr(ssh, "pool", None)
+    if pool is None or not pool.config.get("use_remote_agent"):
+        return None
+
+    agent = pool.agent
+    if agent is not None and agent.is_alive():
+        return agent
+    if pool.agent_failures >= MAX_FAILURES or time.monotonic() < pool.agent_retry_at:
+        return None
+    if not pool.agent_lock.acquire(blocking=False):
+        return None
+
+    try:
+        agent = pool.agent
+        if agent is None or not agent.is_alive():
+            log.warning("Remote agent not running — starting it...")
+            agent = pool.agent = start_agent(ssh)
+            if agent is None:
+                pool.agent_failures += 1
+                pool.agent_retry_at = time.monotonic() + RETRY_DELAY * 2 ** (pool.agent_failures - 1)
+                if pool.agent_failures >= MAX_FAILURES:
+                    log.error(f"❌ Remote agent failed to start {MAX_FAILURES} times, disabled; using plain SSH.")
+            else:
+                pool.agent_failures = 0
+        return agent
+    finally:
+        pool.agent_lock.release()
+
+
+def read_remote_file(ssh, path):
+    """
+    Reads a text file from the VM: one agent message when the agent is
+    available, a `cat` over a new exec channel otherwise.
+    """
+    agent = get_agent(ssh)
+    if agent:
+        try:
+            return agent.call("read", path=path)["content"]
+        except AgentError as e:
+            if str(e).startswith("FileNotFoundError"):
+                raise FileNotFoundError(str(e))
+            log.warning(f"⚠️ Agent read of {path} failed, falling back to cat: {e}")
+
+    result = exec_remote(ssh, f"cat {path}")
+    content = result["stdout"]
+    err = result["stderr"].strip()
+    if err:
+        raise FileNotFoundError(err)
+    return content
+
+
+def write_remote_file(ssh, path, content, mode=None):
+    """
+    Writes a text file on the VM: an atomic agent write when the agent is
+    available, an SFTP upload otherwise.
+    """
+    agent = get_agent(ssh)
+    if agent:
+        try:
+            agent.call("write", path=path, content=content, mode=mode)
+            return
+        except AgentError as e:
+            log.warning(f"⚠️ Agent write of {path} failed, falling back to SFTP: {e}")
+
+    with sftp_session(ssh) as sftp:
+        with sftp.open(path, "w") as f:
+            f.write(content)
+        if mode is not None:
+            sftp.chmod(path, mode)
+
+
+def stat_remote_file(ssh, path):
+    """
+    Returns {'mtime': ..., 'size': ..., 'sha256': ...} for a remote file, or
+    None if it does not exist or isn't a file (either way, nothing to read). The hash is what tells versions apart: two
+    writes within the same second share an mtime (SFTP only has seconds).
+    Costs one agent message or one command.
+    """
+    agent = get_agent(ssh)
+    if agent:
+        try:
+            st = agent.call("stat", path=path, digest=True)
+            # Directories come back without a hash; sha256sum fails on them below too
+            if not st["exists"] or st.get("sha256") is None:
+                return None
+            return {"mtime": st["mtime"], "size": st["size"], "sha256": st["sha256"]}
+        except AgentError as e:
+            log.warning(f"⚠️ Agent stat of {path} failed, falling back to a command: {e}")
+
+    quoted = shlex.quote(path)
+    result = exec_remote(ssh, f"stat -c '%Y %s' -- {quoted} && sha256sum -- {quoted}")
+    if result["exit_code"] != 0:
+        return None
+    stat_line, hash_line = result["stdout"].splitlines()[:2]
+    mtime, size = stat_line.split()
+    return {"mtime": float(mtime), "size": int(size), "sha256": hash_line.split()[0]}
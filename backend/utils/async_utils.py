@@ -0,0 +1,229 @@
+# utils/async_utils.py
+import asyncio
+import codecs
+import os
+import threading
+import time
+import weakref
+from utils.logging_utils import log
+from utils.metrics_utils import current_operation, operation, record_remote_call
+
+DEFAULT_MAX_CONCURRENCY = 8
+MIN_POLL_INTERVAL = 0.005
+MAX_POLL_INTERVAL = 0.1
+RECV_BUFFER = 32768
+
+
+class RemoteExecutor:
+    """
+    Runs remote commands and SFTP transfers on an asyncio loop in a dedicated
+    thread. Every operation gets a real timeout, can be cancelled, and counts
+    against the concurrency limit of the SSH transport it runs on, so long
+    builds on one host don't hold up commands to the others. Pooled
+    connections take the limit from the host's `ssh_max_concurrency`
+    (default: its `ssh_max_channels`); plain clients use `max_concurrency`.
+    Blocking callers (Flask routes, startup code) use run(); coroutines can
+    await the methods directly.
+    """
+
+    def __init__(self, max_concurrency=DEFAULT_MAX_CONCURRENCY):
+        self.max_concurrency = max_concurrency
+        self.loop = asyncio.new_event_loop()
+        self._ready = threading.Event()
+        self._thread = threading.Thread(target=self._run_loop, name="remote-exec", daemon=True)
+        self._thread.start()
+        self._ready.wait()
+
+    def _run_loop(self):
+        asyncio.set_event_loop(self.loop)
+        # One per transport, dropped with it (e.g. after a reconnect)
+        self._semaphores = weakref.WeakKeyDictionary()
+        self._ready.set()
+        self.loop.run_forever()
+
+    def _semaphore(self, ssh):
+        # Only called on the loop thread, so no lock is needed
+        transport = ssh.get_transport()
+        semaphore = self._semaphores.get(transport)
+        if semaphore is None:
+            pool = getattr(ssh, "pool", None)
+            limit = self.max_concurrency
+            if pool is not None:
+                limit = pool.config.get("ssh_max_concurrency", pool.max_channels)
+            semaphore = self._semaphores[transport] = asyncio.Semaphore(max(1, limit))
+        return semaphore
+
+    # ─── Sync bridge ───────────────────────
+    def submit(self, coro):
+        """Schedules a coroutine on the executor loop and returns a concurrent Future."""
+        # Tasks don't inherit the caller thread's context, so carry the metrics label over
+        return asyncio.run_coroutine_threadsafe(self._labelled(current_operation(), coro), self.loop)
+
+    @staticmethod
+    async def _labelled(name, coro):
+        with operation(name):
+            return await coro
+
+    def run(self, coro):
+        """Runs a coroutine on the executor loop and blocks until it finishes."""
+        if threading.current_thread() is self._thread:
+            raise RuntimeError("RemoteExecutor.run() called from the executor loop; await the coroutine instead")
+        future = self.submit(coro)
+        try:
+            return future.result()
+        except asyncio.TimeoutError as e:
+            raise TimeoutError(str(e) or "Remote operation timed out") from None
+        except BaseException:
+            future.cancel()
+            raise
+
+    # ─── Commands ──────────────────────────
+    async def exec_command(self, ssh, command, timeout=None, stdin_data=None, cleanup=None, on_output=None):
+        """
+        Runs `command` on a new channel and collects its output.
+        Returns a dict with 'command', 'stdout', 'stderr' and 'exit_code'.
+        On timeout or cancellation the channel is closed and, if given, the
+        `cleanup` command is run to stop anything left behind on the VM.
+        If given, on_output(stream, text) is called with output as it arrives.
+        """
+        async with self._semaphore(ssh):
+            started = time.monotonic()
+            bytes_out = len(stdin_data) if stdin_data else 0
+            channel = None
+            try:
+                channel = await self._open_channel(ssh, command)
+                coro = self._collect(channel, stdin_data, on_output)
+                stdout, stderr, exit_code = await asyncio.wait_for(coro, timeout)
+            except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+                if channel is not None:
+                    channel.close()
+                status = "timeout" if isinstance(e, asyncio.TimeoutError) else "cancelled"
+                record_remote_call(current_operation(), "exec", time.monotonic() - started, status, bytes_out=bytes_out)
+                if cleanup:
+                    await self._run_cleanup(ssh, cleanup)
+                if isinstance(e, asyncio.TimeoutError):
+                    raise asyncio.TimeoutError(f"Timed out after {timeout}s: {command}") from None
+                raise
+            except Exception:
+                record_remote_call(current_operation(), "exec", time.monotonic() - started, "error", bytes_out=bytes_out)
+                raise
+            finally:
+                if channel is not None:
+                    channel.close()
+
+        record_remote_call(
+            current_operation(), "exec", time.monotonic() - started,
+            "ok" if exit_code == 0 else "failed",
+            bytes_in=len(stdout) + len(stderr), bytes_out=bytes_out, exit_code=exit_code,
+        )
+        return {
+            "command": command,
+            "stdout": stdout.decode(errors="replace"),
+            "stderr": stderr.decode(errors="replace"),
+            "exit_code": exit_code,
+        }
+
+    async def _open_channel(self, ssh, command):
+        def open_and_exec():
+            channel = ssh.get_transport().open_session()
+            channel.exec_command(command)
+            return channel
+
+        return await self.loop.run_in_executor(None, open_and_exec)
+
+    async def _collect(self, channel, stdin_data, on_output=None):
+        # Stdin is written as the channel window allows, between reads: a
+        # blocking sendall() would stall the loop and every other command on it
+        pending = memoryview(stdin_data.encode() if isinstance(stdin_data, str) else (stdin_data or b""))
+        if not pending:
+            channel.shutdown_write()
+
+        stdout, stderr = bytearray(), bytearray()
+        # Incremental decoders so multi-byte characters split across chunks survive
+        decoders = {"stdout": codecs.getincrementaldecoder("utf-8")("replace"),
+                    "stderr": codecs.getincrementaldecoder("utf-8")("replace")}
+
+        def received(stream, buffer, chunk):
+            buffer += chunk
+            if on_output:
+                on_output(stream, decoders[stream].decode(chunk))
+
+        delay = MIN_POLL_INTERVAL
+        while True:
+            progressed = False
+            if pending:
+                # Nothing left to write to once the command has exited
+                while pending and channel.send_ready() and not channel.closed:
+                    pending = pending[channel.send(pending[:RECV_BUFFER]):]
+                    progressed = True
+                if not pending:
+                    channel.shutdown_write()
+            while channel.recv_ready():
+                received("stdout", stdout, channel.recv(RECV_BUFFER))
+                progressed = True
+            while channel.recv_stderr_ready():
+                received("stderr", stderr, channel.recv_stderr(RECV_BUFFER))
+                progressed = True
+
+            # The exit status is sent after all output, so nothing is left to read
+            if channel.exit_status_ready() and not channel.recv_ready() and not channel.recv_stderr_ready():
+                break
+
+            delay = MIN_POLL_INTERVAL if progressed else min(delay * 2, MAX_POLL_INTERVAL)
+            await asyncio.sleep(delay)
+
+        return bytes(stdout), bytes(stderr), channel.recv_exit_status()
+
+    async def _run_cleanup(self, ssh, cleanup):
+        try:
+            channel = await self._open_channel(ssh, cleanup)
+            await asyncio.wait_for(self._collect(channel, None), 10)
+            channel.close()
+        except Exception as e:
+            log.warning(f"⚠️ Cleanup command failed: {e}")
+
+    # ─── SFTP ──────────────────────────────
+    async def sftp_get(self, ssh, remote_path, local_path, timeout=None):
+        await self._sftp_transfer(ssh, "get", remote_path, local_path, timeout)
+
+    async def sftp_put(self, ssh, local_path, remote_path, timeout=None):
+        await self._sftp_transfer(ssh, "put", local_path, remote_path, timeout)
+
+    async def _sftp_transfer(self, ssh, method, src, dst, timeout):
+        # Pooled leases hand out cached sessions; plain clients get a fresh one
+        pooled = hasattr(ssh, "checkout_sftp")
+        local_path = dst if method == "get" else src
+        async with self._semaphore(ssh):
+            started = time.monotonic()
+            open_sftp = ssh.checkout_sftp if pooled else ssh.open_sftp
+            sftp = await self.loop.run_in_executor(None, open_sftp)
+            try:
+                transfer = self.loop.run_in_executor(None, getattr(sftp, method), src, dst)
+                await asyncio.wait_for(transfer, timeout)
+            except BaseException as e:
+                # Closing the session also aborts a transfer still running in the worker thread
+                sftp.close()
+                status = "timeout" if isinstance(e, asyncio.TimeoutError) else "error"
+                record_remote_call(current_operation(), f"sftp_{method}", time.monotonic() - started, status)
+                raise
+            size = os.path.getsize(local_path) if os.path.exists(local_path) else 0
+            record_remote_call(
+                current_operation(), f"sftp_{method}", time.monotonic() - started, "ok",
+                **({"bytes_in": size} if method == "get" else {"bytes_out": size}),
+            )
+            if pooled:
+                ssh.checkin_sftp(sftp)
+            else:
+                sftp.close()
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+def get_executor():
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = RemoteExecutor()
+    return _executor
@@ -0,0 +1,80 @@
+# utils/build_utils.py
+import hashlib
+import json
+import posixpath
+import shlex
+from utils.logging_utils import log
+from utils.ssh_utils import run_remote_batch
+
+# Hash of the last successful build of each subservice, kept on the VM
+BUILD_STATE_DIR = "/root/.cannavaro/builds"
+HASH_TIMEOUT = 60
+
+
+def normalize_build(build, folder):
+    """A compose `build:` entry as a dict with an absolute 'context'."""
+    spec = dict(build) if isinstance(build, dict) else {"context": build}
+    context = spec.get("context") or "."
+    spec["context"] = posixpath.normpath(posixpath.join(folder, context)) if folder else context
+    return spec
+
+def context_hash_command(context):
+    """
+    Prints a content hash of a build context inside a git repo: the committed
+    tree, uncommitted changes and untracked (not ignored) files. Fails outside
+    a git repo, so such contexts are always built.
+    """
+    return (
+        f"cd {shlex.quote(context)} && git rev-parse --is-inside-work-tree >/dev/null 2>&1 && "
+        "{ git rev-parse HEAD:./ 2>/dev/null; git diff HEAD -- . 2>/dev/null; "
+        "git ls-files -o --exclude-standard -z -- . | xargs -0 -r sha256sum; } | sha256sum | cut -d' ' -f1"
+    )
+
+def _state_path(project, service):
+    return f"{BUILD_STATE_DIR}/{project}/{service}"
+
+def plan_builds(ssh, project, build_specs, force=False):
+    """
+    Decides which subservices need a build. `build_specs` is {service: build
+    spec}; the compose build spec is hashed together with the context, so
+    changed build args or Dockerfile paths also trigger a build.
+    Returns {"build": [...], "skip": [...], "hashes": {service: hash}}.
+    """
+    services = list(build_specs)
+    commands = []
+    for svc in services:
+        commands.append(context_hash_command(build_specs[svc]["context"]))
+        commands.append(f"cat {shlex.quote(_state_path(project, svc))} 2>/dev/null")
+    results = run_remote_batch(ssh, commands, timeout=HASH_TIMEOUT) if commands else []
+
+    plan = {"build": [], "skip": [], "hashes": {}}
+    for i, svc in enumerate(services):
+        context_hash, stored = results[2 * i], results[2 * i + 1]
+        if context_hash["exit_code"] != 0 or not context_hash["stdout"].strip():
+            plan["build"].append(svc)
+            continue
+
+        spec = json.dumps(build_specs[svc], sort_keys=True)
+        digest = hashlib.sha256((context_hash["stdout"].strip() + spec).encode()).hexdigest()
+        plan["hashes"][svc] = digest
+        if not force and stored["stdout"].strip() == digest:
+            plan["skip"].append(svc)
+        else:
+            plan["build"].append(svc)
+
+    if plan["skip"]:
+        log.info(f"⏭️ Build context unchanged, skipping build of: {', '.join(plan['skip'])}")
+    return plan
+
+def record_builds(ssh, project, hashes):
+    """Remembers the hashes of successfully built subservices."""
+    if not hashes:
+        return
+    commands = [f"mkdir -p {shlex.quote(f'{BUILD_STATE_DIR}/{project}')}"]
+    commands += [
+        f"printf '%s' {shlex.quote(digest)} > {shlex.quote(_state_path(project, svc))}"
+        for svc, digest in hashes.items()
+    ]
+    failed = [r for r in run_remote_batch(ssh, commands, timeout=HASH_TIMEOUT) if r["exit_code"] != 0]
+    if failed:
+        log.warning(f"⚠️ Could not record build hashes: {failed[0]['stderr'].strip()}")
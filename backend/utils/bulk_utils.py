@@ -0,0 +1,118 @@
+# utils/bulk_utils.py
+import contextvars
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from utils.logging_utils import log
+from utils.metrics_utils import operation
+from utils.services_utils import (
+    READY_TIMEOUT, RESTART_PARALLELISM, build_specs_of, build_subservices, probes_of, recreate_in_dependency_order,
+)
+
+MAX_BUILDS = 2
+MAX_DOWN = 1
+MAX_WORKERS = 16
+
+
+class ServiceProgress:
+    """Tags a bulk restart's steps and output with the service they belong to."""
+
+    def __init__(self, progress, service):
+        self.progress = progress
+        self.service = service
+
+    def step(self, name):
+        self.progress.step(f"{self.service}: {name}")
+
+    def output(self, stream, text, service=None):
+        # `service` is a subservice of this one
+        self.progress.output(stream, text, service=f"{self.service}/{service}" if service else self.service)
+
+
+def plan_bulk_restart(services):
+    """
+    [(service, [unlocked subservices])] for every service with something to
+    restart, smallest first: short recreates go down and come back before
+    bigger ones, which keeps the average wait for a down slot low.
+    """
+    plan = []
+    for service in services:
+        unlocked = [s["name"] for s in service.get("services", []) if not s.get("locked")]
+        if unlocked:
+            plan.append((service, unlocked))
+    return sorted(plan, key=lambda p: (len(p[1]), p[0]["name"]))
+
+
+def restart_all_services(host, progress=None, max_builds=MAX_BUILDS, max_down=MAX_DOWN,
+                         parallelism=RESTART_PARALLELISM, force_build=False, ready_timeout=READY_TIMEOUT):
+    """
+    Restarts every unlocked subservice of every service on a host.
+    Each service is built first, while its containers keep serving, with at
+    most `max_builds` builds running on the VM. Only then is it recreated
+    (in depends_on order, waiting for its ports), with at most `max_down`
+    services being recreated at once. Returns a per-service report.
+    """
+    services = host.services.all()
+    plan = plan_bulk_restart(services)
+    planned = {service["name"] for service, _ in plan}
+    builds, downs = threading.Semaphore(max(1, max_builds)), threading.Semaphore(max(1, max_down))
+    started = time.monotonic()
+    log.info(f"🔁 [{host.name}] Restarting {len(plan)} services ({max_builds} builds, {max_down} down at a time).")
+
+    def restart(service, to_restart):
+        name, path = service["name"], f"/root/{service['name']}"
+        service_progress = ServiceProgress(progress, name) if progress is not None else None
+        report = {"subservices": to_restart}
+        queued = time.monotonic()
+
+        with builds, host.pool.lease() as ssh:
+            build_started = time.monotonic()
+            error, report["builds"] = build_subservices(ssh, path, to_restart, service_progress,
+                                                        build_specs_of(service), force_build)
+        built = time.monotonic()
+        report["timings"] = {"build_wait_s": round(build_started - queued, 3), "build_s": round(built - build_started, 3)}
+        if error:
+            # Nothing was taken down: the running containers are left as they were
+            return dict(report, success=False, error=error)
+
+        depends_on = {s["name"]: s.get("depends_on", []) for s in service.get("services", [])}
+        with downs, host.pool.lease() as ssh:
+            down_started = time.monotonic()
+            failed, durations, downtime = recreate_in_dependency_order(
+                ssh, path, to_restart, depends_on, parallelism, service_progress, probes_of(service), ready_timeout,
+            )
+        report["timings"].update({
+            "down_wait_s": round(down_started - built, 3),
+            "recreate_s": round(time.monotonic() - down_started, 3),
+            "per_service_s": durations,
+            "downtime_s": downtime,
+        })
+        if failed:
+            return dict(report, success=False, error=failed)
+        return dict(report, success=True)
+
+    def run(service, to_restart):
+        try:
+            return restart(service, to_restart)
+        except Exception as e:
+            log.error(f"❌ [{host.name}] Restart of {service['name']} failed: {type(e).__name__}: {e}")
+            return {"subservices": to_restart, "success": False, "error": str(e)}
+
+    with operation("restart_all_services"), ThreadPoolExecutor(max_workers=max(1, min(len(plan), MAX_WORKERS))) as pool:
+        # Worker threads don't inherit the metrics label
+        futures = {s["name"]: pool.submit(contextvars.copy_context().run, run, s, subs) for s, subs in plan}
+        reports = {name: future.result() for name, future in futures.items()}
+
+    failed = {name: r["error"] for name, r in reports.items() if not r["success"]}
+    total = round(time.monotonic() - started, 3)
+    log.info(f"🔁 [{host.name}] Restarted {len(reports) - len(failed)}/{len(reports)} services in {total:.1f}s.")
+    result = {
+        "success": not failed,
+        "services": reports,
+        # Every subservice locked
+        "skipped": [s["name"] for s in services if s["name"] not in planned],
+        "timings": {"max_builds": max_builds, "max_down": max_down, "total_s": total},
+    }
+    if failed:
+        result["error"] = failed
+    return result
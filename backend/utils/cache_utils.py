@@ -0,0 +1,117 @@
+# utils/cache_utils.py
+import threading
+import time
+from utils.agent_utils import read_remote_file, stat_remote_file
+
+FILE_TTL = 2
+PROBE_TTL = 30
+
+
+class RemoteCache:
+    """
+    Local cache for read-only remote queries.
+
+    File entries are keyed by (host, path) and remember the content hash of
+    the version they were read at. Within FILE_TTL an entry is served as-is;
+    after that it is revalidated with a single stat and only re-read if the
+    hash changed (mtimes can't tell apart two writes in the same second).
+    Values derived from a file (e.g. the parsed regex list) are cached with
+    the entry and dropped with it.
+
+    Probe entries cache the result of a remote check for PROBE_TTL seconds.
+
+    The backend's own write paths invalidate entries explicitly, so a save is
+    always visible on the next read.
+    """
+
+    def __init__(self, file_ttl=FILE_TTL, probe_ttl=PROBE_TTL):
+        self.file_ttl = file_ttl
+        self.probe_ttl = probe_ttl
+        self._files = {}
+        self._probes = {}
+        self._lock = threading.Lock()
+
+    # ─── Files ─────────────────────────────
+    def _validated_entry(self, ssh, path):
+        key = (host_key(ssh), path)
+        now = time.monotonic()
+
+        with self._lock:
+            entry = self._files.get(key)
+        if entry and now - entry["checked_at"] < self.file_ttl:
+            return entry
+
+        st = stat_remote_file(ssh, path)
+        if st is None:
+            self._drop(key)
+            raise FileNotFoundError(f"No such file: {path}")
+
+        if entry and entry["sha256"] == st["sha256"]:
+            entry["checked_at"] = now
+            return entry
+
+        # Stat before reading: if the file changes in between, the next
+        # validation sees a different hash and reads it again.
+        entry = {
+            "sha256": st["sha256"],
+            "content": read_remote_file(ssh, path),
+            "derived": {},
+            "checked_at": now,
+        }
+        with self._lock:
+            self._files[key] = entry
+        return entry
+
+    def read(self, ssh, path):
+        return self._validated_entry(ssh, path)["content"]
+
+    def derive(self, ssh, path, name, fn):
+        """Returns fn(content) for the file, computed once per file version."""
+        entry = self._validated_entry(ssh, path)
+        derived = entry["derived"]
+        if name not in derived:
+            derived[name] = fn(entry["content"])
+        return derived[name]
+
+    # ─── Probes ────────────────────────────
+    def probe(self, ssh, name, fn):
+        """Returns fn(), reusing a previous result for up to probe_ttl seconds."""
+        key = (host_key(ssh), name)
+        now = time.monotonic()
+        with self._lock:
+            cached = self._probes.get(key)
+        if cached and now - cached[0] < self.probe_ttl:
+            return cached[1]
+
+        value = fn()
+        with self._lock:
+            self._probes[key] = (now, value)
+        return value
+
+    # ─── Invalidation ──────────────────────
+    def _drop(self, key):
+        with self._lock:
+            self._files.pop(key, None)
+
+    def invalidate(self, ssh, path):
+        self._drop((host_key(ssh), path))
+
+    def invalidate_prefix(self, ssh, prefix):
+        """Drops every file entry under `prefix` and every probe about it."""
+        host = host_key(ssh)
+        with self._lock:
+            for key in [k for k in self._files if k[0] == host and k[1].startswith(prefix)]:
+                del self._files[key]
+            for key in [k for k in self._probes if k[0] == host and prefix in k[1]]:
+                del self._probes[key]
+
+
+def host_key(ssh):
+    """Identifies the VM behind `ssh` so hosts in a fleet don't share entries."""
+    pool = getattr(ssh, "pool", None)
+    if pool is not None:
+        return pool.config.get("name") or pool.config.get("remote_host")
+    return ssh.get_transport().getpeername()
+
+
+remote_cache = RemoteCache()
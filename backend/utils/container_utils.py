@@ -0,0 +1,139 @@
+# utils/container_utils.py
+import copy
+import os
+import threading
+import time
+from collections import deque
+from utils.logging_utils import log
+from utils.metrics_utils import operation
+from utils.ssh_utils import run_remote_batch
+
+COLLECT_INTERVAL = 5
+HISTORY_SECONDS = 300
+COLLECT_TIMEOUT = 30
+
+PS_CMD = (
+    "docker ps -a --filter label=com.docker.compose.service --format "
+    "'{{.ID}}\t{{.Label \"com.docker.compose.project.working_dir\"}}\t{{.Label \"com.docker.compose.project\"}}\t"
+    "{{.Label \"com.docker.compose.service\"}}\t{{.State}}\t{{.Status}}'"
+)
+STATS_CMD = "docker stats --no-stream --format '{{.ID}}\t{{.CPUPerc}}\t{{.MemUsage}}\t{{.MemPerc}}'"
+
+
+def _percent(value):
+    try:
+        return float(value.strip().rstrip("%"))
+    except ValueError:
+        return None
+
+def parse_snapshot(ps_output, stats_output):
+    """
+    Builds {(project, service): [container, ...]} from one `docker ps` and one
+    `docker stats` run. The project is the compose folder's name.
+    """
+    stats = {}
+    for line in stats_output.splitlines():
+        parts = line.split("\t")
+        if len(parts) == 4:
+            stats[parts[0]] = {"cpu_percent": _percent(parts[1]), "mem_usage": parts[2], "mem_percent": _percent(parts[3])}
+
+    containers = {}
+    for line in ps_output.splitlines():
+        parts = line.split("\t")
+        if len(parts) != 6:
+            continue
+        container_id, working_dir, project, service, state, status = parts
+        project = os.path.basename(working_dir) if working_dir else project
+        container = {"id": container_id, "state": state, "status": status}
+        container.update(stats.get(container_id, {}))
+        containers.setdefault((project, service), []).append(container)
+    return containers
+
+def summarize(containers):
+    """State of one subservice from its containers (several if it is scaled)."""
+    states = {c["state"] for c in containers}
+    cpu = [c["cpu_percent"] for c in containers if c.get("cpu_percent") is not None]
+    return {
+        "state": states.pop() if len(states) == 1 else "mixed",
+        "status": containers[0]["status"],
+        "containers": len(containers),
+        "cpu_percent": round(sum(cpu), 2) if cpu else None,
+        "mem_usage": containers[0].get("mem_usage"),
+        "mem_percent": containers[0].get("mem_percent"),
+    }
+
+
+class ContainerCollector:
+    """
+    Polls one host's containers in the background: every COLLECT_INTERVAL
+    seconds a single batched `docker ps` + `docker stats --no-stream` runs
+    and the snapshot is kept in a buffer covering the last HISTORY_SECONDS.
+    Routes read the latest snapshot instead of querying the VM themselves.
+    """
+
+    def __init__(self, host, interval=COLLECT_INTERVAL, history_seconds=HISTORY_SECONDS):
+        self.host = host
+        self.interval = interval
+        self.history_seconds = history_seconds
+        self._snapshots = deque()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name=f"containers-{host.name}", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.collect()
+            except Exception as e:
+                log.warning(f"⚠️ [{self.host.name}] Container snapshot failed: {type(e).__name__}: {e}")
+            self._stop.wait(self.interval)
+
+    def collect(self):
+        with operation("collect_containers"), self.host.pool.lease() as ssh:
+            ps, stats = run_remote_batch(ssh, [PS_CMD, STATS_CMD], timeout=COLLECT_TIMEOUT)
+        if ps["exit_code"] != 0:
+            raise Exception(ps["stderr"].strip())
+
+        snapshot = {"taken_at": time.time(), "containers": parse_snapshot(ps["stdout"], stats["stdout"])}
+        now = time.monotonic()
+        with self._lock:
+            self._snapshots.append((now, snapshot))
+            while self._snapshots and now - self._snapshots[0][0] > self.history_seconds:
+                self._snapshots.popleft()
+
+    # ─── Reads ─────────────────────────────
+    def latest(self):
+        with self._lock:
+            return self._snapshots[-1][1] if self._snapshots else None
+
+    def history(self, project, service):
+        """[(taken_at, summary), ...] of one subservice over the buffered window."""
+        with self._lock:
+            snapshots = [s for _, s in self._snapshots]
+        return [
+            {"taken_at": s["taken_at"], **summarize(s["containers"][(project, service)])}
+            for s in snapshots if (project, service) in s["containers"]
+        ]
+
+    def enrich(self, services):
+        """
+        Copies of `services` with the latest state attached to each subservice
+        as "state" (None if it has no container), plus "state_at" on each service.
+        """
+        snapshot = self.latest()
+        enriched = copy.deepcopy(services)
+        if snapshot is None:
+            return enriched
+
+        for service in enriched:
+            service["state_at"] = snapshot["taken_at"]
+            for sub in service.get("services", []):
+                containers = snapshot["containers"].get((service["name"], sub["name"]))
+                sub["state"] = summarize(containers) if containers else None
+        return enriched
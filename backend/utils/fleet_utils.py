@@ -0,0 +1,132 @@
+# utils/fleet_utils.py
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from utils.logging_utils import log
+from utils.metrics_utils import current_operation, operation
+from utils.ssh_pool import SSHConnectionPool
+from utils.registry_utils import ServiceRegistry
+
+# Keys a `hosts:` entry in config.yaml may override
+HOST_KEYS = ("name", "remote_host", "remote_port", "root_user", "vm_password")
+
+
+class HostContext:
+    """
+    One vulnbox: its own config dict (global settings plus host overrides),
+    its own service registry (also reachable as config["services"], which is
+    what the utils receive) and its own SSH connection pool.
+    """
+
+    def __init__(self, name, config, services_path=None):
+        self.name = name
+        self.config = config
+        self.services = ServiceRegistry(services_path)
+        self.config["services"] = self.services
+        self.pool = SSHConnectionPool(config)
+        # Set once the proxy tools install has finished (or wasn't needed)
+        self.dependencies_ready = threading.Event()
+        # ServiceWatcher keeping config["services"] in sync, set up at startup
+        self.watcher = None
+        # ContainerCollector with the live container state, set up at startup
+        self.collector = None
+
+
+class Fleet:
+    """
+    All the vulnboxes managed by this backend.
+    config.yaml either has a single remote_host/remote_port (one host), or a
+    `hosts:` list whose entries override the top-level connection settings.
+    """
+
+    def __init__(self, config, services_path=None):
+        self.hosts = {}
+        entries = config.get("hosts") or [{}]
+        for entry in entries:
+            unknown = set(entry) - set(HOST_KEYS)
+            if unknown:
+                log.warning(f"⚠️ Ignoring unknown host keys: {', '.join(sorted(unknown))}")
+
+            host_config = {k: v for k, v in config.items() if k != "hosts"}
+            host_config.update({k: v for k, v in entry.items() if k in HOST_KEYS})
+            name = str(host_config.get("name") or host_config["remote_host"])
+            host_config["name"] = name
+
+            if name in self.hosts:
+                raise ValueError(f"Duplicate host name in config: {name}")
+            # Same naming as path_for(): no suffix with a single host
+            path = None
+            if services_path:
+                root, ext = os.path.splitext(services_path)
+                path = services_path if len(entries) == 1 else f"{root}_{name}{ext}"
+            self.hosts[name] = HostContext(name, host_config, path)
+
+        self.primary = next(iter(self.hosts))
+
+    def __iter__(self):
+        return iter(self.hosts.values())
+
+    def __len__(self):
+        return len(self.hosts)
+
+    def get(self, name=None):
+        """Returns the named host, or the primary (first configured) host."""
+        return self.hosts.get(name or self.primary)
+
+    def file_suffix(self, host):
+        """Suffix for per-host local files; empty with a single host so paths don't change."""
+        return "" if len(self.hosts) == 1 else f"_{host.name}"
+
+    def path_for(self, host, path):
+        root, ext = os.path.splitext(path)
+        return f"{root}{self.file_suffix(host)}{ext}"
+
+    # ─── Lifecycle ─────────────────────────
+    def start(self):
+        """
+        Connects to every host in parallel. Hosts that can't be reached are
+        dropped from the fleet. Returns False if none could be reached.
+        """
+        with ThreadPoolExecutor(max_workers=len(self.hosts)) as executor:
+            started = dict(zip(self.hosts, executor.map(lambda h: h.pool.start(), self.hosts.values())))
+
+        for name, ok in started.items():
+            if not ok:
+                log.error(f"❌ Could not connect to host {name}, skipping it.")
+                del self.hosts[name]
+
+        if not self.hosts:
+            return False
+        if self.primary not in self.hosts:
+            self.primary = next(iter(self.hosts))
+        return True
+
+    def close(self):
+        for host in self:
+            host.pool.close()
+
+    # ─── Fan-out ───────────────────────────
+    def fan_out(self, fn, *args, hosts=None, **kwargs):
+        """
+        Runs fn(host, ssh, *args, **kwargs) on every host in parallel, each
+        with its own leased connection. Returns {host name: result}; a host
+        that raises gets {"success": False, "error": ...} instead.
+        """
+        targets = [self.hosts[name] for name in hosts] if hosts else list(self.hosts.values())
+        if not targets:
+            return {}
+
+        # Worker threads start with a fresh context; keep the caller's metrics label
+        label = current_operation()
+
+        def run(host):
+            try:
+                with operation(label), host.pool.lease() as ssh:
+                    return fn(host, ssh, *args, **kwargs)
+            except Exception as e:
+                log.error(f"❌ [{host.name}] {type(e).__name__}: {e}")
+                return {"success": False, "error": str(e)}
+
+        with ThreadPoolExecutor(max_workers=len(targets)) as executor:
+            results = executor.map(run, targets)
+            return dict(zip((h.name for h in targets), results))
@@ -2,7 +2,8 @@ import os
 import stat
 from pathlib import Path
 from utils.logging_utils import log
-from utils.ssh_utils import run_remote_command
+from utils.ssh_utils import run_remote_command, run_remote_batch
+from utils.metrics_utils import track_operation
 import subprocess
 DEFAULT_BRANCH = "master"
 
@@ -12,6 +13,7 @@ def remote_file_exists(ssh, path):
     result = run_remote_command(ssh, cmd).strip()
     return result == "exists"
 
+@track_operation("setup_ssh_key")
 def setup_ssh_key(ssh, config):
     local_key_path = config["local_private_key_file"]
     local_public_key = f"{local_key_path}.pub"
@@ -25,32 +27,32 @@ def setup_ssh_key(ssh, config):
     with open(local_public_key, "r") as f:
         pub_key = f.read().strip()
 
-    # Copy public key to remote authorized_keys
-    run_remote_command(ssh, "mkdir -p /root/.ssh && chmod 700 /root/.ssh")
-    
-    # Only append the key if it's not already in authorized_keys
-    check_cmd = f"grep -qxF '{pub_key}' /root/.ssh/authorized_keys || echo '{pub_key}' >> /root/.ssh/authorized_keys"
-    run_remote_command(ssh, check_cmd)
-
-    run_remote_command(ssh, "chmod 600 /root/.ssh/authorized_keys && chown -R root:root /root/.ssh")
+    # Copy public key to remote authorized_keys (only append it if it's not already there)
+    commands = [
+        "mkdir -p /root/.ssh && chmod 700 /root/.ssh",
+        f"grep -qxF '{pub_key}' /root/.ssh/authorized_keys || echo '{pub_key}' >> /root/.ssh/authorized_keys",
+        "chmod 600 /root/.ssh/authorized_keys && chown -R root:root /root/.ssh",
+        "git config --global user.name \"Root User\"",
+        "git config --global user.email \"skibidi@palleselvagge.com\"",
+        f"git config --global init.defaultBranch \"{DEFAULT_BRANCH}\"",
+    ]
+    # Add all service folders to Git's safe.directory list
+    for svc in config.get("services", []):
+        service_path = f"/root/{svc['name']}"
+        commands.append(f"git config --global --add safe.directory {service_path}")
 
     try:
-        log.info(f"🛠 Setting Git identity for 'root'...")
-        run_remote_command(ssh, "git config --global user.name \"Root User\"")
-        run_remote_command(ssh, "git config --global user.email \"skibidi@palleselvagge.com\"")
-        run_remote_command(ssh, f"git config --global init.defaultBranch \"{DEFAULT_BRANCH}\"")
-        # Add all service folders to Git's safe.directory list
-        for svc in config.get("services", []):
-            service_path = f"/root/{svc['name']}"
-            run_remote_command(ssh, f"git config --global --add safe.directory {service_path}")
+        log.info(f"🛠 Setting up SSH key and Git identity for 'root'...")
+        failed = [r for r in run_remote_batch(ssh, commands) if r["exit_code"] != 0]
+        for r in failed:
+            log.warning(f"⚠️ {r['command']}: {r['stderr'].strip()}")
     except Exception as e:
         log.error(f"❌ Failed to set Git identity: {e}")
         return
 
     log.info("✅ Git setup complete.")
 
-import tempfile
-
+@track_operation("initialize_service_repo")
 def initialize_service_repo(ssh, config, svc):
     """
     Initializes a Git repository in the specified path if one doesn't exist.
@@ -59,14 +61,14 @@ def initialize_service_repo(ssh, config, svc):
     path = "/root/" + svc["name"]
 
     try:
-        is_git_repo = run_remote_command(ssh, f"test -d {path}/.git && echo exists || echo missing").strip()
-
-        if is_git_repo == "missing":
-            log.info(f"🧱 Initializing Git repository at {path}...")
-            run_remote_command(ssh, f"git init {path}")
-
-        # Configure shared repo access
-        run_remote_command(ssh, f"cd {path} && git config core.sharedRepository group")
+        # Probe the repository state in a single round-trip
+        is_git_repo, has_gitignore, has_commits = [
+            r["exit_code"] == 0 for r in run_remote_batch(ssh, [
+                f"test -d {path}/.git",
+                f"test -f {path}/.gitignore",
+                f"cd {path} && git rev-parse --verify HEAD >/dev/null 2>&1",
+            ])
+        ]
 
         # Collect volumes to ignore
         volumes_to_ignore = []
@@ -113,41 +115,41 @@ def initialize_service_repo(ssh, config, svc):
             for volume in subservice.get("volumes", []):
                 if isinstance(volume, str):
                     host_path = volume.split(":")[0].strip()
+                    # `docker compose config` makes bind sources absolute
+                    if host_path.startswith(path.rstrip("/") + "/"):
+                        host_path = os.path.relpath(host_path, path)
                     if host_path and not host_path.startswith("/"):
                         clean_path = os.path.normpath(host_path).lstrip("./")
                         volumes_to_ignore.append(clean_path)
 
         unique_ignores = sorted(set(volumes_to_ignore))
 
-        gitignore_path = os.path.join(path, ".gitignore")
-        if not remote_file_exists(ssh, gitignore_path) and unique_ignores:
-            log.info(f"📄 Creating .gitignore at {gitignore_path}...")
-
-            # Write content to a temporary file locally
-            with tempfile.NamedTemporaryFile("w", delete=False) as tmp:
-                tmp.write("\n".join(unique_ignores) + "\n")
-                local_path = tmp.name
+        commands = []
+        if not is_git_repo:
+            log.info(f"🧱 Initializing Git repository at {path}...")
+            commands.append(f"git init {path}")
 
-            # Copy it to the remote using scp
-            sftp = ssh.open_sftp()
-            sftp.put(local_path, gitignore_path)
-            sftp.close()
+        # Configure shared repo access and git receive config
+        commands.append(f"cd {path} && git config core.sharedRepository group")
+        commands.append(f"cd {path} && git config receive.denyCurrentBranch updateInstead")
 
-        # Git receive config
-        run_remote_command(ssh, f"cd {path} && git config receive.denyCurrentBranch updateInstead")
+        gitignore_path = os.path.join(path, ".gitignore")
+        if not has_gitignore and unique_ignores:
+            log.info(f"📄 Creating .gitignore at {gitignore_path}...")
+            content = "\n".join(unique_ignores)
+            commands.append(f"cat > {gitignore_path} <<'__CANNAVARO_EOF__'\n{content}\n__CANNAVARO_EOF__")
 
         # Git commit if needed
-        has_commits = run_remote_command(
-            ssh, f"cd {path} && git rev-parse --verify HEAD >/dev/null 2>&1 && echo yes || echo no"
-        ).strip()
-
-        if has_commits == "no":
+        if not has_commits:
             log.info("📦 Staging and committing existing files...")
-            run_remote_command(ssh, f"cd {path} && git add .")
-            run_remote_command(ssh, f"cd {path} && git commit -m 'Initial commit: imported services'")
+            commands.append(f"cd {path} && git add . && git commit -m 'Initial commit: imported services'")
         else:
             log.info("✅ Initial commit already exists.")
 
+        for r in run_remote_batch(ssh, commands, stop_on_error=True):
+            if r["exit_code"] != 0:
+                raise Exception(f"{r['command']}: {r['stderr'].strip()}")
+
         log.info("✅ Git repository setup complete and ready for collaboration.")
 
     except Exception as e:
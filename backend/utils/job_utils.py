@@ -0,0 +1,202 @@
+# utils/job_utils.py
+import json
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor
+from utils.logging_utils import log
+
+DEFAULT_WORKERS = 4
+MAX_JOBS = 100
+# Events kept per job for replay; older ones (in practice build output) are dropped
+MAX_EVENTS = 5000
+KEEPALIVE_INTERVAL = 15
+
+
+class Job:
+    """
+    One background task. Its progress is a stream of events ("status",
+    "step", "output", "done"), each with an increasing id, so any number of
+    clients can follow it and resume from where they were. Only the last
+    `max_events` are kept, so late subscribers get the recent history.
+    """
+
+    def __init__(self, kind, params, max_events=MAX_EVENTS):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.params = params
+        self.status = "queued"
+        self.result = None
+        self.error = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.step_name = None
+        self.events = deque(maxlen=max_events)
+        self.last_id = 0
+        self._partial = {}
+        self._cond = threading.Condition()
+
+    # ─── Progress (called by the task) ─────
+    def emit(self, event, **data):
+        with self._cond:
+            self.last_id += 1
+            self.events.append({"id": self.last_id, "event": event, "data": data})
+            self._cond.notify_all()
+
+    def step(self, name, host=None):
+        self.step_name = name
+        self.emit("step", name=name, **({"host": host} if host else {}))
+
+    def output(self, stream, text, host=None, service=None):
+        """
+        Adds command output; it is emitted one complete line at a time, per
+        host and service, so concurrent commands don't interleave mid-line.
+        """
+        key = (host, service, stream)
+        with self._cond:
+            buffered = self._partial.get(key, "") + text
+            *lines, self._partial[key] = buffered.split("\n")
+        for line in lines:
+            self._emit_line(key, line)
+
+    def for_host(self, host):
+        """Progress reporter that tags this job's events with a host name (for fleet jobs)."""
+        return HostProgress(self, host)
+
+    def _emit_line(self, key, line):
+        host, service, stream = key
+        tags = {k: v for k, v in (("host", host), ("service", service)) if v}
+        self.emit("output", stream=stream, line=line.rstrip("\r"), **tags)
+
+    def _flush_output(self):
+        for key, rest in self._partial.items():
+            if rest:
+                self._emit_line(key, rest)
+        self._partial = {}
+
+    # ─── Reads ─────────────────────────────
+    @property
+    def done(self):
+        # Only once the "done" event is out, so followers never miss it
+        return bool(self.events) and self.events[-1]["event"] == "done"
+
+    def wait_events(self, after, timeout):
+        """
+        (missed, events): events with id > after, waiting up to `timeout` for
+        one to arrive, and how many of those were already dropped.
+        """
+        with self._cond:
+            if self.last_id <= after and not self.done:
+                self._cond.wait(timeout)
+            first = self.events[0]["id"] if self.events else self.last_id + 1
+            missed = max(0, first - after - 1)
+            return missed, list(islice(self.events, max(0, after - first + 1), None))
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "kind": self.kind,
+            "params": self.params,
+            "status": self.status,
+            "step": self.step_name,
+            "result": self.result,
+            "error": self.error,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "last_event_id": self.last_id,
+        }
+
+
+class HostProgress:
+    def __init__(self, job, host):
+        self.job = job
+        self.host = host
+
+    def step(self, name):
+        self.job.step(name, host=self.host)
+
+    def output(self, stream, text, service=None):
+        self.job.output(stream, text, host=self.host, service=service)
+
+
+class JobManager:
+    """Runs jobs on a worker pool and keeps the last MAX_JOBS of them."""
+
+    def __init__(self, max_workers=DEFAULT_WORKERS, max_jobs=MAX_JOBS):
+        self.max_jobs = max_jobs
+        self._jobs = OrderedDict()
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="job")
+
+    def submit(self, kind, fn, *args, params=None, **kwargs):
+        """
+        Queues fn(job, *args, **kwargs). Its return value becomes the job's
+        result; a result with "success": False, or an exception, fails the job.
+        """
+        job = Job(kind, params or {})
+        with self._lock:
+            self._jobs[job.id] = job
+            while len(self._jobs) > self.max_jobs:
+                oldest = next(iter(self._jobs.values()))
+                if not oldest.done:
+                    break
+                self._jobs.popitem(last=False)
+        job.emit("status", status=job.status)
+        self._executor.submit(self._run, job, fn, args, kwargs)
+        return job
+
+    def get(self, job_id):
+        return self._jobs.get(job_id)
+
+    def all(self):
+        with self._lock:
+            return list(self._jobs.values())
+
+    def _run(self, job, fn, args, kwargs):
+        job.status = "running"
+        job.started_at = time.time()
+        job.emit("status", status=job.status)
+        try:
+            result = fn(job, *args, **kwargs)
+            job.result = result
+            if isinstance(result, dict) and result.get("success") is False:
+                job.status, job.error = "failed", result.get("error")
+            else:
+                job.status = "succeeded"
+        except Exception as e:
+            log.error(f"❌ Job {job.kind} ({job.id}) failed: {type(e).__name__}: {e}")
+            job.status, job.error = "failed", str(e)
+
+        job._flush_output()
+        job.finished_at = time.time()
+        job.emit("done", status=job.status, result=job.result, error=job.error)
+
+
+def sse_stream(job, last_event_id=0):
+    """
+    Yields a job's events as Server-Sent Events until it is done. If some
+    were dropped from the replay buffer, a "truncated" event says how many.
+    """
+    after = last_event_id
+    while True:
+        missed, events = job.wait_events(after, KEEPALIVE_INTERVAL)
+        if missed:
+            yield f"event: truncated\ndata: {json.dumps({'missed': missed})}\n\n"
+        if not events and job.done:
+            return
+        if not events:
+            # Comment line: keeps proxies from closing an idle connection
+            yield ": keepalive\n\n"
+            continue
+        for event in events:
+            after = event["id"]
+            yield f"id: {event['id']}\nevent: {event['event']}\ndata: {json.dumps(event['data'])}\n\n"
+            if event["event"] == "done":
+                return
+
+
+jobs = JobManager()
@@ -0,0 +1,158 @@
+# utils/metrics_utils.py
+import contextvars
+import functools
+import threading
+from contextlib import contextmanager
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# ─── Operation labels ──────────────────────
+_operation = contextvars.ContextVar("operation", default="unknown")
+
+def current_operation():
+    return _operation.get()
+
+@contextmanager
+def operation(name):
+    """Labels every remote call made inside the block with `name`."""
+    token = _operation.set(name)
+    try:
+        yield
+    finally:
+        _operation.reset(token)
+
+def track_operation(name):
+    """Decorator form of operation()."""
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with operation(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def set_operation(name):
+    return _operation.set(name)
+
+def reset_operation(token):
+    _operation.reset(token)
+
+
+# ─── Metric types ──────────────────────────
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _format_labels(labelnames, values, extra=None):
+    pairs = list(zip(labelnames, values)) + (extra or [])
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in pairs) + "}"
+
+
+class Counter:
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels.get(n, "")) for n in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {value}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels.get(n, "")) for n in self.labelnames)
+        with self._lock:
+            series = self._series.setdefault(key, {"counts": [0] * len(self.buckets), "sum": 0.0, "count": 0})
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series["counts"][i] += 1
+            series["sum"] += value
+            series["count"] += 1
+
+    def counts(self):
+        """{label values: number of observations}."""
+        with self._lock:
+            return {key: series["count"] for key, series in self._series.items()}
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, series in sorted(self._series.items()):
+                for bound, count in zip(self.buckets, series["counts"]):
+                    labels = _format_labels(self.labelnames, key, [("le", bound)])
+                    lines.append(f"{self.name}_bucket{labels} {count}")
+                labels = _format_labels(self.labelnames, key, [("le", "+Inf")])
+                lines.append(f"{self.name}_bucket{labels} {series['count']}")
+                labels = _format_labels(self.labelnames, key)
+                lines.append(f"{self.name}_sum{labels} {series['sum']}")
+                lines.append(f"{self.name}_count{labels} {series['count']}")
+        return lines
+
+
+# ─── Metrics ───────────────────────────────
+REMOTE_CALL_SECONDS = Histogram(
+    "cannavaro_remote_call_seconds",
+    "Wall-clock time of remote calls to the VM.",
+    ("operation", "kind", "status"),
+)
+REMOTE_CALL_BYTES = Counter(
+    "cannavaro_remote_call_bytes_total",
+    "Bytes transferred by remote calls.",
+    ("operation", "kind", "direction"),
+)
+REMOTE_COMMAND_EXITS = Counter(
+    "cannavaro_remote_command_exit_total",
+    "Exit statuses of remote commands.",
+    ("operation", "exit_code"),
+)
+HTTP_REQUEST_SECONDS = Histogram(
+    "cannavaro_http_request_seconds",
+    "Latency of backend API requests.",
+    ("method", "route", "status"),
+)
+
+REGISTRY = [REMOTE_CALL_SECONDS, REMOTE_CALL_BYTES, REMOTE_COMMAND_EXITS, HTTP_REQUEST_SECONDS]
+
+def record_remote_call(operation_name, kind, seconds, status, bytes_in=0, bytes_out=0, exit_code=None):
+    operation_name = operation_name or "unknown"
+    REMOTE_CALL_SECONDS.observe(seconds, operation=operation_name, kind=kind, status=status)
+    if bytes_in:
+        REMOTE_CALL_BYTES.inc(bytes_in, operation=operation_name, kind=kind, direction="in")
+    if bytes_out:
+        REMOTE_CALL_BYTES.inc(bytes_out, operation=operation_name, kind=kind, direction="out")
+    if exit_code is not None:
+        REMOTE_COMMAND_EXITS.inc(operation=operation_name, exit_code=exit_code)
+
+def remote_call_counts():
+    """{operation: number of remote calls so far}, e.g. to count round trips."""
+    counts = {}
+    for (operation_name, _kind, _status), count in REMOTE_CALL_SECONDS.counts().items():
+        counts[operation_name] = counts.get(operation_name, 0) + count
+    return counts
+
+def render_metrics():
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
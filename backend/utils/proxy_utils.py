@@ -6,18 +6,21 @@ import re
 import tempfile
 import os
 import socket
-from utils.ssh_utils import run_remote_command
-from utils.services_utils import rolling_restart_docker_service
+from utils.ssh_utils import run_remote_command, run_remote_batch, exec_remote, sftp_session
+from utils.services_utils import rolling_restart_docker_service, parse_port_mapping, format_port_mapping
+from utils.agent_utils import read_remote_file, write_remote_file
+from utils.cache_utils import remote_cache
 from utils.logging_utils import log
+from utils.metrics_utils import track_operation
 from jinja2 import Template
 
 # ----- HELPER FUNCTIONS -----
 def find_compose_file(ssh, service_path):
     possible_names = ["docker-compose.yml", "docker-compose.yaml", "compose.yml", "compose.yaml"]
-    for name in possible_names:
-        full_path = f"{service_path}/{name}"
-        stdin, stdout, stderr = ssh.exec_command(f"test -f {full_path} && echo exists || echo missing")
-        if stdout.read().decode().strip() == "exists":
+    candidates = [f"{service_path}/{name}" for name in possible_names]
+    results = run_remote_batch(ssh, [f"test -f {path}" for path in candidates])
+    for full_path, result in zip(candidates, results):
+        if result["exit_code"] == 0:
             return full_path
     return None
 
@@ -33,15 +36,19 @@ def render_jinja_proxy_script(service_name, from_port, to_port, target_ip, templ
         SSL_ENABLED= ssl_state
     )
 
+@track_operation("is_proxy_installed")
 def is_proxy_installed(ssh, service_name):
     """
     Checks if the proxy file for the given service already exists on the VM.
     """
     remote_path = f"/root/{service_name}/proxy_folder_{service_name}"
-    stdin, stdout, stderr = ssh.exec_command(f"test -d {remote_path} && echo exists || echo missing")
-    output = stdout.read().decode().strip()
-    log.info(f"Proxy check for {service_name}: {output}")
-    return output == "exists"
+
+    def check():
+        output = exec_remote(ssh, f"test -d {remote_path} && echo exists || echo missing")["stdout"].strip()
+        log.info(f"Proxy check for {service_name}: {output}")
+        return output == "exists"
+
+    return remote_cache.probe(ssh, f"proxy_installed:{remote_path}", check)
 
 def create_start_script(sftp, script_path, screen_name, log_file, command_body):
     """
@@ -62,6 +69,7 @@ def create_start_script(sftp, script_path, screen_name, log_file, command_body):
     os.remove(tmp_local_path)
 
 # ----- MAIN FUNCTIONS -----
+@track_operation("install_proxy_for_service")
 def install_proxy_for_service(ssh, config, parent, subservice, proxy_config):
     try:
         service_path = f"/root/{parent}"
@@ -70,9 +78,10 @@ def install_proxy_for_service(ssh, config, parent, subservice, proxy_config):
             return {"success": False, "error": "Compose file not found in service directory."}
 
         backup_path = f"{compose_path}.bak"
-        run_remote_command(ssh, f"cp {compose_path} {backup_path}")
-        raw_yaml = run_remote_command(ssh, f"cat {compose_path}")
-        compose_data = yaml.safe_load(raw_yaml)
+        backup, read = run_remote_batch(ssh, [f"cp {compose_path} {backup_path}", f"cat {compose_path}"])
+        if backup["exit_code"] != 0:
+            log.warning(f"⚠️ {backup['stderr'].strip()}")
+        compose_data = yaml.safe_load(read["stdout"])
 
         service_def = compose_data['services'][subservice]
         ports = service_def.get("ports", [])
@@ -83,42 +92,41 @@ def install_proxy_for_service(ssh, config, parent, subservice, proxy_config):
         original_port = None
         adjusted_port = None
 
+        mappings = [parse_port_mapping(port) for port in ports]
+        for port, mapping in zip(ports, mappings):
+            if not mapping or mapping["range"]:
+                return {"success": False, "error": f"Unrecognized port format: '{port}'"}
+
         if proxy_config.get("port"):
             original_port = int(proxy_config["port"])
             adjusted_port = original_port
-            container_port = int(ports[0].split(":")[-1])
-            updated_ports = [f"127.0.0.1:{original_port}:{container_port}"]
+            first = mappings[0]
+            updated_ports = [format_port_mapping(ports[0], "127.0.0.1", original_port, first["target"], first["protocol"])]
         else:
-            for port in ports:
-                parts = str(port).split(":")
-                if len(parts) == 2:
-                    host_port, container_port = map(int, parts)
-                elif len(parts) == 3:
-                    host_port = int(parts[1])
-                    container_port = int(parts[2])
-                else:
-                    return {"success": False, "error": f"Unrecognized port format: '{port}'"}
-                original_port = host_port
-                adjusted_port = host_port + 6
-                updated_ports.append(f"127.0.0.1:{adjusted_port}:{container_port}")
+            for port, mapping in zip(ports, mappings):
+                if mapping["published"] is None:
+                    return {"success": False, "error": f"Port '{port}' is not published on the host"}
+                original_port = mapping["published"]
+                adjusted_port = original_port + 6
+                updated_ports.append(
+                    format_port_mapping(port, "127.0.0.1", adjusted_port, mapping["target"], mapping["protocol"])
+                )
 
         service_def["ports"] = updated_ports
 
-        port_check_cmd = f"ss -tuln | grep ':{adjusted_port} ' || true"
-        port_check_result = run_remote_command(ssh, port_check_cmd).strip()
+        port_check_result = run_remote_command(ssh, f"ss -tuln | grep ':{adjusted_port} ' || true").strip()
         if port_check_result:
             return {"success": False, "error": f"Port {adjusted_port} is already in use on the remote host."}
 
+        # Write the new compose file and commit it in one round-trip
         new_yaml = yaml.dump(compose_data)
-        escaped = new_yaml.replace("'", "'\\''")
-        run_remote_command(ssh, f"echo '{escaped}' > {compose_path}")
-
         commit_msg = f"Install proxy: moved ports for subservice {subservice}"
-        run_remote_command(ssh, f"""
-            cd {service_path} && \
-            git add {os.path.basename(compose_path)} && \
-            git commit -m '{commit_msg}'
-        """)
+        write = run_remote_batch(ssh, [
+            f"cat > {compose_path} <<'__CANNAVARO_EOF__'\n{new_yaml}__CANNAVARO_EOF__",
+            f"cd {service_path} && git add {os.path.basename(compose_path)} && git commit -m '{commit_msg}'",
+        ], stop_on_error=True)[0]
+        if write["exit_code"] != 0:
+            raise Exception(f"Failed to write compose file: {write['stderr'].strip()}")
 
         if proxy_config.get("proxy_type") == "AngelPit":
             log.info("Installing AngelPit proxy")
@@ -159,6 +167,9 @@ def install_proxy_for_service(ssh, config, parent, subservice, proxy_config):
     except Exception as e:
         run_remote_command(ssh, f"mv {backup_path} {compose_path}")
         return {"success": False, "error": f"Failed to install proxy: {e}"}
+    finally:
+        # Files and probes about this service are stale now, whatever happened
+        remote_cache.invalidate_prefix(ssh, f"/root/{parent}/")
 
 # ----- PROXY TYPES -----
 def render_template_file(template_path, replacements):
@@ -176,58 +187,57 @@ def install_angel_pit_proxy(ssh, config, proxy_config, service_path, parent, sub
 
     remote_proxy_dir = f"{service_path}/proxy_folder_{parent}"
     run_remote_command(ssh, f"mkdir -p {remote_proxy_dir}")
-    sftp = ssh.open_sftp()
-
-    for filename in os.listdir(local_proxy_dir):
-        local_path = os.path.join(local_proxy_dir, filename)
-        remote_path = posixpath.join(remote_proxy_dir, filename)
-        sftp.put(local_path, remote_path)
-
-    # 🔐 Handle TLS
-    if proxy_config.get("tls_enabled"):
-        cert_path = proxy_config.get("server_cert")
-        key_path = proxy_config.get("server_key")
-        combined_remote_path = posixpath.join(remote_proxy_dir, "combined.pem")
-        run_remote_command(ssh, f"cat {cert_path} {key_path} > {combined_remote_path}")
-
-    # 🔄 Proxy Launch Script
-    protocol = proxy_config["protocol"]
-    if proxy_config.get("tls_enabled"):
-        protocol = {"http": "https", "tcp": "tls"}.get(protocol, protocol)
-
-    address = "host.docker.internal" if config["remote_host"] == "host.docker.internal" else "127.0.0.1"
-
-    mitm_command = [
-        # "SSLKEYLOGFILE=mitmkeys.log mitmdump",
-        f"mitmdump --mode reverse:{protocol}://{address}:{adjusted_port}",
-        f"--listen-port {original_port}",
-        '--certs "*=combined.pem"' if proxy_config.get("tls_enabled") else "",
-        "--quiet",
-        "--ssl-insecure",
-        "--set block_global=false",
-        "-s angel_pit_proxy.py"
-    ]
-
-    if proxy_config.get("dump_pcaps"):
-        mitm_command.append("-s angel_dumper.py")
-        mitm_command.append(f"--set pcap_path={proxy_config.get('pcap_path', 'pcaps')}")
-        mitm_command.append(f"--set service_name={parent}")
-
-    launch_remote_path = posixpath.join(remote_proxy_dir, "angelpit_command.sh")
-    mitm_cmd_str = " \\\n  ".join(filter(None, mitm_command))
-    with tempfile.NamedTemporaryFile("w", delete=False) as mitm_file:
-        mitm_file.write("#!/bin/bash\n\n" + mitm_cmd_str + "\n")
-        mitm_file_path = mitm_file.name
-    sftp.put(mitm_file_path, launch_remote_path)
-    sftp.chmod(launch_remote_path, 0o755)
-    os.remove(mitm_file_path)
-
-    # Start script generation
-    start_script_path = posixpath.join(remote_proxy_dir, "start_proxy.sh")
-    screen_name = f"proxy_{parent}"
-    log_file = f"{remote_proxy_dir}/log_{screen_name}.txt"
-    command_body = f"cd {remote_proxy_dir} && bash {os.path.basename(launch_remote_path)}"
-    create_start_script(sftp, start_script_path, screen_name, log_file, command_body)
+    with sftp_session(ssh) as sftp:
+        for filename in os.listdir(local_proxy_dir):
+            local_path = os.path.join(local_proxy_dir, filename)
+            remote_path = posixpath.join(remote_proxy_dir, filename)
+            sftp.put(local_path, remote_path)
+
+        # 🔐 Handle TLS
+        if proxy_config.get("tls_enabled"):
+            cert_path = proxy_config.get("server_cert")
+            key_path = proxy_config.get("server_key")
+            combined_remote_path = posixpath.join(remote_proxy_dir, "combined.pem")
+            run_remote_command(ssh, f"cat {cert_path} {key_path} > {combined_remote_path}")
+
+        # 🔄 Proxy Launch Script
+        protocol = proxy_config["protocol"]
+        if proxy_config.get("tls_enabled"):
+            protocol = {"http": "https", "tcp": "tls"}.get(protocol, protocol)
+
+        address = "host.docker.internal" if config["remote_host"] == "host.docker.internal" else "127.0.0.1"
+
+        mitm_command = [
+            # "SSLKEYLOGFILE=mitmkeys.log mitmdump",
+            f"mitmdump --mode reverse:{protocol}://{address}:{adjusted_port}",
+            f"--listen-port {original_port}",
+            '--certs "*=combined.pem"' if proxy_config.get("tls_enabled") else "",
+            "--quiet",
+            "--ssl-insecure",
+            "--set block_global=false",
+            "-s angel_pit_proxy.py"
+        ]
+
+        if proxy_config.get("dump_pcaps"):
+            mitm_command.append("-s angel_dumper.py")
+            mitm_command.append(f"--set pcap_path={proxy_config.get('pcap_path', 'pcaps')}")
+            mitm_command.append(f"--set service_name={parent}")
+
+        launch_remote_path = posixpath.join(remote_proxy_dir, "angelpit_command.sh")
+        mitm_cmd_str = " \\\n  ".join(filter(None, mitm_command))
+        with tempfile.NamedTemporaryFile("w", delete=False) as mitm_file:
+            mitm_file.write("#!/bin/bash\n\n" + mitm_cmd_str + "\n")
+            mitm_file_path = mitm_file.name
+        sftp.put(mitm_file_path, launch_remote_path)
+        sftp.chmod(launch_remote_path, 0o755)
+        os.remove(mitm_file_path)
+
+        # Start script generation
+        start_script_path = posixpath.join(remote_proxy_dir, "start_proxy.sh")
+        screen_name = f"proxy_{parent}"
+        log_file = f"{remote_proxy_dir}/log_{screen_name}.txt"
+        command_body = f"cd {remote_proxy_dir} && bash {os.path.basename(launch_remote_path)}"
+        create_start_script(sftp, start_script_path, screen_name, log_file, command_body)
 
     # 🔁 Restart docker subservice
     rolling_restart_docker_service(ssh, service_path, [subservice])
@@ -245,7 +255,6 @@ def install_mini_proxad(ssh, config, proxy_config, service_path, parent, subserv
 
     remote_proxy_dir = f"{service_path}/proxy_folder_{parent}"
     run_remote_command(ssh, f"mkdir -p {remote_proxy_dir}")
-    sftp = ssh.open_sftp()
 
     if config["remote_host"] == "host.docker.internal":
         address = socket.gethostbyname("host.docker.internal")
@@ -265,56 +274,56 @@ def install_mini_proxad(ssh, config, proxy_config, service_path, parent, subserv
         "HTTP_ENABLED": str(proxy_config.get("protocol", False)).lower()== "http",
     }
 
-    for filename in os.listdir(local_proxy_dir):
-        # Handle special case for proxy_filters.py
-        if filename == "proxy_filters.py" or filename == "proxy_filters_http.py":
-            if replacements["HTTP_ENABLED"] and filename == "proxy_filters_http.py":
-                # Upload as proxy_filters.py
-                local_path = os.path.join(local_proxy_dir, filename)
-                remote_path = posixpath.join(remote_proxy_dir, "proxy_filters.py")
-                sftp.put(local_path, remote_path)
-            elif not replacements["HTTP_ENABLED"] and filename == "proxy_filters.py":
-                # Upload as-is
-                local_path = os.path.join(local_proxy_dir, filename)
-                remote_path = posixpath.join(remote_proxy_dir, filename)
+    with sftp_session(ssh) as sftp:
+        for filename in os.listdir(local_proxy_dir):
+            # Handle special case for proxy_filters.py
+            if filename == "proxy_filters.py" or filename == "proxy_filters_http.py":
+                if replacements["HTTP_ENABLED"] and filename == "proxy_filters_http.py":
+                    # Upload as proxy_filters.py
+                    local_path = os.path.join(local_proxy_dir, filename)
+                    remote_path = posixpath.join(remote_proxy_dir, "proxy_filters.py")
+                    sftp.put(local_path, remote_path)
+                elif not replacements["HTTP_ENABLED"] and filename == "proxy_filters.py":
+                    # Upload as-is
+                    local_path = os.path.join(local_proxy_dir, filename)
+                    remote_path = posixpath.join(remote_proxy_dir, filename)
+                    sftp.put(local_path, remote_path)
+                continue
+
+            local_path = os.path.join(local_proxy_dir, filename)
+            remote_path = posixpath.join(remote_proxy_dir, filename)
+
+            if filename.endswith(".yaml") or filename.endswith(".yml"):
+                rendered = render_template_file(local_path, replacements)
+                with sftp.open(remote_path, 'w') as f:
+                    f.write(rendered)
+            else:
                 sftp.put(local_path, remote_path)
-            continue
-
-        local_path = os.path.join(local_proxy_dir, filename)
-        remote_path = posixpath.join(remote_proxy_dir, filename)
-
-        if filename.endswith(".yaml") or filename.endswith(".yml"):
-            rendered = render_template_file(local_path, replacements)
-            with sftp.open(remote_path, 'w') as f:
-                f.write(rendered)
-        else:
-            sftp.put(local_path, remote_path)
 
-    # 🔐 TLS: concatenate cert + key if enabled
-    if proxy_config.get("tls_enabled"):
-        cert_path = proxy_config.get("server_cert")
-        key_path = proxy_config.get("server_key")
-        combined_remote_path = posixpath.join(remote_proxy_dir, "combined.pem")
-        run_remote_command(ssh, f"cat {cert_path} {key_path} > {combined_remote_path}")
+        # 🔐 TLS: concatenate cert + key if enabled
+        if proxy_config.get("tls_enabled"):
+            cert_path = proxy_config.get("server_cert")
+            key_path = proxy_config.get("server_key")
+            combined_remote_path = posixpath.join(remote_proxy_dir, "combined.pem")
+            run_remote_command(ssh, f"cat {cert_path} {key_path} > {combined_remote_path}")
+
+        # ⏯️ Launch Mini-Proxad via screen
+        screen_name = f"proxy_{parent}"
+        log_file = f"{remote_proxy_dir}/log_{screen_name}.txt"
+        start_script_path = posixpath.join(remote_proxy_dir, "start_proxy.sh")
+        command_body = (
+            f"chmod +x {remote_proxy_dir}/mini-proxad.bin && "
+            f"{remote_proxy_dir}/mini-proxad.bin --config {remote_proxy_dir}/config.yaml"
+        )
+        create_start_script(sftp, start_script_path, screen_name, log_file, command_body)
 
     # 🔁 Restart subservice container to ensure the proxy can bind to the target port
     rolling_restart_docker_service(ssh, service_path, [subservice])
 
-    # ⏯️ Launch Mini-Proxad via screen
-    screen_name = f"proxy_{parent}"
-    log_file = f"{remote_proxy_dir}/log_{screen_name}.txt"
-    start_script_path = posixpath.join(remote_proxy_dir, "start_proxy.sh")
-    command_body = (
-        f"chmod +x {remote_proxy_dir}/mini-proxad.bin && "
-        f"{remote_proxy_dir}/mini-proxad.bin --config {remote_proxy_dir}/config.yaml"
-    )
-    create_start_script(sftp, start_script_path, screen_name, log_file, command_body)
-
     # Launch the start script
     run_remote_command(ssh, f"bash {start_script_path}", raise_on_error=True)
 
 
-    sftp.close()
     return {"success": True}
 
 def install_demon_hill_proxy(ssh, config, proxy_config, service_path, parent, subservice, adjusted_port, original_port):
@@ -324,7 +333,6 @@ def install_demon_hill_proxy(ssh, config, proxy_config, service_path, parent, su
 
     remote_proxy_dir = f"{service_path}/proxy_folder_{parent}"
     run_remote_command(ssh, f"mkdir -p {remote_proxy_dir}")
-    sftp = ssh.open_sftp()
 
     if config["remote_host"] == "host.docker.internal":
         address = socket.gethostbyname("host.docker.internal")
@@ -337,34 +345,35 @@ def install_demon_hill_proxy(ssh, config, proxy_config, service_path, parent, su
         "TARGET_IP": address
     }
 
-    for filename in os.listdir(local_proxy_dir):
-        local_path = os.path.join(local_proxy_dir, filename)
-        remote_path = posixpath.join(remote_proxy_dir, filename)
-        rendered = render_template_file(local_path, replacements)
-        with sftp.open(remote_path, 'w') as f:
-            f.write(rendered)
+    with sftp_session(ssh) as sftp:
+        for filename in os.listdir(local_proxy_dir):
+            local_path = os.path.join(local_proxy_dir, filename)
+            remote_path = posixpath.join(remote_proxy_dir, filename)
+            rendered = render_template_file(local_path, replacements)
+            with sftp.open(remote_path, 'w') as f:
+                f.write(rendered)
+
+        # ⏯️ Launch DemonHill via screen
+        screen_name = f"proxy_{parent}"
+        log_file = f"{remote_proxy_dir}/log_{screen_name}.txt"
+        start_script_path = posixpath.join(remote_proxy_dir, "start_proxy.sh")
+        command_body = (
+            f"python3 {remote_proxy_dir}/proxy_filters.py"
+        )
+        create_start_script(sftp, start_script_path, screen_name, log_file, command_body)
 
     # 🔁 Restart subservice container to ensure the proxy can bind to the target port
     rolling_restart_docker_service(ssh, service_path, [subservice])
 
-    # ⏯️ Launch DemonHill via screen
-    screen_name = f"proxy_{parent}"
-    log_file = f"{remote_proxy_dir}/log_{screen_name}.txt"
-    start_script_path = posixpath.join(remote_proxy_dir, "start_proxy.sh")
-    command_body = (
-        f"python3 {remote_proxy_dir}/proxy_filters.py"
-    )
-    create_start_script(sftp, start_script_path, screen_name, log_file, command_body)
-
     # Launch the start script
     run_remote_command(ssh, f"bash {start_script_path}", raise_on_error=True)
 
 
-    sftp.close()
     return {"success": True}
 
 # ----- COMMON FUNCTIONS -----
 
+@track_operation("get_logs")
 def get_logs(ssh, service_name):
     log_path = f"/root/{service_name}/proxy_folder_{service_name}/log_proxy_{service_name}.txt"
     tmp_path = f"/root/{service_name}/proxy_folder_{service_name}/log_tmp.txt"
@@ -380,13 +389,13 @@ def get_logs(ssh, service_name):
         fi
         tail -n 2000 "{log_path}"
         """
-        stdin, stdout, stderr = ssh.exec_command(cmd)
-        logs = stdout.read().decode()
+        logs = exec_remote(ssh, cmd)["stdout"]
 
         return {"success": True, "logs": logs}
     except Exception as e:
         return {"success": False, "error": str(e)}
 
+@track_operation("get_code")
 def get_code(ssh, service_name):
     """
     Retrieve the full contents of the proxy_filters.py file for editing.
@@ -394,17 +403,12 @@ def get_code(ssh, service_name):
     code_path = f"/root/{service_name}/proxy_folder_{service_name}/proxy_filters.py"
 
     try:
-        stdin, stdout, stderr = ssh.exec_command(f"cat {code_path}")
-        code = stdout.read().decode()
-        err = stderr.read().decode()
-
-        if err.strip():
-            return {"success": False, "error": err.strip()}
-
+        code = remote_cache.read(ssh, code_path)
         return {"success": True, "code": code}
     except Exception as e:
         return {"success": False, "error": str(e)}
 
+@track_operation("save_code")
 def save_code(ssh, service_name, new_code):
     """
     Overwrite the proxy_filters.py file with new content.
@@ -418,17 +422,9 @@ def save_code(ssh, service_name, new_code):
         except SyntaxError as e:
             return {"success": False, "error": f"Syntax error in updated code: {e}"}
 
-        # Write to temp file
-        with tempfile.NamedTemporaryFile("w", delete=False) as tmp:
-            tmp.write(new_code)
-            tmp_path = tmp.name
-
         # Upload to remote
-        sftp = ssh.open_sftp()
-        sftp.put(tmp_path, code_path)
-        sftp.chmod(code_path, 0o755)
-        sftp.close()
-        os.remove(tmp_path)
+        write_remote_file(ssh, code_path, new_code, mode=0o755)
+        remote_cache.invalidate(ssh, code_path)
 
         # Git commit
         commit_msg = "Update proxy_filters.py"
@@ -442,38 +438,41 @@ def save_code(ssh, service_name, new_code):
     except Exception as e:
         return {"success": False, "error": str(e)}
 
-def get_regex(ssh, service_name):
-    regex_path = f"/root/{service_name}/proxy_folder_{service_name}/proxy_filters.py"
+def parse_regexes(code):
+    # Parse the full file into AST
+    tree = ast.parse(code)
 
-    try:
-        stdin, stdout, stderr = ssh.exec_command(f"cat {regex_path}")
-        code = stdout.read().decode()
+    regex_values = []
 
-        # Parse the full file into AST
-        tree = ast.parse(code)
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Assign):
+            for target in node.targets:
+                if isinstance(target, ast.Name) and target.id == "ALL_REGEXES":
+                    if isinstance(node.value, ast.List):
+                        for elt in node.value.elts:
+                            if isinstance(elt, ast.Bytes):
+                                regex_values.append(elt.s.decode("utf-8"))
 
-        regex_values = []
+    return regex_values
 
-        for node in ast.walk(tree):
-            if isinstance(node, ast.Assign):
-                for target in node.targets:
-                    if isinstance(target, ast.Name) and target.id == "ALL_REGEXES":
-                        if isinstance(node.value, ast.List):
-                            for elt in node.value.elts:
-                                if isinstance(elt, ast.Bytes):
-                                    regex_values.append(elt.s.decode("utf-8"))
+@track_operation("get_regex")
+def get_regex(ssh, service_name):
+    regex_path = f"/root/{service_name}/proxy_folder_{service_name}/proxy_filters.py"
 
-        return {"success": True, "regex": regex_values}
+    try:
+        # Parsed once per version of the file
+        regex_values = remote_cache.derive(ssh, regex_path, "regex", parse_regexes)
+        return {"success": True, "regex": list(regex_values)}
     except Exception as e:
         return {"success": False, "error": str(e)}
 
+@track_operation("save_regex")
 def save_regex(ssh, service_name, new_regex_list):
     code_path = f"/root/{service_name}/proxy_folder_{service_name}/proxy_filters.py"
 
     try:
-        # Read existing code
-        stdin, stdout, stderr = ssh.exec_command(f"cat {code_path}")
-        code = stdout.read().decode()
+        # Read existing code, fresh: a cached copy could drop an edit made in the meantime
+        code = read_remote_file(ssh, code_path)
 
         # Build new ALL_REGEXES string
         formatted_items = [f"    {repr(r.encode())}" for r in new_regex_list]
@@ -495,16 +494,9 @@ def save_regex(ssh, service_name, new_regex_list):
                 "error": f"Syntax error in code: {e}"
             }
 
-        # Write to temp file and upload
-        with tempfile.NamedTemporaryFile("w", delete=False) as tmp:
-            tmp.write(new_code)
-            tmp_path = tmp.name
-
-        sftp = ssh.open_sftp()
-        sftp.put(tmp_path, code_path)
-        sftp.chmod(code_path, 0o755)
-        sftp.close()
-        os.remove(tmp_path)
+        # Upload to remote
+        write_remote_file(ssh, code_path, new_code, mode=0o755)
+        remote_cache.invalidate(ssh, code_path)
 
         # Git commit
         commit_msg = "Update ALL_REGEXES"
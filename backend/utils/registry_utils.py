@@ -0,0 +1,173 @@
+# utils/registry_utils.py
+import threading
+from contextlib import ExitStack, contextmanager
+from utils.logging_utils import log
+from utils.services_utils import save_services_to_yaml
+
+PERSIST_DELAY = 1.0
+
+
+class ServiceRegistry:
+    """
+    The services of one host, indexed by name.
+
+    Entries are replaced, never modified in place: update() works on a copy
+    and swaps it in, so readers can use whatever they got without locking.
+    Writers to the same service are serialized by a per-service lock; the
+    index is guarded by one registry lock held only for the swap.
+
+    Every change bumps `version` (used for ETags) and schedules a debounced,
+    atomic write of services.yaml.
+    """
+
+    def __init__(self, path=None, persist_delay=PERSIST_DELAY):
+        self.path = path
+        self.persist_delay = persist_delay
+        self.version = 0
+        self._services = {}
+        self._lock = threading.RLock()
+        self._service_locks = {}
+        self._timer = None
+        self._dirty = False
+
+    # ─── Reads ─────────────────────────────
+    def __iter__(self):
+        return iter(self.all())
+
+    def __len__(self):
+        return len(self._services)
+
+    def all(self):
+        with self._lock:
+            return list(self._services.values())
+
+    def get(self, name):
+        return self._services.get(name)
+
+    def snapshot(self):
+        """(version, services) taken atomically."""
+        with self._lock:
+            return self.version, list(self._services.values())
+
+    def etag(self, *extra):
+        """Unquoted entity tag for the current version, to be sent as a weak ETag."""
+        return "-".join(str(v) for v in (self.version, *extra))
+
+    # ─── Writes ────────────────────────────
+    def replace_all(self, services, persist=True, keep_locks=False):
+        """
+        Swaps in a new set of services. With `keep_locks`, subservices that
+        are already known keep the lock state they have at swap time, so
+        locks toggled while `services` was being built aren't lost.
+        """
+        with ExitStack() as stack:
+            for name in sorted(set(self._services) | {s["name"] for s in services}):
+                stack.enter_context(self._service_lock(name))
+            with self._lock:
+                if keep_locks:
+                    services = [self._with_current_locks(s) for s in services]
+                self._services = {s["name"]: s for s in services}
+                self._changed(persist)
+
+    def upsert(self, service):
+        with self._service_lock(service["name"]), self._lock:
+            self._services[service["name"]] = service
+            self._changed()
+
+    def remove(self, name):
+        with self._service_lock(name), self._lock:
+            if self._services.pop(name, None) is None:
+                return False
+            self._changed()
+            return True
+
+    def merge(self, name, fn):
+        """
+        Replaces a service with fn(current entry or None), holding its lock
+        so nothing changes it in between. If fn returns None nothing is
+        stored. Returns what fn returned.
+        """
+        with self._service_lock(name):
+            merged = fn(self._services.get(name))
+            if merged is not None:
+                with self._lock:
+                    self._services[name] = merged
+                    self._changed()
+            return merged
+
+    def update(self, name, **fields):
+        """Sets top-level fields of a service. Returns the new entry, or None if unknown."""
+        with self._service_lock(name):
+            current = self._services.get(name)
+            if current is None:
+                return None
+            updated = dict(current, **fields)
+            with self._lock:
+                self._services[name] = updated
+                self._changed()
+            return updated
+
+    def set_locked(self, name, sub, locked):
+        """
+        Locks or unlocks a subservice. Returns the names of the locked
+        subservices, or raises KeyError if the service or subservice is unknown.
+        """
+        with self._service_lock(name):
+            current = self._services.get(name)
+            if current is None:
+                raise KeyError(name)
+            subservices = [dict(s) for s in current.get("services", [])]
+            target = next((s for s in subservices if s["name"] == sub), None)
+            if target is None:
+                raise KeyError(sub)
+            target["locked"] = bool(locked)
+
+            with self._lock:
+                self._services[name] = dict(current, services=subservices)
+                self._changed()
+        return [s["name"] for s in subservices if s.get("locked")]
+
+    # ─── Persistence ───────────────────────
+    def flush(self):
+        """Writes pending changes now (e.g. at shutdown)."""
+        with self._lock:
+            if self._timer:
+                self._timer.cancel()
+                self._timer = None
+            if not self._dirty or not self.path:
+                return
+            services = list(self._services.values())
+            self._dirty = False
+        try:
+            save_services_to_yaml(services, self.path)
+        except Exception as e:
+            log.error(f"❌ Failed to save {self.path}: {e}")
+
+    # ─── Internals ─────────────────────────
+    @contextmanager
+    def _service_lock(self, name):
+        with self._lock:
+            lock = self._service_locks.setdefault(name, threading.Lock())
+        with lock:
+            yield
+
+    def _changed(self, persist=True):
+        # Called with self._lock held
+        self.version += 1
+        if persist:
+            self._dirty = True
+            if self._timer is None:
+                self._timer = threading.Timer(self.persist_delay, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def _with_current_locks(self, service):
+        current = self._services.get(service["name"])
+        if current is None:
+            return service
+        locked = {s["name"]: bool(s.get("locked")) for s in current.get("services", [])}
+        subservices = [
+            dict(s, locked=locked[s["name"]]) if s["name"] in locked else s
+            for s in service.get("services", [])
+        ]
+        return dict(service, services=subservices)
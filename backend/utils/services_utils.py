@@ -2,125 +2,314 @@
 
 import yaml
 import io
+import contextvars
+import json
 import re
 import os
+import shlex
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from contextlib import nullcontext
 from utils.logging_utils import log
+from utils.ssh_utils import exec_remote, run_remote_batch
+from utils.metrics_utils import track_operation
+from utils.build_utils import normalize_build, plan_builds, record_builds
+
+BUILD_TIMEOUT = 900
+RECREATE_TIMEOUT = 300
+DISCOVERY_TIMEOUT = 60
+RESTART_PARALLELISM = 4
+READY_TIMEOUT = 60
+# Seconds connections get to move over before a container is retired in a blue/green swap
+DRAIN_SECONDS = 5
+# Bump when parse_discovered_service() starts extracting something new
+PARSER_VERSION = 5
+DISCOVERY_SCRIPT_PATH = os.path.join(os.path.dirname(__file__), "../assets/RemoteAgent/discover_services.py")
+
+# Run on the VM, in the project folder: argv = marker file, timeout, then
+# "name=port,port" specs, name being a compose service or "@container".
+# Polls until each one's containers are running (and healthy, if they have a
+# healthcheck) and accept TCP connections on their own address, then prints
+# the seconds from the marker's timestamp (written before the restart) to ready.
+# The published ports aren't used: docker-proxy accepts connections on them
+# as soon as the container exists, whether the app listens or not.
+READY_PROBE = """
+import json, os, socket, subprocess, sys, time
+marker, timeout, specs = sys.argv[1], float(sys.argv[2]), sys.argv[3:]
+try:
+    with open(marker) as f:
+        started = float(f.read())
+    os.remove(marker)
+except (OSError, ValueError):
+    started = time.time()
+
+def docker(*args):
+    return subprocess.run(["docker", *args], capture_output=True, text=True).stdout
+
+def containers(name):
+    named = name.startswith("@")
+    ids = [name[1:]] if named else docker("compose", "ps", "-q", name).split()
+    try:
+        found = json.loads(docker("inspect", *ids)) if ids else []
+    except ValueError:
+        return []
+    # `docker compose run` copies (one-off containers) aren't the service
+    return [c for c in found if named or (c["Config"].get("Labels") or {}).get("com.docker.compose.oneoff") != "True"]
 
-def initialize_services(ssh, config, services_yaml_path):
+def answers(host, port):
+    try:
+        socket.create_connection((host, port), timeout=1).close()
+        return True
+    except OSError:
+        return False
+
+def is_ready(name, ports):
+    found = containers(name)
+    for c in found:
+        state = c["State"]
+        if not state.get("Running") or (state.get("Health") or {}).get("Status", "healthy") != "healthy":
+            return False
+        ips = [n["IPAddress"] for n in (c["NetworkSettings"].get("Networks") or {}).values() if n.get("IPAddress")]
+        if not all(answers(ips[0] if ips else "127.0.0.1", port) for port in ports):
+            return False
+    return bool(found)
+
+pending = {}
+for spec in specs:
+    name, _, ports = spec.partition("=")
+    pending[name] = [int(p) for p in ports.split(",") if p]
+deadline, ready = time.time() + timeout, {name: None for name in pending}
+while pending and time.time() < deadline:
+    for name, ports in list(pending.items()):
+        if is_ready(name, ports):
+            ready[name] = time.time() - started
+            del pending[name]
+    if pending:
+        time.sleep(0.25)
+print(json.dumps({"ready": ready, "elapsed": time.time() - started}))
+"""
+
+@track_operation("initialize_services")
+def initialize_services(ssh, config):
+    """Discovers the services and loads them into the host's registry, which saves them."""
     log.info("🔧 Initializing services...")
     discovered_services = list_vm_services_with_ports(ssh)
     if not discovered_services:
         log.warning("⚠️ No services discovered. Please ensure your VM is running Docker and has services configured.")
         return None
     log.info(f"Discovered {len(discovered_services)} services.")
-    if not os.path.exists(os.path.dirname(services_yaml_path)):
-        os.makedirs(os.path.dirname(services_yaml_path))
-    save_services_to_yaml(discovered_services, services_yaml_path)
-    config["services"] = discovered_services
+    config["services"].replace_all(discovered_services)
     return discovered_services
 
+# [HOST_IP:][PUBLISHED:]TARGET[/PROTOCOL], where ports may be ranges
+SHORT_PORT_RE = re.compile(
+    r"^(?:(?P<host_ip>\[[^\]]+\]|\d+\.\d+\.\d+\.\d+):)?"
+    r"(?:(?P<published>\d+(?:-\d+)?)?:)?"
+    r"(?P<target>\d+(?:-\d+)?)"
+    r"(?:/(?P<protocol>\w+))?$"
+)
+
+def _first_port(value):
+    if value in (None, ""):
+        return None
+    return int(str(value).split("-")[0])
+
+def parse_port_mapping(port_mapping):
+    """
+    Parses a compose port in short ("127.0.0.1:8080:80/tcp") or long
+    ({"published": 8080, "target": 80, ...}) syntax. Returns a dict with
+    'host_ip', 'published' (None if no host port), 'target', 'protocol' and
+    'range' (True for port ranges, whose first port is reported), or None if
+    the format isn't recognized.
+    """
+    if isinstance(port_mapping, dict):
+        published, target = port_mapping.get("published"), port_mapping.get("target")
+        if target is None:
+            return None
+        return {
+            "host_ip": port_mapping.get("host_ip"),
+            "published": _first_port(published),
+            "target": _first_port(target),
+            "protocol": port_mapping.get("protocol"),
+            "range": "-" in str(published) or "-" in str(target),
+        }
+
+    match = SHORT_PORT_RE.match(str(port_mapping).strip())
+    if not match:
+        return None
+    return {
+        "host_ip": match.group("host_ip"),
+        "published": _first_port(match.group("published")),
+        "target": _first_port(match.group("target")),
+        "protocol": match.group("protocol"),
+        "range": "-" in str(port_mapping),
+    }
+
+def format_port_mapping(like, host_ip, published, target, protocol=None):
+    """Builds a port entry in the same syntax (short or long) as `like`."""
+    if isinstance(like, dict):
+        mapping = {"target": target, "published": published, "host_ip": host_ip}
+        if protocol:
+            mapping["protocol"] = protocol
+        return mapping
+    suffix = f"/{protocol}" if protocol and protocol != "tcp" else ""
+    return f"{host_ip}:{published}:{target}{suffix}"
+
 def extract_ports(ports):
     extracted = []
     for port_mapping in ports:
-        port_str = str(port_mapping).strip()
-        match = re.match(r"(?:[\d\.]+:)?(\d+):\d+", port_str)
-        if match:
-            extracted.append(int(match.group(1)))
+        mapping = parse_port_mapping(port_mapping)
+        if mapping and mapping["published"] is not None:
+            extracted.append(mapping["published"])
         else:
             log.warn(f"Failed to extract port from {port_mapping}")
 
     return extracted
 
+def probe_targets(ports):
+    """Container ports behind the published TCP ports, for readiness probes run on the VM."""
+    targets = []
+    for port_mapping in ports:
+        mapping = parse_port_mapping(port_mapping)
+        if not mapping or mapping["published"] is None or (mapping["protocol"] or "tcp") != "tcp":
+            continue
+        if mapping["target"] not in targets:
+            targets.append(mapping["target"])
+    return targets
+
+def format_volumes(volumes):
+    """Volumes as "source:target[:ro]" strings, whichever syntax the compose file used."""
+    formatted = []
+    for volume in volumes:
+        if isinstance(volume, dict):
+            text = f"{volume['source']}:{volume['target']}" if volume.get("source") else str(volume.get("target"))
+            if volume.get("read_only"):
+                text += ":ro"
+            formatted.append(text)
+        else:
+            formatted.append(volume)
+    return formatted
+
+def parse_depends_on(depends_on):
+    """Names of the services a compose service depends on (list or mapping syntax)."""
+    if not depends_on:
+        return []
+    if isinstance(depends_on, dict):
+        return list(depends_on)
+    return [str(d) for d in depends_on]
+
+def builds_from_folder(value, folder):
+    """True if the compose service is built from the project folder itself."""
+    build = value.get("build")
+    context = build.get("context") if isinstance(build, dict) else build
+    if not context:
+        return False
+    return context in (".", "./") or os.path.normpath(context) == folder
+
+def discover_remote_services(ssh, root_dir="/root", known=None):
+    """
+    Runs the discovery script on the VM and returns its entries: one dict per
+    compose file with 'path', 'name', 'content', 'sha256', 'mtime', 'tls'
+    and 'proxied'. Files listed in `known` ({path: [mtime, sha256]}) that
+    haven't changed come back with 'unchanged' set and no 'content'.
+    """
+    with open(DISCOVERY_SCRIPT_PATH, "r") as f:
+        script = f.read()
+
+    cmd = f"python3 - {shlex.quote(root_dir)}"
+    if known:
+        cmd += f" {shlex.quote(json.dumps(known))}"
+    result = exec_remote(ssh, cmd, timeout=DISCOVERY_TIMEOUT, stdin_data=script)
+    if result["exit_code"] != 0:
+        raise Exception(result["stderr"].strip() or f"Discovery exited with {result['exit_code']}")
+    return json.loads(result["stdout"])["services"]
+
+@track_operation("list_vm_services_with_ports")
 def list_vm_services_with_ports(ssh, root_dir="/root"):
-    stdin, stdout, stderr = ssh.exec_command(
-        f"find {root_dir} -maxdepth 2 -type f -regex '.*/\\(docker-\\)?compose\\.ya?ml'"
-    )
+    try:
+        entries = discover_remote_services(ssh, root_dir)
+    except Exception as e:
+        log.error(f"❌ Service discovery failed: {e}")
+        return []
 
-    compose_paths = stdout.read().decode().splitlines()
     services = []
-
-    for path in compose_paths:
-        folder_path = os.path.dirname(path)
-        folder_name = os.path.basename(folder_path)
+    for entry in entries:
+        folder_name = entry["name"]
 
         # 👇 Skip any folder named "pcaps"
         if folder_name.lower() == "pcaps":
             log.info(f"Skipping service folder '{folder_name}'")
             continue
 
-        stdin, stdout, stderr = ssh.exec_command(f"cat {path}")
-        compose_content = stdout.read().decode()
-
-        service_obj = {"name": folder_name}
+        services.append(parse_discovered_service(entry))
 
-        # 👇 Check for TLS (.pem files)
-        pem_check_cmd = f"find {folder_path} -type f -name '*.pem' | head -n 1"
-        stdin, stdout, stderr = ssh.exec_command(pem_check_cmd)
-        pem_result = stdout.read().decode().strip()
-        service_obj["tls"] = bool(pem_result)
+    return services
 
-        # Check for proxy folder
-        proxy_folder_name = f"proxy_folder_{folder_name}"
-        log.info(f"Checking for proxy folder: {proxy_folder_name} in {folder_path}")
-        check_cmd = f"test -d {folder_path}/{proxy_folder_name}"
-        stdin, stdout, stderr = ssh.exec_command(check_cmd)
-        exit_status = stdout.channel.recv_exit_status()
-        log.info(f"Proxy folder check exit status: {exit_status}")
-        service_obj["proxied"] = (exit_status == 0)
+def parse_discovered_service(entry):
+    """Builds a service object from one discovery entry."""
+    folder_name = entry["name"]
+    compose_content = entry.get("content", "")
+    # Canonical config from `docker compose config` when the VM could provide it
+    resolved = entry.get("resolved")
+    service_obj = {"name": folder_name, "tls": entry["tls"], "proxied": entry["proxied"]}
+    if "sha256" in entry:
+        service_obj["compose"] = {
+            "path": entry["path"], "mtime": entry["mtime"], "sha256": entry["sha256"], "parser": PARSER_VERSION,
+        }
 
+    if not compose_content:
+        log.warning(f"⚠️ No compose file found in {folder_name}")
+        return service_obj
 
-        if not compose_content:
-            log.warning(f"⚠️ No compose file found in {folder_name}")
-            services.append(service_obj)
-            continue
+    try:
+        compose_data = resolved or yaml.safe_load(io.StringIO(compose_content))
+
+        subservices = []
+        all_ports = []
+        main_service = None
+
+        for name, value in compose_data.get("services", {}).items():
+            service = {
+                'name': name,
+                'ports': extract_ports(value.get('ports', [])),
+                'volumes': format_volumes(value.get('volumes', [])),
+                'environment': value.get('environment', []),
+                'locked': False,
+                'depends_on': parse_depends_on(value.get('depends_on')),
+                'probes': probe_targets(value.get('ports', [])),
+            }
+
+            if 'image' in value:
+                service['image'] = value['image']
+            if value.get('build'):
+                service['build'] = normalize_build(value['build'], entry.get("folder"))
+
+            subservices.append(service)
+            all_ports.extend(service['ports'])
+
+            if not main_service:
+                if builds_from_folder(value, entry.get("folder")):
+                    main_service = service
+
+        if main_service and main_service['ports']:
+            the_ports = main_service['ports']
+        else:
+            the_ports = all_ports
 
-        try:
-            compose_data = yaml.safe_load(io.StringIO(compose_content))
-
-            subservices = []
-            all_ports = []
-            main_service = None
-
-            for name, value in compose_data.get("services", {}).items():
-                service = {
-                    'name': name,
-                    'ports': extract_ports(value.get('ports', [])),
-                    'volumes': value.get('volumes', []),
-                    'environment': value.get('environment', []),
-                    'locked': False,
-                }
-
-                if 'image' in value:
-                    service['image'] = value['image']
-
-                subservices.append(service)
-                all_ports.extend(service['ports'])
-
-                if not main_service:
-                    if 'build' in value and value['build'] in ['.', './']:
-                        main_service = service
-
-            if main_service and main_service['ports']:
-                the_ports = main_service['ports']
-            else:
-                the_ports = all_ports
-
-            if the_ports:
-                service_obj["port"] = the_ports[0]
-                if len(the_ports) > 1:
-                    log.warn(f"Found more than one port for service {folder_name}!")
-            else:
-                log.error(f"No ports found for service {folder_name}")
-                service_obj["port"] = "Undefined"
-
-            service_obj["services"] = subservices
+        if the_ports:
+            service_obj["port"] = the_ports[0]
+            if len(the_ports) > 1:
+                log.warn(f"Found more than one port for service {folder_name}!")
+        else:
+            log.error(f"No ports found for service {folder_name}")
+            service_obj["port"] = "Undefined"
 
-        except Exception as e:
-            log.error(f"⚠️ Failed to parse compose file in {folder_name}: {e}")
+        service_obj["services"] = subservices
 
-        services.append(service_obj)
+    except Exception as e:
+        log.error(f"⚠️ Failed to parse compose file in {folder_name}: {e}")
 
-    return services
+    return service_obj
 
 def save_services_to_yaml(services, path):
     formatted = []
@@ -134,60 +323,413 @@ def save_services_to_yaml(services, path):
 
         if "services" in s:
             entry["services"] = s["services"]
+        if "compose" in s:
+            entry["compose"] = s["compose"]
         formatted.append(entry)
 
-    with open(path, "w") as f:
+    if not os.path.exists(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+
+    # Write to a temporary file and rename it, so a crash never leaves a truncated file
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
         yaml.dump({"services": formatted}, f, sort_keys=False)
+    os.replace(tmp_path, path)
+
+def _report_step(progress, name):
+    if progress is not None:
+        progress.step(name)
+
+def _output_sink(progress, service=None):
+    """progress.output, tagging lines with `service` when commands for several run at once."""
+    if progress is None or service is None:
+        return progress.output if progress is not None else None
+    return lambda stream, text: progress.output(stream, text, service=service)
+
+def _ready_marker(service_path, name):
+    return f"/tmp/cannavaro-{os.path.basename(service_path)}-{name}.started"
+
+def _mark_down(marker):
+    """Shell prefix recording, on the VM, when the service goes down."""
+    return f"date +%s.%N > {shlex.quote(marker)} && "
+
+def wait_until_ready(ssh, service_path, marker, probes, timeout=READY_TIMEOUT):
+    """
+    Probes from the VM until the containers of each subservice in `probes`
+    ({svc: [container ports]}, or "@container" keys) are running, healthy
+    and accept connections on those ports, or `timeout` passes. Returns
+    ({svc: downtime}, [not ready]); downtime is measured on the VM from when
+    `marker` was written.
+    """
+    specs = [f"{name}={','.join(map(str, ports))}" for name, ports in probes.items()]
+    cmd = (
+        f"cd {service_path} && python3 -c {shlex.quote(READY_PROBE)} {shlex.quote(marker)} {timeout} "
+        f"{' '.join(map(shlex.quote, specs))}"
+    )
+    result = exec_remote(ssh, cmd, timeout=timeout + 30)
+    if result["exit_code"] != 0:
+        raise Exception(result["stderr"].strip() or f"Probe exited with {result['exit_code']}")
+    probe = json.loads(result["stdout"])
+
+    downtime, not_ready = {}, []
+    for svc, ready_after in probe["ready"].items():
+        if ready_after is None:
+            not_ready.append(svc)
+            downtime[svc] = round(probe["elapsed"], 3)
+        else:
+            downtime[svc] = round(ready_after, 3)
+    return downtime, not_ready
 
-def restart_docker_service(ssh, service_name):
+def _plan_builds(ssh, service_path, services, build_specs, force):
+    """
+    Subservices of `services` that need a build, plus the build report.
+    Without `build_specs` (unknown build contexts) all of them are built.
+    """
+    if build_specs is None:
+        return list(services), {}, {"built": list(services), "skipped": []}
+    specs = {svc: build_specs[svc] for svc in services if svc in build_specs}
+    try:
+        plan = plan_builds(ssh, os.path.basename(service_path), specs, force)
+    except Exception as e:
+        log.warning(f"⚠️ Could not hash build contexts, building everything: {e}")
+        return list(specs), {}, {"built": list(specs), "skipped": []}
+    hashes = {svc: plan["hashes"][svc] for svc in plan["build"] if svc in plan["hashes"]}
+    return plan["build"], hashes, {"built": plan["build"], "skipped": plan["skip"]}
+
+@track_operation("restart_docker_service")
+def restart_docker_service(ssh, service_name, progress=None, build_specs=None, force_build=False,
+                           probes=None, ready_timeout=READY_TIMEOUT):
+    """
+    Rebuilds and recreates a whole compose project. If given, `progress`
+    (e.g. a Job) is told about each step and receives the command output.
+    With `build_specs` ({svc: build spec}) only subservices whose build
+    context changed since their last build are rebuilt, unless `force_build`.
+    With `probes` ({svc: [container ports]}) it then waits for the
+    subservices to accept connections and reports each one's downtime.
+    """
     service_path = f"/root/{service_name}"  # Adjust this path as needed
+    started = time.monotonic()
+    if build_specs is None:
+        to_build, hashes, builds = None, {}, None
+    else:
+        to_build, hashes, builds = _plan_builds(ssh, service_path, build_specs, build_specs, force_build)
+
+    marker = _ready_marker(service_path, "all")
+    mark = _mark_down(marker) if probes is not None else ""
     commands = [
-        f"cd {service_path} && docker compose build",
-        f"cd {service_path} && docker compose down && docker compose up -d"
+        ("recreate", f"cd {service_path} && {mark}docker compose down && docker compose up -d", RECREATE_TIMEOUT)
     ]
-    for cmd in commands:
-        stdin, stdout, stderr = ssh.exec_command(cmd)
-        if stdout.channel.recv_exit_status() != 0:
-            error = stderr.read().decode().strip()
+    if to_build is None:
+        commands.insert(0, ("build", f"cd {service_path} && docker compose build", BUILD_TIMEOUT))
+    elif to_build:
+        commands.insert(0, ("build", f"cd {service_path} && docker compose build {' '.join(map(shlex.quote, to_build))}", BUILD_TIMEOUT))
+    for step, cmd, timeout in commands:
+        _report_step(progress, step)
+        try:
+            result = exec_remote(ssh, cmd, timeout=timeout, on_output=_output_sink(progress))
+        except TimeoutError:
+            log.error(f"[ERROR] Timed out after {timeout}s: {cmd}")
+            return {"success": False, "error": f"Timed out after {timeout}s: {cmd}"}
+        if result["exit_code"] != 0:
+            error = result["stderr"].strip()
             print(f"[ERROR] Failed to run: {cmd}\n{error}")
             return {"success": False, "error": error}
-    return {"success": True}
+        if step == "build":
+            record_builds(ssh, service_name, hashes)
 
-def rolling_restart_docker_service(ssh, service_path, to_restart):
+    timings = {"strategy": "recreate"}
+    not_ready = []
+    if probes is not None:
+        _report_step(progress, "wait for ports")
+        try:
+            timings["downtime_s"], not_ready = wait_until_ready(ssh, service_path, marker, probes, ready_timeout)
+        except Exception as e:
+            return {"success": False, "error": f"Readiness probe failed: {e}"}
+    timings["total_s"] = round(time.monotonic() - started, 3)
+    log.info(f"Restart of {service_path} took {timings['total_s']:.1f}s")
+
+    result = {"success": not not_ready, "timings": timings}
+    if not_ready:
+        result["error"] = {svc: f"Not accepting connections after {ready_timeout}s" for svc in not_ready}
+    if builds is not None:
+        result["builds"] = builds
+    return result
+
+def _recreate(ssh, service_path, svc, progress, targets=None, ready_timeout=READY_TIMEOUT):
+    """
+    Recreates one subservice and, given its probe `targets`, waits until it
+    accepts connections. Returns (error, downtime in seconds or None).
+    """
+    marker = _ready_marker(service_path, svc)
+    mark = _mark_down(marker) if targets is not None else ""
+    restart_cmd = f"cd {service_path} && {mark}docker compose up -d --no-deps --force-recreate {svc}"
+    log.info("Restarting service: %s", svc)
+    _report_step(progress, f"recreate {svc}")
+    try:
+        # Recreates run in parallel: keep each one's partial lines apart
+        result = exec_remote(ssh, restart_cmd, timeout=RECREATE_TIMEOUT, on_output=_output_sink(progress, svc))
+    except TimeoutError:
+        return f"Timed out after {RECREATE_TIMEOUT}s", None
+    if result["exit_code"] != 0:
+        return result["stderr"].strip(), None
+    if targets is None:
+        return None, None
+
+    _report_step(progress, f"wait for {svc}")
+    try:
+        downtime, not_ready = wait_until_ready(ssh, service_path, marker, {svc: targets}, ready_timeout)
+    except Exception as e:
+        return f"Readiness probe failed: {e}", None
+    if not_ready:
+        return f"Not accepting connections after {ready_timeout}s", downtime[svc]
+    return None, downtime[svc]
+
+def recreate_in_dependency_order(ssh, service_path, to_restart, depends_on=None, parallelism=RESTART_PARALLELISM, progress=None,
+                                 probes=None, ready_timeout=READY_TIMEOUT):
+    """
+    Recreates the listed subservices, up to `parallelism` at a time. A
+    subservice waits for the ones it depends on (within `to_restart`) and is
+    skipped if one of them failed. With `probes` ({svc: [container ports]}) a
+    subservice only counts as restarted once its ports accept connections.
+    If `ssh` is a pool lease, parallel recreates take a lease each, so their
+    channels count against the pool's per-transport cap.
+    Returns ({svc: error}, {svc: seconds}, {svc: downtime seconds}).
+    """
+    depends_on = depends_on or {}
+    pending = {svc: {d for d in depends_on.get(svc, []) if d in to_restart and d != svc} for svc in to_restart}
+    failed, durations, downtime, running = {}, {}, {}, {}
+    ssh_pool = getattr(ssh, "pool", None) if parallelism > 1 and len(to_restart) > 1 else None
+
+    def timed(svc):
+        started = time.monotonic()
+        targets = probes.get(svc, []) if probes is not None else None
+        try:
+            with ssh_pool.lease() if ssh_pool is not None else nullcontext(ssh) as worker_ssh:
+                error, down = _recreate(worker_ssh, service_path, svc, progress, targets, ready_timeout)
+        except TimeoutError as e:
+            error, down = str(e), None
+        return error, time.monotonic() - started, down
+
+    with ThreadPoolExecutor(max_workers=max(1, parallelism)) as pool:
+        while pending or running:
+            for svc, deps in list(pending.items()):
+                if deps & failed.keys():
+                    failed[svc] = "Not restarted: a dependency failed"
+                    del pending[svc]
+            ready = [svc for svc, deps in pending.items() if not deps - durations.keys()]
+            if not ready and not running and pending:
+                # Dependency cycle: nothing can ever become ready, so stop waiting
+                log.warning("⚠️ depends_on cycle among %s, ignoring the order", list(pending))
+                ready = list(pending)
+
+            for svc in ready:
+                del pending[svc]
+                # Worker threads don't inherit the metrics label
+                running[pool.submit(contextvars.copy_context().run, timed, svc)] = svc
+
+            if not running:
+                continue
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                svc = running.pop(future)
+                error, durations[svc], down = future.result()
+                if down is not None:
+                    downtime[svc] = down
+                if error:
+                    failed[svc] = error
+
+    return failed, {svc: round(d, 3) for svc, d in durations.items()}, downtime
+
+def build_subservices(ssh, service_path, to_build, progress=None, build_specs=None, force_build=False):
+    """
+    Builds the listed subservices (with `build_specs`, only those whose
+    build context changed, unless `force_build`). Returns (error, builds).
+    """
+    to_build, hashes, builds = _plan_builds(ssh, service_path, to_build, build_specs, force_build)
+    if not to_build:
+        return None, builds
+
+    build_cmd = f"cd {service_path} && docker compose build {' '.join(map(shlex.quote, to_build))}"
+    log.info("Building services: %s", build_cmd)
+    _report_step(progress, "build")
+    try:
+        result = exec_remote(ssh, build_cmd, timeout=BUILD_TIMEOUT, on_output=_output_sink(progress))
+    except TimeoutError:
+        log.error("[ERROR] Build timed out after %ss", BUILD_TIMEOUT)
+        return f"Build timed out after {BUILD_TIMEOUT}s", builds
+    if result["exit_code"] != 0:
+        error = result["stderr"].strip()
+        log.error("[ERROR] Build failed:\n%s", error)
+        return error, builds
+    record_builds(ssh, os.path.basename(service_path), hashes)
+    return None, builds
+
+@track_operation("rolling_restart_docker_service")
+def rolling_restart_docker_service(ssh, service_path, to_restart, progress=None, depends_on=None, parallelism=RESTART_PARALLELISM,
+                                   build_specs=None, force_build=False, probes=None, ready_timeout=READY_TIMEOUT):
     """
     Perform a rolling restart of specified services:
-    - Build the listed services
-    - Restart each one individually
+    - Build the listed services (with `build_specs`, only those whose build
+      context changed since their last build, unless `force_build`)
+    - Recreate them, independent ones in parallel (up to `parallelism`),
+      dependents after what they depend on ({svc: [deps]} in `depends_on`)
+    - With `probes`, wait for each one's ports to accept connections (up to
+      `ready_timeout`) and report its downtime as measured on the VM
+    `progress` is reported to like in restart_docker_service().
+    The result includes wall-clock timings of each phase.
     """
     log.info("Rolling restart for: %s", to_restart)
     if not to_restart:
         return {"success": True, "message": "No services to restart."}
-
-    # 1. Build specified services
-    build_cmd = f"cd {service_path} && docker compose build {' '.join(to_restart)}"
-    log.info("Building services: %s", build_cmd)
-    stdin, stdout, stderr = ssh.exec_command(build_cmd)
-    if stdout.channel.recv_exit_status() != 0:
-        error = stderr.read().decode().strip()
-        log.error("[ERROR] Build failed:\n%s", error)
-        return {"success": False, "error": error}
-
-    # 2. Restart each service individually
-    failed = {}
-    for svc in to_restart:
-        restart_cmd = f"cd {service_path} && docker compose up -d --no-deps --force-recreate {svc}"
-        log.info("Restarting service: %s", svc)
-        stdin, stdout, stderr = ssh.exec_command(restart_cmd)
-        exit_status = stdout.channel.recv_exit_status()
-        if exit_status != 0:
-            failed[svc] = stderr.read().decode().strip()
+    started = time.monotonic()
+
+    # 1. Build specified services whose context changed
+    error, builds = build_subservices(ssh, service_path, to_restart, progress, build_specs, force_build)
+    if error:
+        return {"success": False, "error": error, "builds": builds}
+    built = time.monotonic()
+
+    # 2. Recreate, following depends_on
+    failed, durations, downtime = recreate_in_dependency_order(ssh, service_path, to_restart, depends_on, parallelism, progress,
+                                                               probes, ready_timeout)
+    timings = {
+        "strategy": "rolling",
+        "parallelism": parallelism,
+        "build_s": round(built - started, 3),
+        "recreate_s": round(time.monotonic() - built, 3),
+        "total_s": round(time.monotonic() - started, 3),
+        "per_service_s": durations,
+    }
+    if probes is not None:
+        timings["downtime_s"] = downtime
+    log.info("Rolling restart of %s took %.1fs", service_path, timings["total_s"])
 
     if failed:
         for svc, msg in failed.items():
             log.error("[ERROR] Restart failed for %s: %s", svc, msg)
-        return {"success": False, "error": failed}
+        return {"success": False, "error": failed, "timings": timings, "builds": builds}
+
+    return {"success": True, "restarted": to_restart, "timings": timings, "builds": builds}
+
+# ─── Blue/green ────────────────────────────
+SPARE_PORTS_SCRIPT = """
+import socket, sys
+socks = [socket.socket() for _ in range(int(sys.argv[1]))]
+for sock in socks:
+    sock.bind(("127.0.0.1", 0))
+print(" ".join(str(sock.getsockname()[1]) for sock in socks))
+"""
+
+def _published_tcp_ports(output):
+    """{target: published} from `docker port` output ("80/tcp -> 127.0.0.1:8086")."""
+    ports = {}
+    for line in output.splitlines():
+        container, _, host = line.partition(" -> ")
+        target, _, protocol = container.strip().partition("/")
+        if protocol == "tcp" and host:
+            ports.setdefault(int(target), int(host.rsplit(":", 1)[1]))
+    return ports
+
+def _redirect_rule(action, published, spare, tag):
+    # Locally generated connections only: that is how the proxy reaches the service
+    return (
+        f"iptables -t nat {action} OUTPUT -p tcp -m addrtype --dst-type LOCAL --dport {published} "
+        f"-m comment --comment {shlex.quote(tag)} -j REDIRECT --to-ports {spare}"
+    )
+
+@track_operation("blue_green_restart")
+def blue_green_restart(ssh, service_path, svc, progress=None, build_specs=None, force_build=False,
+                       ready_timeout=READY_TIMEOUT, drain=DRAIN_SECONDS):
+    """
+    Restarts one subservice behind a proxy without refusing connections:
+    - Build it, then start a "green" copy of it on spare ports and wait for it
+    - Redirect local connections to its published ports (the proxy's
+      TO_PORT) to the green copy with an iptables rule, in one step
+    - After `drain` seconds, recreate the original container and wait for it
+    - Drop the redirect and, after `drain` seconds, remove the green copy
+    The redirect and the green copy are always cleaned up, even on failure.
+    """
+    started = time.monotonic()
+    project = os.path.basename(service_path)
+    green, tag = f"{project}-{svc}-green", f"cannavaro-{project}-{svc}"
+    # The compose-managed container, never the green one-off copy
+    current = (
+        f"$(docker compose ps -q {shlex.quote(svc)} | xargs -r docker inspect -f '{{{{.Id}}}} {{{{.Name}}}}' "
+        f"| grep -v ' /{green}$' | head -n1 | cut -d' ' -f1)"
+    )
+
+    ports = exec_remote(ssh, f"cd {service_path} && docker port {current}")
+    published = _published_tcp_ports(ports["stdout"])
+    if ports["exit_code"] != 0 or not published:
+        return {"success": False, "error": f"{svc} isn't running with published TCP ports"}
+
+    # 1. Build, while the current container keeps serving
+    error, builds = build_subservices(ssh, service_path, [svc], progress, build_specs, force_build)
+    if error:
+        return {"success": False, "error": error, "builds": builds}
+    built = time.monotonic()
 
-    return {"success": True, "restarted": to_restart}
+    spare = exec_remote(ssh, f"python3 -c {shlex.quote(SPARE_PORTS_SCRIPT)} {len(published)}")
+    if spare["exit_code"] != 0:
+        return {"success": False, "error": f"Could not find spare ports: {spare['stderr'].strip()}"}
+    swap = {pub: int(port) for pub, port in zip(published.values(), spare["stdout"].split())}
+    redirected = []
+
+    try:
+        # 2. Green copy on the spare ports
+        _report_step(progress, f"start green {svc}")
+        mappings = " ".join(f"-p 127.0.0.1:{swap[pub]}:{target}" for target, pub in published.items())
+        result = exec_remote(
+            ssh,
+            f"cd {service_path} && docker rm -f {green} >/dev/null 2>&1; "
+            f"docker compose run -d --no-deps --name {green} {mappings} {shlex.quote(svc)}",
+            timeout=RECREATE_TIMEOUT, on_output=_output_sink(progress),
+        )
+        if result["exit_code"] != 0:
+            return {"success": False, "error": result["stderr"].strip(), "builds": builds}
+        # Probed on its own address: docker-proxy accepts on the spare ports before the app listens
+        _, not_ready = wait_until_ready(ssh, service_path, _ready_marker(service_path, green), {f"@{green}": list(published)}, ready_timeout)
+        if not_ready:
+            return {"success": False, "error": f"Green {svc} not accepting connections after {ready_timeout}s", "builds": builds}
+        green_ready = time.monotonic()
+
+        # 3. Switch traffic over
+        _report_step(progress, f"switch {svc} to green")
+        for pub, port in swap.items():
+            rule = exec_remote(ssh, _redirect_rule("-I", pub, port, tag))
+            if rule["exit_code"] != 0:
+                return {"success": False, "error": f"Could not redirect port {pub}: {rule['stderr'].strip()}", "builds": builds}
+            redirected.append(pub)
+        time.sleep(drain)
+
+        # 4. Recreate the original; its ports are redirected, so probe the container itself
+        _report_step(progress, f"recreate {svc}")
+        result = exec_remote(ssh, f"cd {service_path} && docker compose up -d --no-deps --force-recreate {svc}",
+                             timeout=RECREATE_TIMEOUT, on_output=_output_sink(progress))
+        if result["exit_code"] != 0:
+            return {"success": False, "error": result["stderr"].strip(), "builds": builds}
+        _, not_ready = wait_until_ready(ssh, service_path, _ready_marker(service_path, svc), {svc: list(published)}, ready_timeout)
+        if not_ready:
+            return {"success": False, "error": f"{svc} not accepting connections after {ready_timeout}s", "builds": builds}
+        swapped = time.monotonic()
+    finally:
+        # 5. Back to the original container, then retire the green copy
+        _report_step(progress, f"retire green {svc}")
+        commands = [_redirect_rule("-D", pub, swap[pub], tag) for pub in redirected]
+        if redirected:
+            commands.append(f"sleep {drain}")
+        commands.append(f"docker stop {green} >/dev/null 2>&1; docker rm -f {green}")
+        run_remote_batch(ssh, commands, timeout=RECREATE_TIMEOUT + drain)
+
+    timings = {
+        "strategy": "blue_green",
+        "build_s": round(built - started, 3),
+        "green_s": round(green_ready - built, 3),
+        "swap_s": round(swapped - green_ready, 3),
+        "total_s": round(time.monotonic() - started, 3),
+    }
+    log.info("Blue/green restart of %s/%s took %.1fs", service_path, svc, timings["total_s"])
+    return {"success": True, "restarted": [svc], "ports": swap, "timings": timings, "builds": builds}
 
 def load_services_from_yaml(path):
     if not os.path.exists(path):
@@ -196,6 +738,9 @@ def load_services_from_yaml(path):
     try:
         with open(path, "r") as f:
             data = yaml.safe_load(f)
+            # Older versions saved the bare list
+            if isinstance(data, list):
+                return data
             if not data or "services" not in data:
                 log.warning("⚠️ services.yaml is missing the 'services' key.")
                 return None
@@ -203,3 +748,93 @@ def load_services_from_yaml(path):
     except Exception as e:
         log.error(f"❌ Failed to load services.yaml: {e}")
         return None
+
+def build_specs_of(service):
+    """
+    {subservice: build spec} of a registry entry, or None if it was parsed
+    before build contexts were recorded (then everything gets built).
+    """
+    if service.get("compose", {}).get("parser") != PARSER_VERSION:
+        return None
+    return {sub["name"]: sub["build"] for sub in service.get("services", []) if sub.get("build")}
+
+def probes_of(service):
+    """{subservice: [container ports]} of a registry entry, or None if parsed before probes were recorded."""
+    if service.get("compose", {}).get("parser") != PARSER_VERSION:
+        return None
+    return {sub["name"]: sub.get("probes", []) for sub in service.get("services", [])}
+
+def carry_over_locks(old_service, new_service):
+    """Keeps the lock state of subservices that still exist after a re-parse."""
+    locked = {s["name"] for s in old_service.get("services", []) if s.get("locked")}
+    for sub in new_service.get("services", []):
+        if sub["name"] in locked:
+            sub["locked"] = True
+
+def known_compose_files(services):
+    """
+    {path: [mtime, sha256]} of the compose files behind `services`, for the
+    discovery script. Services parsed by an older parser are left out, so
+    they get re-parsed.
+    """
+    return {
+        s["compose"]["path"]: [s["compose"]["mtime"], s["compose"]["sha256"]]
+        for s in services if s.get("compose", {}).get("parser") == PARSER_VERSION
+    }
+
+def merge_discovered_service(old, entry):
+    """
+    Combines a known service with a fresh discovery entry. The compose file
+    is only re-parsed if it changed. Returns (service, changed).
+    """
+    if old and entry.get("unchanged"):
+        service = dict(old, tls=entry["tls"], proxied=entry["proxied"])
+        service["compose"] = dict(old["compose"], mtime=entry["mtime"], sha256=entry["sha256"])
+        return service, (old.get("tls"), old.get("proxied")) != (entry["tls"], entry["proxied"])
+
+    service = parse_discovered_service(entry)
+    if old:
+        carry_over_locks(old, service)
+    return service, True
+
+@track_operation("revalidate_services")
+def revalidate_services(ssh, config, root_dir="/root"):
+    """
+    Checks the services loaded from services.yaml against the VM. Only
+    compose files whose mtime and hash changed are sent back and re-parsed;
+    the result is swapped into the host's registry, which saves it.
+    Returns {"added": [...], "removed": [...], "changed": [...]}, or None if
+    discovery failed.
+    """
+    cached = {s["name"]: s for s in config["services"]}
+    known = known_compose_files(cached.values())
+
+    try:
+        entries = discover_remote_services(ssh, root_dir, known)
+    except Exception as e:
+        log.error(f"❌ Service revalidation failed: {e}")
+        return None
+
+    services = []
+    diff = {"added": [], "removed": [], "changed": []}
+    for entry in entries:
+        name = entry["name"]
+        if name.lower() == "pcaps":
+            continue
+
+        old = cached.get(name)
+        service, changed = merge_discovered_service(old, entry)
+        if changed:
+            diff["changed" if old else "added"].append(name)
+        services.append(service)
+
+    found = {s["name"] for s in services}
+    diff["removed"] = [name for name in cached if name not in found]
+
+    # Locks may have been toggled since `cached` was read
+    config["services"].replace_all(services, persist=any(diff.values()), keep_locks=True)
+    if any(diff.values()):
+        log.info(f"🔄 Services changed on the VM: {diff}")
+    else:
+        log.info("✅ Cached services are up to date.")
+    return diff
@@ -0,0 +1,332 @@
+# utils/ssh_pool.py
+import threading
+import time
+from contextlib import contextmanager
+from utils.logging_utils import log
+from utils.ssh_utils import ssh_connect, is_ssh_active
+
+DEFAULT_POOL_SIZE = 3
+DEFAULT_MAX_CHANNELS = 4
+DEFAULT_LEASE_TIMEOUT = 30
+SFTP_MAX_IDLE = 2
+HEALTH_INTERVAL = 5
+PROBE_TIMEOUT = 5
+MIN_BACKOFF = 1
+MAX_BACKOFF = 60
+
+
+class PooledConnection:
+    """
+    One authenticated transport owned by the pool, plus the number of
+    leases currently running commands on it.
+    """
+
+    def __init__(self, index, max_channels):
+        self.index = index
+        self.max_channels = max_channels
+        self.client = None
+        self.leases = 0
+        # Health, maintained by the pool supervisor
+        self.state = "down"
+        self.rtt_ms = None
+        self.last_ok = None
+        self.last_error = None
+        self.failures = 0
+        self.backoff = 0
+        self.next_attempt = 0
+        # Idle SFTP sessions opened on self.client, reused across leases
+        self._sftp_idle = []
+        self._sftp_lock = threading.Lock()
+
+    def mark_up(self, rtt_ms):
+        self.state = "up"
+        self.rtt_ms = rtt_ms
+        self.last_ok = time.time()
+        self.last_error = None
+        self.failures = 0
+        self.backoff = 0
+
+    def mark_down(self, error):
+        self.state = "down"
+        self.rtt_ms = None
+        self.last_error = error
+
+    def mark_failed(self, error):
+        self.mark_down(error)
+        self.failures += 1
+        self.backoff = min(MIN_BACKOFF * 2 ** (self.failures - 1), MAX_BACKOFF)
+        self.next_attempt = time.monotonic() + self.backoff
+
+    def health(self):
+        return {
+            "index": self.index,
+            "state": self.state,
+            "rtt_ms": round(self.rtt_ms, 2) if self.rtt_ms is not None else None,
+            "last_ok": self.last_ok,
+            "last_error": self.last_error,
+            "failures": self.failures,
+            "leases": self.leases,
+        }
+
+    def is_active(self):
+        return bool(is_ssh_active(self.client))
+
+    # ─── SFTP cache ────────────────────────
+    @staticmethod
+    def _sftp_usable(sftp, client):
+        channel = sftp.get_channel()
+        transport = client.get_transport() if client else None
+        return (
+            not channel.closed
+            and transport is not None
+            and transport.is_active()
+            and channel.get_transport() is transport
+        )
+
+    def checkout_sftp(self, client):
+        """Returns an idle SFTP session on `client`, opening one only if none is cached."""
+        with self._sftp_lock:
+            while self._sftp_idle:
+                sftp = self._sftp_idle.pop()
+                if self._sftp_usable(sftp, client):
+                    return sftp
+                sftp.close()
+        return client.open_sftp()
+
+    def checkin_sftp(self, sftp, client):
+        """Caches a session for reuse if it is still healthy and bound to the current transport."""
+        with self._sftp_lock:
+            if (
+                client is self.client
+                and len(self._sftp_idle) < SFTP_MAX_IDLE
+                and self._sftp_usable(sftp, client)
+            ):
+                self._sftp_idle.append(sftp)
+                return
+        sftp.close()
+
+    def drop_sftp(self):
+        with self._sftp_lock:
+            idle, self._sftp_idle = self._sftp_idle, []
+        for sftp in idle:
+            try:
+                sftp.close()
+            except Exception:
+                pass
+
+    def has_capacity(self):
+        return self.leases < self.max_channels
+
+
+class SSHLease:
+    """
+    Handle given to a caller for the duration of a lease.
+    Behaves like the underlying paramiko.SSHClient, so the utils keep working
+    unchanged, but closing it does not tear down the shared transport.
+    """
+
+    def __init__(self, pool, connection):
+        self.pool = pool
+        self.connection = connection
+        # Pin the client: a background reconnect swaps connection.client,
+        # but in-flight commands keep talking to the transport they started on.
+        self._client = connection.client
+
+    def __getattr__(self, name):
+        return getattr(self._client, name)
+
+    def checkout_sftp(self):
+        return self.connection.checkout_sftp(self._client)
+
+    def checkin_sftp(self, sftp):
+        self.connection.checkin_sftp(sftp, self._client)
+
+    @contextmanager
+    def sftp_session(self):
+        """Borrows a cached SFTP session bound to this lease's transport."""
+        sftp = self.checkout_sftp()
+        try:
+            yield sftp
+        finally:
+            self.checkin_sftp(sftp)
+
+    def close(self):
+        pass
+
+
+class SSHConnectionPool:
+    """
+    Keeps a small pool of SSH transports to the VM and leases them to callers.
+    Each transport accepts at most `max_channels` concurrent leases; a background
+    supervisor keeps them alive, measures latency, and replaces dead transports
+    instead of doing it on the request path.
+    """
+
+    def __init__(self, config, size=None, max_channels=None):
+        self.config = config
+        self.size = size or config.get("ssh_pool_size", DEFAULT_POOL_SIZE)
+        self.max_channels = max_channels or config.get("ssh_max_channels", DEFAULT_MAX_CHANNELS)
+        self._connections = [PooledConnection(i, self.max_channels) for i in range(self.size)]
+        self._cond = threading.Condition()
+        self._stop = threading.Event()
+        self._wakeup = threading.Event()
+        self._thread = None
+        # Optional helper agent on the VM, see utils/agent_utils.py
+        self.agent = None
+        self.agent_lock = threading.Lock()
+        self.agent_failures = 0
+        self.agent_retry_at = 0
+
+    # ─── Lifecycle ─────────────────────────
+    def start(self):
+        """
+        Opens the first transport synchronously so startup fails fast when the VM
+        is unreachable, then lets the maintenance thread fill the rest of the pool.
+        """
+        client = ssh_connect(self.config)
+        if not client:
+            return False
+
+        with self._cond:
+            self._connections[0].client = client
+            self._connections[0].mark_up(None)
+            self._cond.notify_all()
+
+        self._thread = threading.Thread(target=self._maintain, name="ssh-pool", daemon=True)
+        self._thread.start()
+        log.info(f"🔌 SSH pool started ({self.size} transports, {self.max_channels} channels each)")
+        return True
+
+    def close(self):
+        self._stop.set()
+        self._wakeup.set()
+        if self.agent is not None:
+            self.agent.close()
+        with self._cond:
+            for conn in self._connections:
+                conn.drop_sftp()
+                if conn.client:
+                    conn.client.close()
+                    conn.client = None
+            self._cond.notify_all()
+
+    # ─── Leasing ───────────────────────────
+    def acquire(self, timeout=DEFAULT_LEASE_TIMEOUT):
+        """
+        Returns an SSHLease on the least busy healthy transport, waiting up to
+        `timeout` seconds for one to become available.
+        """
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while True:
+                candidates = [c for c in self._connections if c.is_active() and c.has_capacity()]
+                if candidates:
+                    conn = min(candidates, key=lambda c: c.leases)
+                    conn.leases += 1
+                    return SSHLease(self, conn)
+
+                if not any(c.is_active() for c in self._connections):
+                    self._wakeup.set()
+
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or self._stop.is_set():
+                    raise TimeoutError("No SSH connection available")
+                self._cond.wait(min(remaining, 1))
+
+    def release(self, lease):
+        with self._cond:
+            lease.connection.leases -= 1
+            self._cond.notify()
+
+    @contextmanager
+    def lease(self, timeout=DEFAULT_LEASE_TIMEOUT):
+        lease = self.acquire(timeout)
+        try:
+            yield lease
+        finally:
+            self.release(lease)
+
+    def health(self):
+        """
+        Connection state and latency of every transport, as reported by the
+        background supervisor.
+        """
+        with self._cond:
+            transports = [c.health() for c in self._connections]
+        up = sum(1 for t in transports if t["state"] == "up")
+        rtts = [t["rtt_ms"] for t in transports if t["state"] == "up" and t["rtt_ms"] is not None]
+        return {
+            "host": self.config.get("remote_host"),
+            "state": "up" if up == len(transports) else "degraded" if up else "down",
+            "rtt_ms": round(min(rtts), 2) if rtts else None,
+            "transports": transports,
+        }
+
+    # ─── Supervision ───────────────────────
+    def _maintain(self):
+        """
+        Background supervisor: probes every live transport with a keepalive
+        request (which also measures RTT) and reconnects dead ones with
+        exponential backoff, so requests never pay the reconnect cost.
+        """
+        while not self._stop.is_set():
+            for conn in self._connections:
+                if self._stop.is_set():
+                    break
+                if conn.is_active():
+                    self._probe(conn)
+                elif time.monotonic() >= conn.next_attempt:
+                    self._reconnect(conn)
+            self._wakeup.wait(HEALTH_INTERVAL)
+            self._wakeup.clear()
+
+    def _probe(self, conn):
+        transport = conn.client.get_transport()
+        result = {}
+
+        def send_keepalive():
+            start = time.monotonic()
+            # OpenSSH answers unknown global requests with a failure reply, which is enough to time a round-trip
+            transport.global_request("keepalive@openssh.com", wait=True)
+            result["rtt"] = time.monotonic() - start
+
+        # global_request has no timeout of its own, so wait for it from the outside
+        probe = threading.Thread(target=send_keepalive, name=f"ssh-probe-{conn.index}", daemon=True)
+        probe.start()
+        probe.join(PROBE_TIMEOUT)
+
+        if "rtt" in result and transport.is_active():
+            conn.mark_up(result["rtt"] * 1000)
+            return
+
+        log.warning(f"SSH transport #{conn.index} did not answer keepalive within {PROBE_TIMEOUT}s — dropping it")
+        conn.mark_down("Keepalive timed out")
+        # Closing the transport also unblocks the pending keepalive
+        transport.close()
+        self._reconnect(conn)
+
+    def _reconnect(self, conn):
+        if conn.client is not None:
+            log.warning(f"SSH transport #{conn.index} inactive — reconnecting in background...")
+
+        # Connect outside the lock so leases on healthy transports are not blocked
+        conn.state = "connecting"
+        client = ssh_connect(self.config)
+        if not client:
+            conn.mark_failed("Connection failed")
+            log.warning(f"SSH transport #{conn.index} retrying in {conn.backoff:.0f}s")
+            return
+
+        with self._cond:
+            old, conn.client = conn.client, client
+            conn.mark_up(None)
+            self._cond.notify_all()
+
+        # Sessions cached on the old transport are useless now
+        conn.drop_sftp()
+
+        if old is not None:
+            try:
+                old.close()
+            except Exception:
+                pass
@@ -1,130 +1,369 @@
-import os
-import paramiko
-from utils.logging_utils import log
-
-def is_ssh_active(ssh):
-    try:
-        return ssh is not None and ssh.get_transport() and ssh.get_transport().is_active()
-    except Exception:
-        return False
-    
-def ssh_connect(config):
-    """
-    Establishes an SSH connection to the remote VM using password authentication.
-    Handles and logs connection issues gracefully.
-    """
-    ssh = paramiko.SSHClient()
-    ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-
-    try:
-        log.info("Connecting using password...")
-        ssh.connect(
-            config["remote_host"],
-            port=config["remote_port"],
-            username=config["root_user"],
-            password=config["vm_password"]
-        )
-        return ssh
-    except Exception as e:
-        log.error(f"SSH connection failed: {type(e).__name__}: {e}")
-        return None
-
-def ensure_remote_dependencies(ssh):
-    """
-    Installs required packages on the remote VM using apt.
-    If Python is 3.12+, uses pipx instead of pip for tools.
-    """
-    try:
-        log.info("📦 Ensuring dependencies are installed on remote VM...")
-
-        # Install base dependencies + pipx support
-        base_cmd = (
-            "DEBIAN_FRONTEND=noninteractive apt-get update -y && "
-            "DEBIAN_FRONTEND=noninteractive apt-get install -y "
-            "zip rsync git screen python3-pip python3-venv pipx tshark tcpdump"
-        )
-        stdin, stdout, stderr = ssh.exec_command(base_cmd)
-        if stdout.channel.recv_exit_status() != 0:
-            raise Exception(stderr.read().decode())
-
-        # Determine Python version
-        stdin, stdout, stderr = ssh.exec_command("python3 --version")
-        version_output = stdout.read().decode().strip()
-        version = tuple(map(int, version_output.split()[1].split('.')[:2]))
-
-        if version >= (3, 12):
-            log.info(f"🐍 Detected Python {version_output}, using pipx...")
-            cmd = (
-                "pipx ensurepath && "
-                "pipx install mitmproxy && "
-                "pipx inject mitmproxy cachetools scapy && "
-                "python3 -m pip install cachetools --break-system-packages"
-            )
-        else:
-            log.info(f"🐍 Detected Python {version_output}, using pip...")
-            cmd = "python3 -m pip install mitmproxy cachetools scapy"
-
-        # Execute pip or pipx command
-        stdin, stdout, stderr = ssh.exec_command(cmd)
-        if stdout.channel.recv_exit_status() != 0:
-            raise Exception(stderr.read().decode())
-
-        log.info("✅ Remote dependencies installed.")
-    except Exception as e:
-        log.error(f"❌ Failed to install dependencies: {e}")
-
-
-def setup_ssh_authorized_key(ssh, config):
-    """
-    Ensures the current public key is present in the remote VM's ~/.ssh/authorized_keys.
-    Uses the given SSH connection (must be authenticated).
-    """
-    pub_key_path = "/root/.ssh/id_rsa.pub"
-    if not pub_key_path:
-        log.info("Skipped adding SSH key to authorized_keys")
-        return False
-
-    if not os.path.exists(pub_key_path):
-        log.error(f"⚠️ SSH public key not found at path: {pub_key_path}")
-        return False
-
-    with open(pub_key_path, 'r') as key_file:
-        pub_key = key_file.read().strip()
-
-    try:
-        log.info("🔐 Setting up authorized_keys on remote VM...")
-
-        # Ensure .ssh folder and authorized_keys file
-        ssh.exec_command('mkdir -p ~/.ssh && chmod 700 ~/.ssh')
-        ssh.exec_command('touch ~/.ssh/authorized_keys && chmod 600 ~/.ssh/authorized_keys')
-
-        # Avoid duplicates before appending key
-        check_and_add_cmd = f'grep -qxF "{pub_key}" ~/.ssh/authorized_keys || echo "{pub_key}" >> ~/.ssh/authorized_keys'
-        stdin, stdout, stderr = ssh.exec_command(check_and_add_cmd)
-
-        out = stdout.read().decode().strip()
-        err = stderr.read().decode().strip()
-
-        if out:
-            log.info(f"STDOUT: {out}")
-        if err:
-            log.warning(f"STDERR: {err}")
-
-        log.info("✅ Public key ensured on VM.")
-        return True
-
-    except Exception as e:
-        log.error(f"❌ Failed to setup authorized key: {type(e).__name__}: {e}")
-        return False
-
-def run_remote_command(ssh, command, raise_on_error=False):
-    stdin, stdout, stderr = ssh.exec_command(command)
-    out = stdout.read().decode()
-    err = stderr.read().decode()
-
-    if err.strip():
-        log.warning(f"⚠️ {err.strip()}")
-        if raise_on_error:
-            raise Exception(f"Command failed: {err.strip()}")
-
-    return out
\ No newline at end of file
+import hashlib
+import os
+import re
+import time
+from contextlib import contextmanager
+import uuid
+import paramiko
+from utils.logging_utils import log
+from utils.async_utils import get_executor
+from utils.metrics_utils import current_operation, record_remote_call, track_operation
+
+INSTALL_TIMEOUT = 900
+APT_PACKAGES = ("zip", "rsync", "git", "screen", "python3-pip", "python3-venv", "pipx", "tshark", "tcpdump")
+PROXY_PACKAGES = ("mitmproxy", "cachetools", "scapy")
+DEPS_FINGERPRINT_PATH = "/root/.cannavaro/dependencies.fingerprint"
+
+def is_ssh_active(ssh):
+    try:
+        return ssh is not None and ssh.get_transport() and ssh.get_transport().is_active()
+    except Exception:
+        return False
+    
+def ssh_connect(config):
+    """
+    Establishes an SSH connection to the remote VM using password authentication.
+    Handles and logs connection issues gracefully.
+    """
+    ssh = paramiko.SSHClient()
+    ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+
+    try:
+        log.info("Connecting using password...")
+        ssh.connect(
+            config["remote_host"],
+            port=config["remote_port"],
+            username=config["root_user"],
+            password=config["vm_password"]
+        )
+        return ssh
+    except Exception as e:
+        log.error(f"SSH connection failed: {type(e).__name__}: {e}")
+        return None
+
+@track_operation("probe_remote_dependencies")
+def probe_remote_dependencies(ssh):
+    """
+    Checks every dependency in one batched round-trip.
+    Returns {"missing_apt": [...], "python": (major, minor), "proxy_tools": bool}.
+    The slow check of the mitmproxy environment is skipped when the VM holds
+    a matching fingerprint from a previous successful install.
+    """
+    dpkg_query = "dpkg-query -W -f='${Package} ${Status}\\n' " + " ".join(APT_PACKAGES)
+    proxy_check = (
+        f'export PATH="$PATH:$HOME/.local/bin"; command -v mitmdump >/dev/null 2>&1 && '
+        f'{{ test "$(cat {DEPS_FINGERPRINT_PATH} 2>/dev/null)" = "{dependencies_fingerprint()}" || '
+        f"python3 -c 'import mitmproxy, cachetools, scapy' 2>/dev/null || "
+        f"pipx runpip mitmproxy show cachetools scapy >/dev/null 2>&1; }}"
+    )
+    installed, version, proxy = run_remote_batch(ssh, [dpkg_query, "python3 --version", proxy_check], timeout=30)
+
+    ok = {line.split()[0] for line in installed["stdout"].splitlines() if line.endswith("install ok installed")}
+    match = re.search(r"(\d+)\.(\d+)", version["stdout"])
+    return {
+        "missing_apt": [pkg for pkg in APT_PACKAGES if pkg not in ok],
+        "python": (int(match.group(1)), int(match.group(2))) if match else None,
+        "proxy_tools": proxy["exit_code"] == 0,
+    }
+
+@track_operation("ensure_remote_dependencies")
+def ensure_remote_dependencies(ssh):
+    """
+    Probes the remote VM and installs only the apt packages it is missing.
+    The mitmproxy tools are left to install_proxy_dependencies(), which the
+    caller can run in the background. Returns a dict with 'success' and
+    'pending' (True if the proxy tools still need to be installed) and 'python'.
+    """
+    try:
+        log.info("📦 Checking dependencies on remote VM...")
+        state = probe_remote_dependencies(ssh)
+
+        if state["missing_apt"]:
+            log.info(f"📦 Installing missing packages: {', '.join(state['missing_apt'])}")
+            cmd = (
+                "DEBIAN_FRONTEND=noninteractive apt-get update -y && "
+                "DEBIAN_FRONTEND=noninteractive apt-get install -y " + " ".join(state["missing_apt"])
+            )
+            result = exec_remote(ssh, cmd, timeout=INSTALL_TIMEOUT)
+            if result["exit_code"] != 0:
+                raise Exception(result["stderr"])
+            if state["python"] is None:
+                state = probe_remote_dependencies(ssh)
+
+        if state["proxy_tools"]:
+            write_dependencies_fingerprint(ssh)
+            log.info("✅ Remote dependencies already satisfied.")
+        else:
+            log.info("📦 Base packages ready, proxy tools still to install.")
+        return {"success": True, "pending": not state["proxy_tools"], "python": state["python"]}
+    except Exception as e:
+        log.error(f"❌ Failed to install dependencies: {e}")
+        return {"success": False, "pending": False, "error": str(e)}
+
+@track_operation("install_proxy_dependencies")
+def install_proxy_dependencies(ssh, python_version):
+    """
+    Installs mitmproxy and the packages the proxies need.
+    If Python is 3.12+, uses pipx instead of pip for tools.
+    """
+    try:
+        if python_version and python_version >= (3, 12):
+            log.info(f"🐍 Detected Python {python_version[0]}.{python_version[1]}, using pipx...")
+            cmd = (
+                "pipx ensurepath && "
+                "pipx install mitmproxy && "
+                "pipx inject mitmproxy cachetools scapy && "
+                "python3 -m pip install cachetools --break-system-packages"
+            )
+        else:
+            log.info("🐍 Using pip for proxy tools...")
+            cmd = "python3 -m pip install mitmproxy cachetools scapy"
+
+        result = exec_remote(ssh, cmd, timeout=INSTALL_TIMEOUT)
+        if result["exit_code"] != 0:
+            raise Exception(result["stderr"])
+
+        write_dependencies_fingerprint(ssh)
+        log.info("✅ Remote dependencies installed.")
+        return True
+    except Exception as e:
+        log.error(f"❌ Failed to install proxy dependencies: {e}")
+        return False
+
+def dependencies_fingerprint():
+    """Changes whenever the dependency list does, so old fingerprints stop matching."""
+    spec = " ".join(APT_PACKAGES) + "|" + " ".join(PROXY_PACKAGES)
+    return hashlib.sha256(spec.encode()).hexdigest()
+
+def write_dependencies_fingerprint(ssh):
+    exec_remote(
+        ssh,
+        f"mkdir -p {os.path.dirname(DEPS_FINGERPRINT_PATH)} && "
+        f"echo {dependencies_fingerprint()} > {DEPS_FINGERPRINT_PATH}",
+        timeout=30,
+    )
+
+
+@track_operation("setup_ssh_authorized_key")
+def setup_ssh_authorized_key(ssh, config):
+    """
+    Ensures the current public key is present in the remote VM's ~/.ssh/authorized_keys.
+    Uses the given SSH connection (must be authenticated).
+    """
+    pub_key_path = "/root/.ssh/id_rsa.pub"
+    if not pub_key_path:
+        log.info("Skipped adding SSH key to authorized_keys")
+        return False
+
+    if not os.path.exists(pub_key_path):
+        log.error(f"⚠️ SSH public key not found at path: {pub_key_path}")
+        return False
+
+    with open(pub_key_path, 'r') as key_file:
+        pub_key = key_file.read().strip()
+
+    try:
+        log.info("🔐 Setting up authorized_keys on remote VM...")
+
+        # Ensure .ssh folder and authorized_keys file, avoiding duplicates before appending key
+        check_and_add_cmd = f'grep -qxF "{pub_key}" ~/.ssh/authorized_keys || echo "{pub_key}" >> ~/.ssh/authorized_keys'
+        results = run_remote_batch(ssh, [
+            'mkdir -p ~/.ssh && chmod 700 ~/.ssh',
+            'touch ~/.ssh/authorized_keys && chmod 600 ~/.ssh/authorized_keys',
+            check_and_add_cmd,
+        ])
+
+        out = "".join(r["stdout"] for r in results).strip()
+        err = "".join(r["stderr"] for r in results).strip()
+
+        if out:
+            log.info(f"STDOUT: {out}")
+        if err:
+            log.warning(f"STDERR: {err}")
+
+        log.info("✅ Public key ensured on VM.")
+        return True
+
+    except Exception as e:
+        log.error(f"❌ Failed to setup authorized key: {type(e).__name__}: {e}")
+        return False
+
+def exec_remote(ssh, command, timeout=None, stdin_data=None, cleanup=None, on_output=None):
+    """
+    Runs a command on the remote executor and blocks until it finishes.
+    Returns a dict with 'command', 'stdout', 'stderr' and 'exit_code'.
+    Raises TimeoutError if it runs longer than `timeout` seconds.
+    on_output(stream, text), if given, receives the output as it arrives.
+    """
+    executor = get_executor()
+    return executor.run(executor.exec_command(ssh, command, timeout, stdin_data, cleanup, on_output))
+
+@contextmanager
+def sftp_session(ssh):
+    """
+    SFTP session for `ssh`: a cached one when `ssh` is a pooled lease,
+    otherwise a fresh session that is closed afterwards. Transfers made on
+    it are metered like the executor's.
+    """
+    if hasattr(ssh, "sftp_session"):
+        with ssh.sftp_session() as sftp:
+            yield MeteredSFTP(sftp)
+        return
+
+    sftp = ssh.open_sftp()
+    try:
+        yield MeteredSFTP(sftp)
+    finally:
+        sftp.close()
+
+
+class MeteredSFTP:
+    """
+    Wraps an SFTP session so that put/get, file reads and writes, chmod and
+    stat are recorded as remote calls (kind "sftp_<method>").
+    Everything else is passed through.
+    """
+
+    def __init__(self, sftp):
+        self._sftp = sftp
+
+    def __getattr__(self, name):
+        return getattr(self._sftp, name)
+
+    def _timed(self, method, fn, *args, size=None):
+        """fn(*args), recorded; size() gives the bytes moved, if any."""
+        started = time.monotonic()
+        try:
+            result = fn(*args)
+        except Exception:
+            record_remote_call(current_operation(), f"sftp_{method}", time.monotonic() - started, "error")
+            raise
+        direction = {"get": "bytes_in", "put": "bytes_out"}.get(method)
+        sizes = {direction: size()} if size and direction else {}
+        record_remote_call(current_operation(), f"sftp_{method}", time.monotonic() - started, "ok", **sizes)
+        return result
+
+    def put(self, localpath, remotepath, *args):
+        return self._timed("put", self._sftp.put, localpath, remotepath, *args, size=lambda: os.path.getsize(localpath))
+
+    def get(self, remotepath, localpath, *args):
+        return self._timed("get", self._sftp.get, remotepath, localpath, *args, size=lambda: os.path.getsize(localpath))
+
+    def chmod(self, path, mode):
+        return self._timed("chmod", self._sftp.chmod, path, mode)
+
+    def stat(self, path):
+        return self._timed("stat", self._sftp.stat, path)
+
+    def open(self, filename, mode="r", *args, **kwargs):
+        return _MeteredFile(self._sftp.open(filename, mode, *args, **kwargs), "read" if mode.startswith("r") else "write")
+
+
+class _MeteredFile:
+    """Remote file recorded as one call, with its bytes, when it is closed."""
+
+    def __init__(self, f, method):
+        self._f = f
+        self._method = method
+        self._bytes = 0
+        self._started = time.monotonic()
+        self._closed = False
+
+    def __getattr__(self, name):
+        return getattr(self._f, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def read(self, *args):
+        data = self._f.read(*args)
+        self._bytes += len(data)
+        return data
+
+    def write(self, data):
+        self._bytes += len(data)
+        return self._f.write(data)
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self._f.close()
+        direction = "bytes_in" if self._method == "read" else "bytes_out"
+        record_remote_call(current_operation(), f"sftp_{self._method}", time.monotonic() - self._started, "ok",
+                           **{direction: self._bytes})
+
+def download_remote_file(ssh, remote_path, local_path, timeout=None):
+    executor = get_executor()
+    executor.run(executor.sftp_get(ssh, remote_path, local_path, timeout))
+
+def run_remote_command(ssh, command, raise_on_error=False, timeout=None):
+    result = exec_remote(ssh, command, timeout=timeout)
+    out = result["stdout"]
+    err = result["stderr"]
+
+    if err.strip():
+        log.warning(f"⚠️ {err.strip()}")
+        if raise_on_error:
+            raise Exception(f"Command failed: {err.strip()}")
+
+    return out
+
+def _build_batch_script(commands, token, stop_on_error):
+    """
+    Wraps each command so its stdout, stderr and exit code end up on stdout
+    between marker lines that carry a random token.
+    """
+    lines = ['__cv_err=$(mktemp)', "trap 'rm -f \"$__cv_err\"' EXIT"]
+    for i, command in enumerate(commands):
+        lines += [
+            f"printf '\\n%s OUT %d\\n' '{token}' {i}",
+            f"( {command}\n) </dev/null 2>\"$__cv_err\"",
+            "__cv_rc=$?",
+            f"printf '\\n%s ERR %d\\n' '{token}' {i}",
+            'cat "$__cv_err"',
+            f"printf '\\n%s RC %d %d\\n' '{token}' {i} $__cv_rc",
+        ]
+        if stop_on_error:
+            lines.append('[ "$__cv_rc" -eq 0 ] || exit 0')
+    return "\n".join(lines) + "\n"
+
+def _parse_batch_output(output, token, commands):
+    marker = re.compile(rf"\n{re.escape(token)} (OUT|ERR|RC) (\d+)(?: (-?\d+))?\n")
+    results = {}
+    matches = list(marker.finditer(output))
+
+    for pos, match in enumerate(matches):
+        kind, index = match.group(1), int(match.group(2))
+        end = matches[pos + 1].start() if pos + 1 < len(matches) else len(output)
+        entry = results.setdefault(index, {"command": commands[index], "stdout": "", "stderr": "", "exit_code": None})
+        if kind == "OUT":
+            entry["stdout"] = output[match.end():end]
+        elif kind == "ERR":
+            entry["stderr"] = output[match.end():end]
+        else:
+            entry["exit_code"] = int(match.group(3))
+
+    return [results[i] for i in sorted(results)]
+
+def run_remote_batch(ssh, commands, stop_on_error=False, timeout=None):
+    """
+    Runs a list of shell commands as a single script over one SSH channel.
+    Returns one dict per executed command with 'command', 'stdout', 'stderr'
+    and 'exit_code'. With stop_on_error, execution stops at the first command
+    that exits non-zero and the remaining commands are not reported.
+    """
+    if not commands:
+        return []
+
+    token = f"__CANNAVARO_{uuid.uuid4().hex}__"
+    script = _build_batch_script(commands, token, stop_on_error)
+
+    result = exec_remote(ssh, "bash -s", timeout=timeout, stdin_data=script)
+    if result["stderr"].strip():
+        log.warning(f"⚠️ {result['stderr'].strip()}")
+
+    return _parse_batch_output(result["stdout"], token, commands)
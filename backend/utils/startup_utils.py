@@ -0,0 +1,126 @@
+# utils/startup_utils.py
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from utils.logging_utils import log
+
+DEFAULT_WORKERS = 4
+
+
+class StartupTask:
+    def __init__(self, name, fn, deps):
+        self.name = name
+        self.fn = fn
+        self.deps = tuple(deps)
+        self.status = "pending"
+        self.error = None
+        self.started_at = None
+        self.finished_at = None
+        self._started = None
+        self.duration = None
+
+    def to_dict(self):
+        return {
+            "status": self.status,
+            "deps": list(self.deps),
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "duration_s": round(self.duration, 3) if self.duration is not None else None,
+            "error": self.error,
+        }
+
+
+class StartupGraph:
+    """
+    Startup steps and their dependencies. start() runs the graph in the
+    background: every step starts as soon as the steps it depends on are done,
+    so independent steps run concurrently. A step that raises fails, and the
+    steps depending on it are skipped.
+    """
+
+    def __init__(self, name, max_workers=DEFAULT_WORKERS):
+        self.name = name
+        self.max_workers = max_workers
+        self.tasks = {}
+        self._lock = threading.Lock()
+        self._finished = threading.Event()
+
+    def add(self, name, fn, deps=()):
+        """Adds a step; fn takes no arguments. Dependencies must be added first."""
+        missing = [d for d in deps if d not in self.tasks]
+        if missing:
+            raise ValueError(f"Unknown dependencies for {name}: {', '.join(missing)}")
+        self.tasks[name] = StartupTask(name, fn, deps)
+
+    def start(self):
+        threading.Thread(target=self._run, name=f"startup-{self.name}", daemon=True).start()
+
+    def wait(self, timeout=None):
+        return self._finished.wait(timeout)
+
+    @property
+    def ready(self):
+        return self._finished.is_set()
+
+    def status(self):
+        with self._lock:
+            return {
+                "ready": self.ready,
+                "ok": all(t.status == "done" for t in self.tasks.values()),
+                "steps": {name: t.to_dict() for name, t in self.tasks.items()},
+            }
+
+    # ─── Internals ─────────────────────────
+    def _runnable(self):
+        runnable = []
+        for task in self.tasks.values():
+            if task.status != "pending":
+                continue
+            states = [self.tasks[d].status for d in task.deps]
+            if any(s in ("failed", "skipped") for s in states):
+                task.status = "skipped"
+                task.error = "A dependency failed"
+            elif all(s == "done" for s in states):
+                runnable.append(task)
+        return runnable
+
+    def _execute(self, task):
+        with self._lock:
+            task.status = "running"
+            task.started_at = time.time()
+            task._started = time.monotonic()
+        try:
+            task.fn()
+            status, error = "done", None
+        except Exception as e:
+            log.error(f"❌ [{self.name}] Startup step '{task.name}' failed: {type(e).__name__}: {e}")
+            status, error = "failed", str(e)
+        with self._lock:
+            task.status, task.error = status, error
+            task.finished_at = time.time()
+            task.duration = time.monotonic() - task._started
+
+    def _run(self):
+        started = time.monotonic()
+        running = set()
+        with ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix=f"startup-{self.name}") as executor:
+            while True:
+                with self._lock:
+                    # Skipping a step can unblock nothing but may skip others, so repeat until stable
+                    while True:
+                        before = sum(t.status == "skipped" for t in self.tasks.values())
+                        runnable = self._runnable()
+                        if sum(t.status == "skipped" for t in self.tasks.values()) == before:
+                            break
+                    for task in runnable:
+                        task.status = "queued"
+                for task in runnable:
+                    running.add(executor.submit(self._execute, task))
+
+                if not running:
+                    break
+                done, running = wait(running, return_when=FIRST_COMPLETED)
+                running = set(running)
+
+        self._finished.set()
+        log.info(f"🚀 [{self.name}] Startup finished in {time.monotonic() - started:.1f}s")
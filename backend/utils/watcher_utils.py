@@ -0,0 +1,108 @@
+# utils/watcher_utils.py
+import json
+import shlex
+import threading
+from utils.logging_utils import log
+from utils.services_utils import DISCOVERY_SCRIPT_PATH, known_compose_files, merge_discovered_service
+
+WATCH_INTERVAL = 2
+MIN_RETRY = 1
+MAX_RETRY = 60
+
+
+class ServiceWatcher:
+    """
+    Keeps a host's service registry in sync with the VM.
+    The discovery script runs in watch mode on one long-lived channel and
+    streams a JSON event per changed compose file or proxy folder; only the
+    affected service entry is re-parsed and replaced. If the channel drops
+    (e.g. the transport was reconnected) the watcher restarts it with backoff.
+    """
+
+    def __init__(self, host, root_dir="/root", interval=WATCH_INTERVAL):
+        self.host = host
+        self.root_dir = root_dir
+        self.interval = interval
+        self._channel = None
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name=f"watcher-{host.name}", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._channel is not None:
+            self._channel.close()
+
+    # ─── Channel ───────────────────────────
+    def _open(self, ssh):
+        with open(DISCOVERY_SCRIPT_PATH, "rb") as f:
+            script = f.read()
+
+        known = known_compose_files(self.host.services)
+        cmd = f"python3 - {shlex.quote(self.root_dir)} {shlex.quote(json.dumps(known))} --watch {self.interval}"
+
+        channel = ssh.get_transport().open_session()
+        channel.exec_command(cmd)
+        channel.sendall(script)
+        channel.shutdown_write()
+        return channel
+
+    def _run(self):
+        retry = MIN_RETRY
+        while not self._stop.is_set():
+            try:
+                # The lease is held as long as the channel is open, so it counts
+                # against the transport's channel cap like any other command
+                with self.host.pool.lease() as ssh:
+                    try:
+                        self._channel = self._open(ssh)
+                        log.info(f"👀 [{self.host.name}] Watching services for changes.")
+                        for line in self._channel.makefile("r"):
+                            retry = MIN_RETRY
+                            self._handle(json.loads(line))
+                    finally:
+                        if self._channel is not None:
+                            self._channel.close()
+            except Exception as e:
+                if not self._stop.is_set():
+                    log.warning(f"⚠️ [{self.host.name}] Service watcher error: {type(e).__name__}: {e}")
+
+            if self._stop.wait(retry):
+                break
+            retry = min(retry * 2, MAX_RETRY)
+
+    # ─── Events ────────────────────────────
+    def _handle(self, event):
+        kind = event.get("event")
+        if kind == "heartbeat":
+            return
+
+        registry = self.host.services
+
+        if kind == "removed":
+            # Only if the entry came from that compose file
+            current = registry.get(event["name"])
+            if current is not None and current.get("compose", {}).get("path", event["path"]) != event["path"]:
+                return
+            if registry.remove(event["name"]):
+                log.info(f"🗑️ [{self.host.name}] Service {event['name']} was removed.")
+
+        elif kind == "changed":
+            entry = event["entry"]
+            if entry["name"].lower() == "pcaps":
+                return
+
+            def merge(old):
+                # Runs under the service's lock, so locks set meanwhile are carried over
+                service, changed = merge_discovered_service(old, entry)
+                if not changed:
+                    return None
+                if old is None:
+                    log.info(f"🆕 [{self.host.name}] New service {entry['name']} discovered.")
+                else:
+                    log.info(f"🔄 [{self.host.name}] Service {entry['name']} changed, updated.")
+                return service
+
+            registry.merge(entry["name"], merge)
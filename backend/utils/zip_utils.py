@@ -3,7 +3,11 @@ import zipfile
 import os
 import datetime
 from utils.logging_utils import log
-import threading
+from utils.ssh_utils import exec_remote, download_remote_file
+from utils.metrics_utils import track_operation
+
+ZIP_TIMEOUT = 5
+DOWNLOAD_TIMEOUT = 120
 
 def setup_zip_dirs(base_dir):
     startup_zip_path = os.path.join(base_dir, 'home_backup_startup.zip')
@@ -12,61 +16,45 @@ def setup_zip_dirs(base_dir):
     os.makedirs(current_zip_dir, exist_ok=True)
     return startup_zip_path, current_zip_dir
 
-def create_and_download_zip(ssh, base_dir, filename="home_backup.zip"):
+@track_operation("create_and_download_zip")
+def create_and_download_zip(ssh, base_dir, filename="home_backup.zip", timeout=ZIP_TIMEOUT):
     # Ensure zip folder exists
     os.makedirs(base_dir, exist_ok=True)
 
     remote_dir_to_zip = "/root"
     remote_zip_path = f"/root/{filename}"
 
-    # Avoid recursive inclusion
-    ssh.exec_command(f'rm -f {remote_zip_path}')
-    
-    zip_cmd = f'cd {remote_dir_to_zip} && zip -r {filename} *'
-    
-    result = {}
-
-    def run_zip():
-        try:
-            stdin, stdout, stderr = ssh.exec_command(zip_cmd)
-            stdout.channel.recv_exit_status()
-            result['status'] = 'success'
-        except Exception as e:
-            result['status'] = 'error'
-            result['error'] = str(e)
-
-    thread = threading.Thread(target=run_zip)
-    thread.start()
-    thread.join(timeout=5)
+    # Remove any previous zip first to avoid recursive inclusion
+    zip_cmd = f'rm -f {remote_zip_path} && cd {remote_dir_to_zip} && zip -r {filename} *'
+    # On timeout, stop zip and clean up the partial archive. Anchored so it
+    # only matches zip itself, not the shells whose command lines contain it
+    cleanup_cmd = f"pkill -f '^zip -r {filename}'; rm -f {remote_zip_path}"
 
-    if thread.is_alive():
-        log.error("❌ Remote zip creation took too long (over 5 seconds). Aborting.")
-        # Optional: clean up potentially partial zip
-        ssh.exec_command(f'rm -f {remote_zip_path}')
+    try:
+        exec_remote(ssh, zip_cmd, timeout=timeout, cleanup=cleanup_cmd)
+    except TimeoutError:
+        log.error(f"❌ Remote zip creation took too long (over {timeout} seconds). Aborting.")
         return None
-
-    if result.get('status') == 'error':
-        log.error(f"❌ Failed to run zip command: {result.get('error')}")
+    except Exception as e:
+        log.error(f"❌ Failed to run zip command: {e}")
         return None
 
-    sftp = ssh.open_sftp()
+    local_zip_path = os.path.join(base_dir, filename)
     try:
-        sftp.stat(remote_zip_path)
+        download_remote_file(ssh, remote_zip_path, local_zip_path, timeout=DOWNLOAD_TIMEOUT)
     except FileNotFoundError:
         log.error(f"❌ Remote zip file {remote_zip_path} not found.")
-        sftp.close()
         return None
+    except TimeoutError:
+        log.error(f"❌ Downloading {remote_zip_path} took too long (over {DOWNLOAD_TIMEOUT} seconds). Aborting.")
+        return None
+    finally:
+        # Clean up the remote zip whether or not the download succeeded
+        try:
+            exec_remote(ssh, f"rm -f {remote_zip_path}")
+        except Exception as e:
+            log.warning(f"⚠️ Failed to delete remote zip file: {e}")
 
-    local_zip_path = os.path.join(base_dir, filename)
-    sftp.get(remote_zip_path, local_zip_path)
-
-    # Clean up the remote zip after successful download
-    try:
-        sftp.remove(remote_zip_path)
-    except Exception as e:
-        log.warning(f"⚠️ Failed to delete remote zip file: {e}")
-
-    sftp.close()
     return local_zip_path
 
 
@@ -0,0 +1,37 @@
+import { useEffect, useRef } from "react";
+import { Box } from "@mui/material";
+
+// Live output of a running job, one line per event, kept scrolled to the bottom
+function JobOutput({ lines }) {
+  const endRef = useRef(null);
+
+  useEffect(() => {
+    endRef.current?.scrollIntoView({ block: "nearest" });
+  }, [lines]);
+
+  if (!lines.length) return null;
+
+  return (
+    <Box
+      component="pre"
+      sx={{
+        mt: 2,
+        mb: 0,
+        p: 1.5,
+        maxHeight: 300,
+        overflow: "auto",
+        borderRadius: 1,
+        bgcolor: "grey.900",
+        color: "grey.100",
+        fontSize: "0.75rem",
+        whiteSpace: "pre-wrap",
+        wordBreak: "break-all",
+      }}
+    >
+      {lines.join("\n")}
+      <span ref={endRef} />
+    </Box>
+  );
+}
+
+export default JobOutput;
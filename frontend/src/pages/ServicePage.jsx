@@ -12,6 +12,7 @@ import {
 } from "@mui/material";
 import ArrowBackIcon from "@mui/icons-material/ArrowBack";
 import { useAlert } from "../context/AlertContext";
+import { runJob } from "../utils/jobs";
 import ServiceHeader from "../components/ServiceHeader";
 import DetailsMenu from "../components/DetailsMenu";
 import RestartingDocker from "../assets/RestartingDocker";
@@ -31,6 +32,17 @@ import CachedIcon from "@mui/icons-material/Cached";
 import SubserviceCard from "../components/SubserviceCard";
 import DockerActionsBar from "../components/DockerActionsBar";
 import ProxyActionsCard from "../components/ProxyActionsCard";
+import JobOutput from "../components/JobOutput";
+
+// Lines of restart output kept on screen
+const MAX_OUTPUT_LINES = 500;
+
+const formatJobEvent = (event) => {
+  const prefix = event.service ? `[${event.service}] ` : "";
+  if (event.type === "step") return `▶ ${event.name}`;
+  if (event.type === "truncated") return `… ${event.missed} earlier events not shown`;
+  return prefix + event.line;
+};
 
 function ServicePage() {
   const { name } = useParams();
@@ -38,6 +50,7 @@ function ServicePage() {
   const [service, setService] = useState(null);
   const [settingProxy, setSettingProxy] = useState(false);
   const [restartingDocker, setRestartingDocker] = useState(false);
+  const [jobOutput, setJobOutput] = useState([]);
   const [lockedServices, setLockedServices] = useState(new Set());
   const [vmIp, setVmIp] = useState("");
   const [serviceIsProxy, setServiceIsProxy] = useState(false);
@@ -116,21 +129,14 @@ function ServicePage() {
     document.body.removeChild(textarea);
   };
 
+  const appendJobEvent = (event) =>
+    setJobOutput((lines) => [...lines, formatJobEvent(event)].slice(-MAX_OUTPUT_LINES));
+
   const handleResetDocker = async () => {
     setRestartingDocker(true);
+    setJobOutput([]);
     try {
-      const res = await fetch("/api/reset_docker", {
-        method: "POST",
-        headers: { "Content-Type": "application/json" },
-        body: JSON.stringify({
-          service: service.name,
-        }),
-      });
-
-      if (!res.ok) {
-        const err = await res.json();
-        throw new Error(err.error || "Unknown error");
-      }
+      await runJob("/api/reset_docker", { service: service.name }, appendJobEvent);
 
       showAlert("Docker reset successfully", "success");
     } catch (err) {
@@ -142,21 +148,9 @@ function ServicePage() {
 
   const handleResetSubservice = async (subservice) => {
     setRestartingDocker(true);
+    setJobOutput([]);
     try {
-      const res = await fetch("/api/reset_docker", {
-        method: "POST",
-        headers: { "Content-Type": "application/json" },
-        body: JSON.stringify({
-          service: name,
-          subservice: subservice,
-        }),
-      });
-
-      const data = await res.json();
-
-      if (!res.ok) {
-        throw new Error(data.error || "Unknown error");
-      }
+      await runJob("/api/reset_docker", { service: name, subservice }, appendJobEvent);
 
       showAlert(`Subservice ${subservice} restarted`, "success");
     } catch (err) {
@@ -222,6 +216,8 @@ function ServicePage() {
               onCopy={() => copyGitClone(service.name, vmIp)}
             />
 
+            <JobOutput lines={jobOutput} />
+
             <Box display="flex" flexWrap="wrap" gap={2} mt={4}>
               {service.services.map((svc) => (
                 <Box key={svc.name} flex={0.5}>
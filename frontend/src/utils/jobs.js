@@ -0,0 +1,42 @@
+// Starts a backend job (the POST answers 202 with a job id) and resolves with
+// the job's result once its "done" event arrives. onEvent receives every
+// step/output event while the job runs, and a "truncated" event if older
+// output had already been dropped from the server's replay buffer.
+export const runJob = async (url, body, onEvent) => {
+  const res = await fetch(url, {
+    method: "POST",
+    headers: { "Content-Type": "application/json" },
+    body: JSON.stringify(body),
+  });
+
+  const data = await res.json();
+  if (!res.ok) {
+    throw new Error(data.error || "Unknown error");
+  }
+
+  return new Promise((resolve, reject) => {
+    const source = new EventSource(data.events_url);
+
+    const forward = (type) => (e) => onEvent?.({ type, ...JSON.parse(e.data) });
+    source.addEventListener("step", forward("step"));
+    source.addEventListener("output", forward("output"));
+    source.addEventListener("truncated", forward("truncated"));
+
+    source.addEventListener("done", (e) => {
+      source.close();
+      const done = JSON.parse(e.data);
+      if (done.status === "succeeded") {
+        resolve(done.result);
+      } else {
+        const error = done.error;
+        reject(new Error(typeof error === "string" ? error : JSON.stringify(error) || "Job failed"));
+      }
+    });
+    // EventSource reconnects on its own (resuming via Last-Event-ID); only give up if it can't
+    source.onerror = () => {
+      if (source.readyState === EventSource.CLOSED) {
+        reject(new Error("Lost connection to job events"));
+      }
+    };
+  });
+};